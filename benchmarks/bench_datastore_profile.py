@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares ingest and ticket query latency of the datastore without tuning
+(default pragmas, no secondary indexes) and with the performance profile.
+
+usage:
+    python -m benchmarks.bench_datastore_profile --rows 100000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from bookops_watchdog.datastore import Base, DataAccessLayer, Ticket
+from bookops_watchdog.worker_datastore import (
+    CHECKPOINT_ROWS,
+    get_file,
+    get_library_wid,
+    ingest_chunk,
+)
+from bookops_watchdog.worker_reports import SierraExportReader
+from benchmarks.synthetic import make_export
+
+
+def drop_secondary_indexes(dal: DataAccessLayer) -> None:
+    with dal.engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+
+
+def measure(export_fh: str, store_fh: str, tuned: bool, queries: int) -> dict:
+    dal = DataAccessLayer(
+        f"sqlite:///{store_fh}", profile="performance" if tuned else "default"
+    )
+    dal.connect()
+    if not tuned:
+        drop_secondary_indexes(dal)
+
+    # ingest committed every CHECKPOINT_ROWS rows, as done by the app
+    start = time.perf_counter()
+    session = dal.Session()
+    file = get_file(
+        session, get_library_wid(session, "bpl"), os.path.basename(export_fh)
+    )
+    count = 0
+    for records, end in SierraExportReader(export_fh).iter_chunks(CHECKPOINT_ROWS):
+        ingest_chunk(session, file, records, file.checkpoint_offset, end)
+        session.commit()
+        count += len(records)
+    ingest = time.perf_counter() - start
+
+    # one ticket per order
+    rows = [
+        dict(conflict_wid=n % 50 + 1, order_wid=n, bib_wid=n // 2, copies=1)
+        for n in range(count)
+    ]
+    for i in range(0, len(rows), 5000):
+        session.bulk_insert_mappings(Ticket, rows[i : i + 5000])
+        session.commit()
+
+    start = time.perf_counter()
+    for n in range(queries):
+        session.query(Ticket).filter(
+            Ticket.bib_wid == n * 7, Ticket.reported == False  # noqa: E712
+        ).all()
+    query = (time.perf_counter() - start) / queries
+    session.close()
+    dal.dispose()
+
+    return dict(
+        mode="tuned" if tuned else "untuned",
+        rows=count,
+        ingest_sec=round(ingest, 3),
+        ticket_query_ms=round(query * 1000, 3),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="datastore profile benchmark")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        export_fh = os.path.join(tmp, "BookOpsQCb.bench")
+        make_export(export_fh, args.rows)
+        for tuned in (False, True):
+            store_fh = os.path.join(tmp, f"datastore-{tuned}.db")
+            print(measure(export_fh, store_fh, tuned, args.queries))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compares memory footprint and throughput of dict and compact (Record)
+output of SierraExportReader.
+
+usage:
+    python -m benchmarks.bench_record_types --rows 100000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from bookops_watchdog.worker_reports import SierraExportReader
+from benchmarks.synthetic import make_export
+
+
+def measure(fh: str, compact: bool) -> dict:
+    reader = SierraExportReader(fh, compact=compact)
+
+    start = time.perf_counter()
+    for _ in reader:
+        pass
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    records = list(reader)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(
+        mode="compact" if compact else "dict",
+        rows=len(records),
+        bytes_per_record=round(size / len(records)),
+        rows_per_sec=round(len(records) / elapsed),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="record type benchmark")
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fh = os.path.join(tmp, "BookOpsQCb.bench")
+        make_export(fh, args.rows)
+        for compact in (False, True):
+            print(measure(fh, compact))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measures CLI startup: import time of the app module reported by
+`python -X importtime` and wall time of `python -m bookops_watchdog.app
+--help`. Fails when a heavy dependency is imported at startup or startup
+exceeds given limit, so it can guard against regressions.
+
+usage:
+    python -m benchmarks.bench_startup --repeat 10 --max-ms 250
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+MODULE = "bookops_watchdog.app"
+
+# dependencies that must be imported only on code paths that use them
+HEAVY_MODULES = ("sqlalchemy", "requests", "urllib3", "yaml", "loggly", "pymarc")
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int]]:
+    """
+    Parses `-X importtime` output
+
+    Args:
+        stderr:                 stderr of the interpreter
+
+    Returns:
+        list of (module, self us, cumulative us)
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        if not own.strip().isdigit():
+            # header line
+            continue
+        modules.append((name.strip(), int(own), int(cumulative)))
+    return modules
+
+
+def measure_import() -> Tuple[float, List[Tuple[str, int, int]]]:
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {MODULE}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = parse_importtime(out.stderr)
+    total = next(c for name, _, c in reversed(modules) if name == MODULE)
+    return total / 1000, modules
+
+
+def measure_help() -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", MODULE, "--help"],
+        capture_output=True,
+        check=True,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def run(repeat: int, top: int) -> Dict:
+    imports = []
+    helps = []
+    modules: List[Tuple[str, int, int]] = []
+    for _ in range(repeat):
+        ms, modules = measure_import()
+        imports.append(ms)
+        helps.append(measure_help())
+    loaded = {name.split(".")[0] for name, _, _ in modules}
+    heaviest = sorted(modules, key=lambda m: m[1], reverse=True)[:top]
+    return dict(
+        import_ms=dict(
+            best=round(min(imports), 1), median=round(statistics.median(imports), 1)
+        ),
+        help_ms=dict(
+            best=round(min(helps), 1), median=round(statistics.median(helps), 1)
+        ),
+        heavy_modules=sorted(loaded.intersection(HEAVY_MODULES)),
+        heaviest=[dict(module=n, self_ms=round(s / 1000, 1)) for n, s, _ in heaviest],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI startup benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--max-ms", type=float, help="fail if best import time exceeds it"
+    )
+    parser.add_argument("--output", help="path of JSON results")
+    args = parser.parse_args()
+
+    result = run(args.repeat, args.top)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    failures = []
+    if result["heavy_modules"]:
+        failures.append(f"heavy modules imported: {result['heavy_modules']}")
+    if args.max_ms is not None and result["import_ms"]["best"] > args.max_ms:
+        failures.append(
+            f"import took {result['import_ms']['best']} ms (limit {args.max_ms} ms)"
+        )
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+Times hot paths of export processing on synthetic exports of increasing
+size and writes results as JSON, so runs of different commits can be
+compared.
+
+Benchmarks:
+    reader_iter             iteration over SierraExportReader
+    reader_len_cold         SierraExportReader.__len__ without cached count
+    reader_len_cached       SierraExportReader.__len__ of an unchanged export
+    reader_chunk_ranges     record-aligned split of the export for workers
+    reader_parallel         SierraExportReader.iter_parallel
+    ingest_insert_or_ignore per-row ingest with insert_or_ignore
+    ingest_bulk             batched ingest with bulk_ingest
+    find_unprocessed_files  comparison of delivered and processed handles
+
+usage:
+    python -m benchmarks.bench_suite --rows 1000 10000 100000 --output base.json
+    python -m benchmarks.bench_suite --compare base.json head.json
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+from bookops_watchdog.datastore import Bib, DataAccessLayer, Order
+from bookops_watchdog.worker_datastore import (
+    BIB_DEFAULTS,
+    bulk_ingest,
+    insert_or_ignore,
+)
+from bookops_watchdog.worker_drive import find_unprocessed_files
+from bookops_watchdog.worker_reports import (
+    PARALLEL_CHUNK_SIZE,
+    SierraExportReader,
+    _length_cache,
+    chunk_ranges,
+    parse_date,
+    sierra_no_to_int,
+)
+from benchmarks.synthetic import make_export
+
+SIZES = [1000, 10000, 100000]
+
+# per-row ingest runs at about a thousand rows a second, larger exports
+# are skipped unless the limit is raised with --max-insert-rows
+MAX_INSERT_OR_IGNORE_ROWS = 10000
+
+# relative slowdown reported as a regression by --compare; timings below
+# MIN_SECONDS are too noisy to be flagged
+THRESHOLD = 0.1
+MIN_SECONDS = 0.001
+
+
+def timeit(fn: Callable, repeat: int, setup: Optional[Callable] = None) -> Dict:
+    """
+    Runs fn repeat times and returns best and median wall time in seconds
+
+    Args:
+        fn:                     timed callable
+        repeat:                 number of runs
+        setup:                  untimed callable run before each run
+
+    Returns:
+        dictionary of best_sec and median_sec
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return dict(best_sec=min(times), median_sec=statistics.median(times))
+
+
+def _result(name: str, rows: int, size: int, timing: Dict) -> Dict:
+    best = timing["best_sec"]
+    return dict(
+        name=name,
+        rows=rows,
+        bytes=size,
+        best_sec=round(best, 6),
+        median_sec=round(timing["median_sec"], 6),
+        rows_per_sec=round(rows / best) if best else None,
+        bytes_per_sec=round(size / best) if best and size else None,
+    )
+
+
+def _clear_caches() -> None:
+    _length_cache.clear()
+    parse_date.cache_clear()
+
+
+def _ingest_insert_or_ignore(session, fh: str) -> None:
+    for record in SierraExportReader(fh):
+        bib_wid = sierra_no_to_int(record["bibNo"])
+        if bib_wid is None:
+            continue
+        insert_or_ignore(
+            session,
+            Bib,
+            **dict(
+                BIB_DEFAULTS,
+                wid=bib_wid,
+                library_wid=1,
+                author=record["author"],
+                catDate=record["catDate"],
+                subjects="~".join(record["subjects"]),
+                title=record["title"],
+            ),
+        )
+        order_wid = sierra_no_to_int(record["orderNo"])
+        if order_wid is None:
+            continue
+        insert_or_ignore(
+            session,
+            Order,
+            wid=order_wid,
+            bib_wid=bib_wid,
+            copies=record["copies"] or 0,
+            orderDate=record["orderDate"],
+        )
+
+
+def bench_ingest(
+    tmp: str, fh: str, rows: int, size: int, repeat: int, max_insert_rows: int
+) -> List:
+    results = []
+    ingests = [("ingest_bulk", lambda s: bulk_ingest(s, SierraExportReader(fh), 1))]
+    if rows <= max_insert_rows:
+        ingests.insert(
+            0, ("ingest_insert_or_ignore", lambda s: _ingest_insert_or_ignore(s, fh))
+        )
+    for name, ingest in ingests:
+        times = []
+        for n in range(repeat):
+            # each run ingests into an empty datastore
+            dal = DataAccessLayer(f"sqlite:///{os.path.join(tmp, f'{name}{n}.db')}")
+            dal.connect()
+            session = dal.Session()
+            _clear_caches()
+            start = time.perf_counter()
+            ingest(session)
+            session.commit()
+            times.append(time.perf_counter() - start)
+            session.close()
+            dal.dispose()
+        timing = dict(best_sec=min(times), median_sec=statistics.median(times))
+        results.append(_result(name, rows, size, timing))
+    return results
+
+
+def bench_find_unprocessed_files(rows: int, repeat: int) -> Dict:
+    # one export a day per library, every tenth handle is not an export
+    start = datetime(2000, 1, 1).toordinal()
+    delivered = []
+    for n in range(rows):
+        day = datetime.fromordinal(start + n // 2).strftime("%Y%m%d")
+        if n % 10 == 0:
+            delivered.append(f"BookOpsQC.{day}.log")
+        else:
+            delivered.append(f"BookOpsQC{'bn'[n % 2]}.{day}603001")
+    processed = delivered[: rows // 2]
+    timing = timeit(lambda: find_unprocessed_files(delivered, processed), repeat)
+    return _result("find_unprocessed_files", rows, 0, timing)
+
+
+def run_suite(
+    sizes: List[int],
+    repeat: int = 3,
+    seed: int = 0,
+    malformed: float = 0.02,
+    max_insert_rows: int = MAX_INSERT_OR_IGNORE_ROWS,
+) -> List[Dict]:
+    """
+    Generates export of each size and runs all benchmarks on it
+
+    Args:
+        sizes:                  numbers of export rows
+        repeat:                 number of runs of each benchmark
+        seed:                   seed of the export generator
+        malformed:              share of rows with a malformed value
+        max_insert_rows:        largest export ingested with insert_or_ignore
+
+    Returns:
+        list of results
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            fh = os.path.join(tmp, f"BookOpsQCb.{rows}")
+            size = make_export(fh, rows, seed, malformed)
+            first = len(results)
+
+            timing = timeit(
+                lambda: sum(1 for _ in SierraExportReader(fh)), repeat, _clear_caches
+            )
+            results.append(_result("reader_iter", rows, size, timing))
+
+            timing = timeit(lambda: len(SierraExportReader(fh)), repeat, _clear_caches)
+            results.append(_result("reader_len_cold", rows, size, timing))
+
+            len(SierraExportReader(fh))
+            timing = timeit(lambda: len(SierraExportReader(fh)), repeat)
+            results.append(_result("reader_len_cached", rows, size, timing))
+
+            timing = timeit(lambda: chunk_ranges(fh, PARALLEL_CHUNK_SIZE), repeat)
+            results.append(_result("reader_chunk_ranges", rows, size, timing))
+
+            timing = timeit(
+                lambda: sum(1 for _ in SierraExportReader(fh).iter_parallel()),
+                repeat,
+                _clear_caches,
+            )
+            results.append(_result("reader_parallel", rows, size, timing))
+
+            results.extend(bench_ingest(tmp, fh, rows, size, repeat, max_insert_rows))
+            results.append(bench_find_unprocessed_files(rows, repeat))
+            for result in results[first:]:
+                print(result)
+            os.remove(fh)
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def compare(base_fh: str, head_fh: str, threshold: float = THRESHOLD) -> int:
+    """
+    Prints relative change of best times between two result files
+
+    Args:
+        base_fh:                results of the baseline run
+        head_fh:                results of the compared run
+        threshold:              relative slowdown reported as a regression
+
+    Returns:
+        number of regressions
+    """
+    with open(base_fh) as f:
+        base = json.load(f)
+    with open(head_fh) as f:
+        head = json.load(f)
+    baseline = {(r["name"], r["rows"]): r for r in base["results"]}
+
+    print(f"{base['meta']['commit']} -> {head['meta']['commit']}")
+    regressions = 0
+    for result in head["results"]:
+        before = baseline.get((result["name"], result["rows"]))
+        if before is None or not before["best_sec"]:
+            continue
+        change = result["best_sec"] / before["best_sec"] - 1
+        flag = ""
+        if change > threshold and result["best_sec"] >= MIN_SECONDS:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(
+            f"{result['name']:<26}{result['rows']:>9} "
+            f"{before['best_sec']:>10.4f}s {result['best_sec']:>10.4f}s "
+            f"{change:>+8.1%}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="export processing benchmarks")
+    parser.add_argument("--rows", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--malformed", type=float, default=0.02)
+    parser.add_argument(
+        "--max-insert-rows", type=int, default=MAX_INSERT_OR_IGNORE_ROWS
+    )
+    parser.add_argument("--output", help="path of JSON results")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("BASE", "HEAD"),
+        help="compare two JSON results instead of running benchmarks",
+    )
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    meta = dict(
+        commit=_git_commit(),
+        timestamp=datetime.now().isoformat(timespec="seconds"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        repeat=args.repeat,
+        seed=args.seed,
+        malformed=args.malformed,
+        max_insert_rows=args.max_insert_rows,
+    )
+    results = run_suite(
+        args.rows, args.repeat, args.seed, args.malformed, args.max_insert_rows
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
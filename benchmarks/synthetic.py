@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic generator of synthetic Sierra exports. Rows follow the layout
+of the '^'-delimited exports delivered to the shared drive: bibs with one or
+more orders, '~'-separated subject headings (including FAST headings dropped
+by the reader), MM-DD-YYYY dates, and record numbers either bare
+(b122039130) or quoted with a leading period ('".b12203913x"'). A share of
+rows carries malformed values the reader and ingest have to skip or repair.
+
+usage:
+    python -m benchmarks.synthetic BookOpsQCb.20210801603001 --rows 100000
+"""
+
+import argparse
+from datetime import date, timedelta
+import random
+from typing import Iterator, List
+
+HEADER = [
+    "RECORD #(BIBLIO)",
+    "CAT DATE",
+    "REC TYPE(BIBLIO)",
+    "TITLE",
+    "AUTHOR",
+    "CALL #",
+    "SUBJECT",
+    "RECORD #(ORDER)",
+    "CREATED(ORDER)",
+    "LOCATION",
+    "COPIES",
+    "VEN NOTE",
+    "STATUS",
+]
+
+TOPICS = [
+    "Latvia",
+    "Uganda",
+    "Africa",
+    "United States",
+    "New York (N.Y.)",
+    "Brooklyn (New York, N.Y.)",
+    "Superheroes",
+    "Kings and rulers",
+    "Climate change",
+    "Immigrants",
+    "Cooking, Italian",
+    "Baseball",
+]
+SUBDIVISIONS = [
+    "Juvenile literature.",
+    "Description and travel -- Juvenile literature.",
+    "Social life and customs -- Juvenile literature.",
+    "History.",
+    "Comic books, strips, etc.",
+    "Fiction.",
+    "Biography.",
+]
+FORMS = [
+    "Informational works. lcgft",
+    "Illustrated works. lcgft",
+    "Graphic novels. lcgft",
+    "Juvenile works. fast (OCoLC)fst01411637",
+    "Fiction. fast (OCoLC)fst01423787",
+]
+WORDS = [
+    "river",
+    "empire",
+    "garden",
+    "night",
+    "city",
+    "journey",
+    "secret",
+    "history",
+    "Wakanda",
+    "Brooklyn",
+    "winter",
+    "kitchen",
+]
+SURNAMES = ["Barlas", "Coates", "Wong", "Duling", "Griffin", "Acuna", "Bartel"]
+FORENAMES = ["Robert", "Ta-Nehisi", "Winnie", "Kaitlyn", "Brett", "Daniel", "Jen"]
+LOCATIONS = ["02jnf", "24jnf", "25jnf", "45jnf", "80jnf", "89   ", "13anf"]
+VENDORS = ["", "", "OBCC", "BKDC", "AMALI"]
+
+# kinds of malformed values and the column they are written to
+MALFORMED = [
+    ("bib_number", 0),
+    ("cat_date", 1),
+    ("order_number", 7),
+    ("order_date", 8),
+    ("copies", 10),
+]
+
+FIRST_BIB = 12000000
+FIRST_ORDER = 20000000
+START_DATE = date(2019, 1, 1)
+
+
+def check_digit(number: int) -> str:
+    """
+    Returns Sierra check digit of a record number
+
+    Args:
+        number:                 record number without prefix, example: 12203913
+
+    Returns:
+        check digit, 'x' for remainder of 10
+    """
+    total = sum(int(d) * w for w, d in enumerate(reversed(str(number)), start=2))
+    remainder = total % 11
+    return "x" if remainder == 10 else str(remainder)
+
+
+def sierra_number(prefix: str, number: int, quoted: bool) -> str:
+    value = f"{prefix}{number}{check_digit(number)}"
+    if quoted:
+        return f'".{value}"'
+    return value
+
+
+def _date(rng: random.Random) -> str:
+    return (START_DATE + timedelta(days=rng.randrange(3 * 365))).strftime("%m-%d-%Y")
+
+
+def _subjects(rng: random.Random) -> str:
+    topics = rng.sample(TOPICS, rng.randint(1, 3))
+    headings = [f"{t} -- {rng.choice(SUBDIVISIONS)}" for t in topics]
+    headings.extend(f"{t}. fast (OCoLC)fst0{rng.randrange(10**7):07d}" for t in topics)
+    headings.extend(rng.sample(FORMS, rng.randint(0, 2)))
+    return "~".join(headings)
+
+
+def _malform(rng: random.Random, row: List[str]) -> None:
+    kind, column = rng.choice(MALFORMED)
+    if kind in ("bib_number", "order_number"):
+        row[column] = rng.choice(["", "b", '"."', "n/a"])
+    elif kind in ("cat_date", "order_date"):
+        row[column] = rng.choice(["13-45-2021", "2021-07-06", "07/06/2021", "-"])
+    else:
+        row[column] = rng.choice(["", "ten", "-1.5"])
+
+
+def iter_rows(rows: int, seed: int = 0, malformed: float = 0.02) -> Iterator[List[str]]:
+    """
+    Yields rows of a synthetic export; the same arguments always produce
+    the same rows
+
+    Args:
+        rows:                   number of rows
+        seed:                   seed of the random generator
+        malformed:              share of rows with a malformed value
+
+    Yields:
+        row as a list of 13 fields
+    """
+    rng = random.Random(seed)
+    bib = FIRST_BIB
+    bib_fields: List[str] = []
+    orders_left = 0
+    for n in range(rows):
+        if orders_left == 0:
+            bib += rng.randint(1, 3)
+            orders_left = rng.choice([1, 1, 1, 2, 2, 3, 5])
+            title = " ".join(rng.sample(WORDS, rng.randint(2, 5))).capitalize()
+            surname, forename = rng.choice(SURNAMES), rng.choice(FORENAMES)
+            bib_fields = [
+                sierra_number("b", bib, quoted=rng.random() < 0.5),
+                "" if rng.random() < 0.1 else _date(rng),
+                "b",
+                f"{title} / {forename} {surname}.",
+                f"{surname}, {forename}, author.",
+                f"J {rng.randint(100, 999)}.{rng.randint(1, 99)} {surname[0]}",
+                _subjects(rng),
+            ]
+        orders_left -= 1
+
+        row = bib_fields + [
+            sierra_number("o", FIRST_ORDER + n, quoted=rng.random() < 0.5),
+            _date(rng),
+            ",".join(rng.sample(LOCATIONS, rng.randint(1, 4))),
+            str(rng.randint(0, 12)),
+            rng.choice(VENDORS),
+            rng.choice(["o", "a", "1"]),
+        ]
+        if rng.random() < malformed:
+            _malform(rng, row)
+        yield row
+
+
+def make_export(fh: str, rows: int, seed: int = 0, malformed: float = 0.02) -> int:
+    """
+    Writes synthetic export to a file
+
+    Args:
+        fh:                     path of the export
+        rows:                   number of rows
+        seed:                   seed of the random generator
+        malformed:              share of rows with a malformed value
+
+    Returns:
+        size of the export in bytes
+    """
+    with open(fh, "w", encoding="utf-8", newline="\n") as f:
+        f.write("^".join(HEADER) + "\n")
+        for row in iter_rows(rows, seed, malformed):
+            f.write("^".join(row) + "\n")
+        return f.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="synthetic Sierra export")
+    parser.add_argument("fh", help="path of the export")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--malformed", type=float, default=0.02)
+    args = parser.parse_args()
+    size = make_export(args.fh, args.rows, args.seed, args.malformed)
+    print(dict(fh=args.fh, rows=args.rows, bytes=size))
+
+
+if __name__ == "__main__":
+    main()
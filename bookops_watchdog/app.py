@@ -5,20 +5,546 @@ Main module of the BookOps-Watchdog app.
 """
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import logging.config
 import os
+import signal
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import loggly.handlers
 
-from bookops_watchdog.config import configure_app, watchdog_logging_config
-from bookops_watchdog.worker_ftp import (
-    ftp_connect,
+from bookops_watchdog.config import Config, configure_app
+from bookops_watchdog.log_handlers import enqueue_handlers
+from bookops_watchdog.metrics import metrics
+from bookops_watchdog.profiling import PROFILE_MODES, profile
+from bookops_watchdog.worker_drive import (
+    DriveIndex,
+    StagingCache,
+    get_library_dir,
+    get_sierra_files,
+    get_watch_backend,
 )
+from bookops_watchdog.worker_reports import SierraExportReader
 
+# modules depending on SQLAlchemy and requests (datastore, worker_datastore,
+# worker_rules, worker_email) are imported where they are used, so parsing
+# arguments and configuring logging does not wait for them
+if TYPE_CHECKING:
+    from bookops_watchdog.datastore import DataAccessLayer, DatastoreWriter
 
-def run():
-    logger.info(f"Current working directory: '{os.getcwd()}'.")
+
+logger = logging.getLogger("bookops-watchdog")
+
+LIBRARIES = ("bpl", "nypl")
+POLL_INTERVAL = 30.0
+DEBOUNCE = 10.0
+# seconds before a failed export is retried, doubled after each failure
+RETRY_DELAY = 60.0
+RETRY_MAX_DELAY = 3600.0
+
+
+def _stats() -> Dict:
+    # per-library pipeline counts, timing in seconds, and failed handles
+    return dict(
+        exports=0, rows=0, stage=0.0, parse=0.0, write=0.0, seconds=0.0, failed=[]
+    )
+
+
+def _timed(iterable: Iterable, stats: Dict, key: str) -> Iterator:
+    # accumulates time spent producing items of iterable under stats[key]
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stats[key] += time.perf_counter() - start
+        yield item
+
+
+def _open_export(
+    session, library: str, handle: str, size: int, mtime_ns: int
+) -> Tuple[int, int, int, bool]:
+    from bookops_watchdog.worker_datastore import get_file, get_library_wid
+
+    library_wid = get_library_wid(session, library)
+    file = get_file(session, library_wid, handle, size, mtime_ns)
+    return file.wid, file.checkpoint_offset, file.checkpoint_row, file.completed
+
+
+def _write_chunk(session, file_wid: int, records: List[Dict], start: int, end: int):
+    from bookops_watchdog.datastore import File
+    from bookops_watchdog.worker_datastore import ingest_chunk
+
+    return ingest_chunk(session, session.get(File, file_wid), records, start, end)
+
+
+def _complete_export(session, file_wid: int) -> Dict[str, int]:
+    from bookops_watchdog.datastore import File
+    from bookops_watchdog.worker_rules import evaluate_file_changes
+
+    tickets = evaluate_file_changes(session, [file_wid])
+    session.get(File, file_wid).completed = True
+    return tickets
+
+
+def process_export(
+    library: str,
+    handle: str,
+    drive: str,
+    staging: Optional[StagingCache] = None,
+    writer: Optional["DatastoreWriter"] = None,
+    stats: Optional[Dict] = None,
+) -> None:
+    """
+    Ingests Sierra export into the datastore, records it as processed and
+    evaluates conflict rules for bibs included in the export. The export is
+    parsed on the calling thread while its chunks are written by the
+    datastore writer, so parsing of a chunk overlaps writing of the previous
+    one.
+
+    Args:
+        library:                'bpl' or 'nypl'
+        handle:                 export file handle
+        drive:                  shared drive root directory
+        staging:                cache of local copies of exports
+        writer:                 datastore writer shared by library pipelines,
+                                a private one is used if not given
+        stats:                  pipeline timing updated in place
+    """
+    from bookops_watchdog.datastore import DatastoreWriter
+    from bookops_watchdog.worker_datastore import CHECKPOINT_ROWS, INGEST_COUNTS
+
+    if writer is None:
+        with DatastoreWriter() as writer:
+            return process_export(library, handle, drive, staging, writer, stats)
+    if stats is None:
+        stats = _stats()
+
+    fh = os.path.join(get_library_dir(library, drive), handle)
+    source = os.stat(fh)
+    file_wid, offset, row, completed = writer.submit(
+        _open_export,
+        library,
+        handle,
+        source.st_size,
+        source.st_mtime_ns,
+        label=library,
+    ).result()
+    if completed:
+        logger.debug("Export %s already processed, skipping.", handle)
+        return
+    if row:
+        logger.info("Resuming ingest of %s at row %s (byte %s).", handle, row, offset)
+
+    if staging is not None:
+        start = time.perf_counter()
+        fh = staging.stage(fh)
+        stats["stage"] += time.perf_counter() - start
+
+    try:
+        counts = dict.fromkeys(INGEST_COUNTS, 0)
+        chunks = SierraExportReader(fh).iter_chunks(CHECKPOINT_ROWS, offset)
+        pending = None
+        for records, end in _timed(chunks, stats, "parse"):
+            # at most one chunk waits for the writer, each starts at the
+            # previous one's end, so a failed write stops the following ones
+            future = writer.submit(
+                _write_chunk, file_wid, records, offset, end, label=library
+            )
+            if pending is not None:
+                for key, value in pending.result().items():
+                    counts[key] += value
+            pending = future
+            offset = end
+            stats["rows"] += len(records)
+        if pending is not None:
+            for key, value in pending.result().items():
+                counts[key] += value
+    finally:
+        if staging is not None:
+            staging.release(fh)
+
+    tickets = writer.submit(_complete_export, file_wid, label=library).result()
+    stats["exports"] += 1
+    logger.info("Processed %s export %s: %s", library.upper(), handle, counts)
+    logger.info("Wrote tickets for %s export %s: %s", library.upper(), handle, tickets)
+
+
+def process_library(
+    library: str,
+    handles: List[str],
+    writer: "DatastoreWriter",
+    drive: str,
+    staging: Optional[StagingCache] = None,
+) -> Dict:
+    """
+    Library pipeline: stages, parses, ingests and evaluates rules for
+    library's exports one after another. Pipelines of different libraries
+    run concurrently and share the datastore writer.
+
+    Args:
+        library:                'bpl' or 'nypl'
+        handles:                export file handles
+        writer:                 datastore writer
+        drive:                  shared drive root directory
+        staging:                cache of local copies of exports
+
+    Returns:
+        pipeline timing: number of exports and rows, and seconds spent in
+        total, staging, parsing, and writing; handles of failed exports
+    """
+    stats = _stats()
+    start = time.perf_counter()
+    written = writer.seconds.get(library, 0.0)
+    for handle in handles:
+        try:
+            process_export(library, handle, drive, staging, writer, stats)
+        except Exception:
+            logger.exception("Unable to process export %s.", handle)
+            stats["failed"].append(handle)
+    stats["write"] = writer.seconds.get(library, 0.0) - written
+    stats["seconds"] = time.perf_counter() - start
+    logger.info(
+        "%s pipeline processed %s export(s), %s row(s) in %.2fs "
+        "(staging %.2fs, parsing %.2fs, writing %.2fs).",
+        library.upper(),
+        stats["exports"],
+        stats["rows"],
+        stats["seconds"],
+        stats["stage"],
+        stats["parse"],
+        stats["write"],
+    )
+    return stats
+
+
+def audit(store: Optional["DataAccessLayer"] = None) -> None:
+    """
+    Re-evaluates conflict rules for all bibs in the datastore
+
+    Args:
+        store:                  datastore, module's dal is used if not given
+    """
+    from bookops_watchdog.datastore import session_scope
+    from bookops_watchdog.worker_rules import evaluate_rules
+
+    with session_scope(store) as session:
+        tickets = evaluate_rules(session)
+    logger.info("Completed full audit, wrote tickets: %s", tickets)
+
+
+def notify(config: Config, store: Optional["DataAccessLayer"] = None) -> None:
+    """
+    Emails digests of unreported tickets if SendGrid is configured
+
+    Args:
+        config:                 app config
+        store:                  datastore, module's dal is used if not given
+    """
+    if not config.sendgrid_key:
+        logger.debug("SendGrid key not configured, skipping notifications.")
+        return
+    from bookops_watchdog.datastore import session_scope
+    from bookops_watchdog.worker_email import SendGridTransport, send_digests
+
+    transport = SendGridTransport(config.sendgrid_key, config.email_sender)
+    try:
+        with session_scope(store) as session:
+            send_digests(session, transport, config.email_recipients)
+    finally:
+        transport.close()
+
+
+class Watcher:
+    """
+    Tracks Sierra exports waiting for processing. An export is processed
+    only after it has not changed for `debounce` seconds, so files still
+    being written are not picked up. Failed exports stay queued and are
+    retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        libraries: Tuple[str, ...] = LIBRARIES,
+        debounce: float = DEBOUNCE,
+        index: Optional[DriveIndex] = None,
+        staging: Optional[StagingCache] = None,
+        store: Optional["DataAccessLayer"] = None,
+    ):
+        """
+        Args:
+            config:             app config
+            libraries:          libraries whose exports are processed
+            debounce:           seconds an export must stay unchanged
+            index:              drive index, defaults to the configured one
+            staging:            staging cache, defaults to the configured one
+            store:              datastore, defaults to the configured one
+        """
+        from bookops_watchdog.datastore import DataAccessLayer
+
+        self.libraries = libraries
+        self.debounce = debounce
+        self.config = config
+        self.drive = config.drive
+        self.index = index or DriveIndex(config.drive_index_fh, config.drive)
+        self.staging = staging or StagingCache(
+            config.staging_dir, config.staging_cache_size
+        )
+        self.store = store or DataAccessLayer(
+            f"sqlite:///{config.datastore_fh}", config.datastore_profile
+        )
+        # (library, handle): monotonic time of the last observed change;
+        # retries are queued as if changed just before they are due
+        self.pending: Dict[Tuple[str, str], float] = dict()
+        # (library, handle): number of consecutive failures
+        self.failures: Dict[Tuple[str, str], int] = dict()
+
+    def reconcile(self) -> None:
+        """
+        Queues all unprocessed exports found on the drive. Exports are
+        considered unchanged since their modification time. Libraries'
+        directories are scanned concurrently.
+        """
+        from bookops_watchdog.datastore import DatastoreWriter
+
+        now = time.monotonic()
+        with DatastoreWriter(self.store) as writer, ThreadPoolExecutor(
+            max_workers=len(self.libraries), thread_name_prefix="watchdog-library"
+        ) as executor:
+            scans = [
+                (library, executor.submit(self._scan_unprocessed, library, writer))
+                for library in self.libraries
+            ]
+            for library, future in scans:
+                for handle, age in future.result():
+                    self.pending[(library, handle)] = now - age
+        logger.info("Found %s unprocessed export(s).", len(self.pending))
+
+    def _scan_unprocessed(
+        self, library: str, writer: "DatastoreWriter"
+    ) -> List[Tuple[str, float]]:
+        # unprocessed exports of the library and their age in seconds
+        self.index.scan(library)
+        delivered = get_sierra_files(library, self.drive)
+        unprocessed = writer.submit(
+            self._find_unprocessed, library, delivered, label=library
+        ).result()
+        directory = get_library_dir(library, self.drive)
+        found = []
+        for handle in unprocessed:
+            mtime = os.path.getmtime(os.path.join(directory, handle))
+            found.append((handle, max(time.time() - mtime, 0.0)))
+        return found
+
+    @staticmethod
+    def _find_unprocessed(session, library: str, delivered: List[str]) -> List[str]:
+        from bookops_watchdog.worker_datastore import (
+            find_unprocessed_handles,
+            get_library_wid,
+        )
+
+        library_wid = get_library_wid(session, library)
+        return find_unprocessed_handles(session, library_wid, delivered)
+
+    def poll(self) -> None:
+        """
+        Queues exports that are new or changed since the last scan
+        """
+        for library in self.libraries:
+            for handle in self.index.scan(library):
+                logger.debug("Detected change of %s.", handle)
+                self.pending[(library, handle)] = time.monotonic()
+
+    def ready(self) -> List[Tuple[str, str]]:
+        """
+        Returns queued exports that have been stable for debounce period
+        """
+        now = time.monotonic()
+        return sorted(k for k, t in self.pending.items() if now - t >= self.debounce)
+
+    def settle(self) -> None:
+        """
+        Blocks until all queued exports have been stable for debounce period.
+        Exports changed while waiting are waited for again.
+        """
+        while True:
+            now = time.monotonic()
+            waiting = sorted(
+                handle
+                for (_, handle), t in self.pending.items()
+                if now - t < self.debounce
+            )
+            if not waiting:
+                return
+            delay = self.debounce - (now - max(self.pending.values()))
+            logger.info(
+                "Waiting %.1fs for export(s) to stop changing: %s.",
+                delay,
+                ", ".join(waiting),
+            )
+            time.sleep(delay)
+            self.poll()
+
+    def process_ready(self) -> Dict[str, Dict]:
+        """
+        Processes stable exports, each library in its own pipeline
+
+        Returns:
+            pipeline timing by library
+        """
+        from bookops_watchdog.datastore import DatastoreWriter
+
+        ready = self.ready()
+        handles: Dict[str, List[str]] = dict()
+        for library, handle in ready:
+            del self.pending[(library, handle)]
+            handles.setdefault(library, []).append(handle)
+
+        timing = dict()
+        if handles:
+            with DatastoreWriter(self.store) as writer, ThreadPoolExecutor(
+                max_workers=len(handles), thread_name_prefix="watchdog-library"
+            ) as executor:
+                pipelines = {
+                    library: executor.submit(
+                        process_library,
+                        library,
+                        library_handles,
+                        writer,
+                        self.drive,
+                        self.staging,
+                    )
+                    for library, library_handles in handles.items()
+                }
+                timing = {lib: future.result() for lib, future in pipelines.items()}
+        for library, stats in timing.items():
+            for handle in handles[library]:
+                if handle in stats["failed"]:
+                    self._retry(library, handle)
+                else:
+                    self.failures.pop((library, handle), None)
+        self.index.save()
+        if ready:
+            try:
+                notify(self.config, self.store)
+            except Exception:
+                logger.exception("Unable to send notifications.")
+            report_metrics(self.config)
+        return timing
+
+    def _retry(self, library: str, handle: str) -> None:
+        # queues failed export again, unless it was removed from the drive
+        key = (library, handle)
+        if not os.path.isfile(
+            os.path.join(get_library_dir(library, self.drive), handle)
+        ):
+            self.failures.pop(key, None)
+            return
+        failures = self.failures.get(key, 0) + 1
+        self.failures[key] = failures
+        delay = min(RETRY_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)
+        self.pending.setdefault(key, time.monotonic() + delay - self.debounce)
+        logger.info(
+            "Retrying export %s in %.0fs (failed %s time(s)).", handle, delay, failures
+        )
+
+    def next_timeout(self, interval: float) -> float:
+        """
+        Returns number of seconds until the next check is due
+        """
+        if not self.pending:
+            return interval
+        oldest = min(self.pending.values())
+        due = self.debounce - (time.monotonic() - oldest)
+        return min(interval, max(due, 0.0))
+
+
+def report_metrics(config: Config) -> None:
+    """
+    Logs and saves summary of metrics collected since the last report
+
+    Args:
+        config:                 app config
+    """
+    metrics.report(config.metrics_fh)
+
+
+def _install_signal_handlers(stop_event: threading.Event) -> None:
+    def handler(signum, frame):
+        logger.info("Received signal %s, shutting down...", signum)
+        stop_event.set()
+
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), handler)
+
+
+def watch(
+    watcher: Watcher,
+    stop_event: threading.Event,
+    interval: float = POLL_INTERVAL,
+) -> None:
+    """
+    Processes exports as they arrive until stop event is set
+
+    Args:
+        watcher:                Watcher instance
+        stop_event:             event signaling shutdown
+        interval:               max number of seconds between drive scans
+    """
+    directories = [
+        get_library_dir(library, watcher.drive) for library in watcher.libraries
+    ]
+    backend = get_watch_backend(directories, stop_event)
+    logger.info("Watching %s using %s backend.", directories, backend.name)
+    try:
+        while not stop_event.is_set():
+            watcher.process_ready()
+            backend.wait(watcher.next_timeout(interval))
+            if stop_event.is_set():
+                break
+            watcher.poll()
+    finally:
+        backend.close()
+        watcher.index.save()
+        report_metrics(watcher.config)
+    logger.info("Watcher stopped.")
+
+
+def run(
+    config: Config,
+    watch_mode: bool = False,
+    interval: float = POLL_INTERVAL,
+    debounce: float = DEBOUNCE,
+    full_audit: bool = False,
+) -> None:
+    logger.info("Current working directory: '%s'.", os.getcwd())
+    metrics.enabled = config.metrics
+    metrics.reset()
+
+    watcher = Watcher(config, debounce=debounce)
+    watcher.reconcile()
+    if not watch_mode:
+        # a single run processes every export found, however fresh
+        watcher.settle()
+    if full_audit:
+        watcher.process_ready()
+        with metrics.timer("rules.audit"):
+            audit(watcher.store)
+        notify(config, watcher.store)
+    if not watch_mode:
+        watcher.process_ready()
+        report_metrics(config)
+        return
+
+    stop_event = threading.Event()
+    _install_signal_handlers(stop_event)
+    watch(watcher, stop_event, interval)
 
 
 def createArgParser():
@@ -29,6 +555,34 @@ def createArgParser():
         type=str,
         help="environment to run app, options: dev | prod",
     )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and process exports as they arrive",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="max number of seconds between drive scans in watch mode",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=DEBOUNCE,
+        help="number of seconds an export must stay unchanged before processing",
+    )
+    parser.add_argument(
+        "--audit",
+        action="store_true",
+        help="re-evaluate conflict rules for all bibs in the datastore",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILE_MODES,
+        help="profile the run, cpu: cProfile stats, mem: tracemalloc snapshot; "
+        "saved next to the log file",
+    )
     return parser
 
 
@@ -40,10 +594,12 @@ if __name__ == "__main__":
     parser = createArgParser()
     args = parser.parse_args()
 
-    log_fh, log_token, handlers = configure_app(args.env)
-    log_conf = watchdog_logging_config(log_fh, log_token, handlers)
-    logging.config.dictConfig(log_conf)
-    logger = logging.getLogger("bookops-watchdog")
-    logger.info(f"Initiating Watchdog in {args.env.upper()} mode...")
+    config = configure_app(args.env)
+    listener = enqueue_handlers(logger)
+    logger.info("Initiating Watchdog in %s mode...", args.env.upper())
 
-    run()
+    try:
+        with profile(args.profile, config.data_dir):
+            run(config, args.watch, args.interval, args.debounce, args.audit)
+    finally:
+        listener.stop()
@@ -1,7 +1,56 @@
+import json
 import logging
+import logging.config
 import os
-import yaml
-from typing import Dict, List, Tuple
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+
+from bookops_watchdog.errors import WatchdogError
+
+mlogger = logging.getLogger("bookops-watchdog")
+
+
+# bump when layout of cached settings changes
+CONFIG_CACHE_VERSION = 1
+
+LOG_HANDLERS = ("console", "file", "loggly")
+
+# SQLite pragmas applied to each new datastore connection
+SQLITE_PROFILES = {
+    "default": dict(),
+    "performance": dict(
+        journal_mode="WAL",
+        synchronous="NORMAL",
+        cache_size=-64000,  # in KiB
+        mmap_size=256 * 1024 * 1024,
+        temp_store="MEMORY",
+    ),
+}
+
+
+class Config(NamedTuple):
+    """
+    Validated app configuration
+    """
+
+    env: str
+    data_dir: str
+    log_fh: str
+    log_token: str
+    log_handlers: Tuple[str, ...]
+    drive: str
+    datastore_fh: str
+    datastore_profile: str
+    drive_index_fh: str
+    staging_dir: str
+    staging_cache_size: Optional[int]
+    sendgrid_key: str
+    email_sender: str
+    # {library: {tier: (email, ...)}}
+    email_recipients: Mapping[str, Mapping[str, Tuple[str, ...]]]
+    metrics: bool
+    metrics_fh: str
 
 
 class LogglyAdapter(logging.LoggerAdapter):
@@ -24,13 +73,72 @@ class LogglyAdapter(logging.LoggerAdapter):
         return format_msg, kwargs
 
 
-def add_environ_variables(**kwargs) -> None:
-    """
-    Persist app configuration settings in the environmental variables
+def validate_config_settings(conf: Dict) -> Dict:
     """
+    Validates settings read from the YAML config file
+
+    Args:
+        conf:                   config file settings
+
+    Returns:
+        settings used by the app, optional ones set to their defaults
 
-    for k, v in kwargs.items():
-        os.environ[k] = v
+    Raises:
+        WatchdogError
+    """
+    if not isinstance(conf, dict):
+        raise WatchdogError("Invalid config file. Expected mapping of settings.")
+
+    def setting(name, types, required=False, default=None):
+        value = conf.get(name)
+        if value is None:
+            if required:
+                raise WatchdogError(f"Invalid config file. Missing '{name}' setting.")
+            return default
+        if not isinstance(value, types) or (
+            isinstance(value, bool) and types is not bool
+        ):
+            raise WatchdogError(f"Invalid config file. Malformed '{name}' setting.")
+        return value
+
+    handlers = setting("log_handlers", list, required=True)
+    if not all(h in LOG_HANDLERS for h in handlers):
+        raise WatchdogError("Invalid config file. Malformed 'log_handlers' setting.")
+    recipients = setting("email_recipients", dict, default={})
+    if not all(
+        isinstance(tiers, dict)
+        and all(
+            isinstance(emails, list) and all(isinstance(e, str) for e in emails)
+            for emails in tiers.values()
+            if emails is not None
+        )
+        for tiers in recipients.values()
+    ):
+        raise WatchdogError(
+            "Invalid config file. Malformed 'email_recipients' setting."
+        )
+    datastore_profile = setting("datastore_profile", str, default="performance")
+    if datastore_profile not in SQLITE_PROFILES:
+        raise WatchdogError(
+            "Invalid config file. Malformed 'datastore_profile' setting."
+        )
+    staging_cache_size = setting("staging_cache_size", int)
+    if staging_cache_size is not None and staging_cache_size < 0:
+        raise WatchdogError(
+            "Invalid config file. Malformed 'staging_cache_size' setting."
+        )
+
+    return dict(
+        loggly_token=setting("loggly_token", str, required=True),
+        log_handlers=handlers,
+        drive=setting("drive", str, required=True),
+        datastore_profile=datastore_profile,
+        staging_cache_size=staging_cache_size,
+        sendGrid_key=setting("sendGrid_key", str, default=""),
+        email_sender=setting("email_sender", str, default=""),
+        email_recipients=recipients,
+        metrics=setting("metrics", bool, default=False),
+    )
 
 
 def validate_directory(data_dir: str) -> None:
@@ -46,31 +154,128 @@ def validate_directory(data_dir: str) -> None:
         os.mkdir(data_dir)
 
 
-def configure_app(env: str = "dev") -> Tuple:
+def configure_app(env: str = "dev") -> Config:
     """
-    Configures sets up workspace for the app.
+    Loads app configuration and configures logging. The returned config is
+    the only source of settings for the rest of the app.
 
     Args:
         env:            dev or prod
 
     Returns:
-        log_fh, log_token, handlers
+        config
     """
 
-    conf = get_config_settings(env)
-    log_token = conf["loggly_token"]
-    handlers = conf["log_handlers"]
-    data_dir = get_app_data_dir(env)
-    log_fh = get_log_fh(data_dir)
-    datastore_fh = get_datastore_fh(data_dir)
+    config = load_config(env)
+    logging.config.dictConfig(
+        watchdog_logging_config(
+            config.log_fh, config.log_token, list(config.log_handlers)
+        )
+    )
+    return config
 
+
+def load_config(env: str = "dev") -> Config:
+    """
+    Loads validated app configuration. Settings are cached in the app data
+    directory and the YAML config file is parsed again only when its
+    modification time or size changes.
+
+    Args:
+        env:            dev or prod
+
+    Returns:
+        config
+    """
+    data_dir = get_app_data_dir(env)
     validate_directory(data_dir)
+    config_fh = construct_config_path(env)
+    cache_fh = get_config_cache_fh(data_dir)
 
-    add_environ_variables(
-        watchdog_store=datastore_fh,
-        watchdog_drive=conf["drive"],
+    try:
+        stat = os.stat(config_fh)
+        source = [config_fh, stat.st_mtime_ns, stat.st_size]
+    except OSError:
+        source = None
+
+    conf = _load_cached_settings(cache_fh, source)
+    if conf is None:
+        conf = validate_config_settings(get_config_settings(env))
+        if source is not None:
+            _save_cached_settings(cache_fh, source, conf)
+    return build_config(env, data_dir, conf)
+
+
+def build_config(env: str, data_dir: str, conf: Dict) -> Config:
+    """
+    Creates config from validated settings
+
+    Args:
+        env:            dev or prod
+        data_dir:       app data directory
+        conf:           settings returned by validate_config_settings
+
+    Returns:
+        config
+    """
+    return Config(
+        env=env,
+        data_dir=data_dir,
+        log_fh=get_log_fh(data_dir),
+        log_token=conf["loggly_token"],
+        log_handlers=tuple(conf["log_handlers"]),
+        drive=conf["drive"],
+        datastore_fh=get_datastore_fh(data_dir),
+        datastore_profile=conf["datastore_profile"],
+        drive_index_fh=get_drive_index_fh(data_dir),
+        staging_dir=get_staging_dir(data_dir),
+        staging_cache_size=conf["staging_cache_size"],
+        sendgrid_key=conf["sendGrid_key"],
+        email_sender=conf["email_sender"],
+        email_recipients=MappingProxyType(
+            {
+                library: MappingProxyType(
+                    {tier: tuple(emails or ()) for tier, emails in tiers.items()}
+                )
+                for library, tiers in conf["email_recipients"].items()
+            }
+        ),
+        metrics=conf["metrics"],
+        metrics_fh=get_metrics_fh(data_dir),
     )
-    return (log_fh, log_token, handlers)
+
+
+def _load_cached_settings(cache_fh: str, source: Optional[List]) -> Optional[Dict]:
+    # cached settings, None when missing or the config file changed since
+    if source is None or not os.path.isfile(cache_fh):
+        return None
+    try:
+        with open(cache_fh, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError) as exc:
+        mlogger.warning("Unable to read config cache. Error: %s", exc)
+        return None
+    if (
+        not isinstance(cached, dict)
+        or cached.get("version") != CONFIG_CACHE_VERSION
+        or cached.get("source") != source
+    ):
+        return None
+    return cached.get("settings")
+
+
+def _save_cached_settings(cache_fh: str, source: List, conf: Dict) -> None:
+    # written to a temporary file first, so a concurrent run never reads
+    # a partial cache
+    temp_fh = f"{cache_fh}.tmp"
+    try:
+        with open(temp_fh, "w") as f:
+            json.dump(
+                dict(version=CONFIG_CACHE_VERSION, source=source, settings=conf), f
+            )
+        os.replace(temp_fh, cache_fh)
+    except OSError as exc:
+        mlogger.warning("Unable to save config cache. Error: %s", exc)
 
 
 def construct_config_path(env: str) -> str:
@@ -120,12 +325,28 @@ def get_config_settings(env: str = "dev") -> Dict:
     """
     Retrieves configuration from YAML file
     """
+    # imported on use, the CLI does not load it before arguments are parsed
+    import yaml
+
     config_fh = construct_config_path(env)
     with open(config_fh, "r") as f:
         data = yaml.safe_load(f)
         return data
 
 
+def get_config_cache_fh(data_dir: str) -> str:
+    """
+    Constructs config cache file handle
+
+    Args:
+        data_dir:           app data directory
+
+    Returns:
+        config_cache_fh:    file of validated config settings
+    """
+    return os.path.join(data_dir, "config_cache.json")
+
+
 def get_datastore_fh(data_dir: str) -> str:
     """
     Constructs datastore file handle
@@ -139,6 +360,19 @@ def get_datastore_fh(data_dir: str) -> str:
     return os.path.join(data_dir, "datastore.db")
 
 
+def get_drive_index_fh(data_dir: str) -> str:
+    """
+    Constructs shared drive index file handle
+
+    Args:
+        data_dir:           app data directory
+
+    Returns:
+        drive_index_fh:     drive index file handle
+    """
+    return os.path.join(data_dir, "drive_index.json")
+
+
 def get_log_fh(data_dir: str) -> str:
     """
     Constructs log file handle
@@ -152,9 +386,37 @@ def get_log_fh(data_dir: str) -> str:
     return os.path.join(data_dir, "watchdog.log")
 
 
+def get_metrics_fh(data_dir: str) -> str:
+    """
+    Constructs metrics file handle
+
+    Args:
+        data_dir:           app data directory
+
+    Returns:
+        metrics_fh:         file of per-run metrics summaries
+    """
+    return os.path.join(data_dir, "metrics.jsonl")
+
+
+def get_staging_dir(data_dir: str) -> str:
+    """
+    Constructs staging cache directory path
+
+    Args:
+        data_dir:           app data directory
+
+    Returns:
+        staging_dir:        local directory of staged Sierra exports
+    """
+    return os.path.join(data_dir, "staging")
+
+
 def watchdog_logging_config(log_fh: str, log_token: str, handlers: List) -> Dict:
     """
-    Returns dictionary with logger configuration based on environment
+    Returns dictionary with logger configuration based on environment.
+    Handlers are moved behind a queue by log_handlers.enqueue_handlers
+    once the configuration is applied.
 
     Args:
         log_fh:                     log file handle to use
@@ -191,9 +453,9 @@ def watchdog_logging_config(log_fh: str, log_token: str, handlers: List) -> Dict
             },
             "loggly": {
                 "level": "ERROR",
-                "class": "loggly.handlers.HTTPSHandler",
+                "class": "bookops_watchdog.log_handlers.LogglyBatchHandler",
                 "formatter": "json",
-                "url": f"https://logs-01.loggly.com/inputs/{log_token}/tag/python",
+                "url": f"https://logs-01.loggly.com/bulk/{log_token}/tag/python",
             },
         },
         "loggers": {
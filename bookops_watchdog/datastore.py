@@ -3,9 +3,14 @@
 """
 Watchdog's database models
 """
+
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-import os
 from contextlib import contextmanager
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
 
 from sqlalchemy import (
     Boolean,
@@ -13,43 +18,219 @@ from sqlalchemy import (
     Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     String,
     create_engine,
+    event,
+    inspect,
+    literal,
 )
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import CreateColumn, UniqueConstraint
+
+
+from bookops_watchdog.config import SQLITE_PROFILES
+from bookops_watchdog.errors import WatchdogError
+from bookops_watchdog.metrics import metrics
 
+mlogger = logging.getLogger("bookops-watchdog")
 
 Base = declarative_base()
 
 
 class DataAccessLayer:
-    def __init__(self):
+    def __init__(self, conn: Optional[str] = None, profile: str = "performance"):
         """
-        Provides connection to the datastore.
+        Provides connection to the datastore. The engine and schema are
+        created once, on the first connect, and sessions share its
+        connection pool.
+
+        Args:
+            conn:               connection string, required before connecting
+            profile:            name of SQLite pragmas profile
         """
-        self.conn = f"sqlite:///{os.getenv('watchdog_store')}"
+        self._conn = conn
+        self._profile = profile
+        self._lock = threading.Lock()
         self.engine = None
+        self.engine_conn = None
+        self.pragmas: Dict[str, object] = dict()
+        self.Session: Optional[sessionmaker] = None
         self.session = None
 
-    def connect(self):
-        self.engine = create_engine(self.conn)
-        Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
+        # instrumentation
+        self.engines_created = 0
+        self.connections_created = 0
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @conn.setter
+    def conn(self, value):
+        if value != self._conn:
+            self.dispose()
+        self._conn = value
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @profile.setter
+    def profile(self, value):
+        if value != self._profile:
+            self.dispose()
+        self._profile = value
+
+    def connect(self) -> sessionmaker:
+        """
+        Creates the engine and sets up the schema unless already connected
+
+        Returns:
+            session factory bound to the engine
+        """
+        if self.conn is None:
+            raise WatchdogError("Datastore connection string is not configured.")
+        with self._lock:
+            if self.Session is not None and self.engine_conn == self.conn:
+                return self.Session
+            self._dispose()
+            conn = self.conn
+            engine = self._create_engine(conn)
+            self.engines_created += 1
+            # engine is kept only once the schema is set up, so a failed
+            # setup is retried by the next connect
+            try:
+                self._setup_schema(engine)
+            except Exception:
+                engine.dispose()
+                raise
+            self.engine_conn = conn
+            self.engine = engine
+            self.Session = sessionmaker(bind=engine)
+            return self.Session
+
+    def _setup_schema(self, engine):
+        Base.metadata.create_all(engine)
+        # create_all skips columns and indexes of already existing tables
+        self._add_missing_columns(engine)
+        self._merge_duplicate_tickets(engine)
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+
+    def _merge_duplicate_tickets(self, engine):
+        # datastores created before tickets were de-duplicated may hold
+        # several tickets of the same conflict, order and bib, which the
+        # unique index rejects; the oldest one is kept, reported if any of
+        # them was, open if any of them is, with copies of the newest one
+        with engine.begin() as conn:
+            indexes = {i["name"] for i in inspect(conn).get_indexes("ticket")}
+            if "ix_ticket_conflict_order_bib" in indexes:
+                return
+            same = (
+                "d.conflict_wid = ticket.conflict_wid "
+                "AND d.order_wid = ticket.order_wid AND d.bib_wid = ticket.bib_wid"
+            )
+            oldest = (
+                "SELECT MIN(wid) FROM ticket "
+                "GROUP BY conflict_wid, order_wid, bib_wid"
+            )
+            conn.exec_driver_sql(
+                f"UPDATE ticket SET "
+                f"reported = (SELECT MAX(d.reported) FROM ticket d WHERE {same}), "
+                f"closed = (SELECT MIN(d.closed) FROM ticket d WHERE {same}), "
+                f"copies = (SELECT d.copies FROM ticket d WHERE {same} "
+                f"ORDER BY d.wid DESC LIMIT 1) "
+                f"WHERE wid IN ({oldest} HAVING COUNT(*) > 1)"
+            )
+            merged = conn.exec_driver_sql(
+                f"DELETE FROM ticket WHERE wid NOT IN ({oldest})"
+            ).rowcount
+            if merged:
+                mlogger.info("Merged %s duplicate ticket(s).", merged)
+
+    def _add_missing_columns(self, engine):
+        # columns added to the models after a datastore was created; their
+        # scalar defaults fill existing rows
+        with engine.begin() as conn:
+            inspector = inspect(conn)
+            for table in Base.metadata.sorted_tables:
+                existing = {c["name"] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    ddl = str(CreateColumn(column).compile(dialect=conn.dialect))
+                    if column.default is not None and column.default.is_scalar:
+                        value = literal(column.default.arg, column.type).compile(
+                            dialect=conn.dialect,
+                            compile_kwargs=dict(literal_binds=True),
+                        )
+                        ddl = f"{ddl} DEFAULT {value}"
+                    table_name = conn.dialect.identifier_preparer.format_table(table)
+                    conn.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {ddl}")
+
+    def _create_engine(self, conn):
+        url = make_url(conn)
+        in_memory = url.database in (None, "", ":memory:")
+        if url.get_backend_name() == "sqlite" and not in_memory:
+            # file databases default to NullPool in SQLAlchemy 1.4,
+            # keep connections open between units of work instead
+            engine = create_engine(
+                conn,
+                poolclass=QueuePool,
+                connect_args=dict(check_same_thread=False),
+            )
+        else:
+            engine = create_engine(conn)
+        if url.get_backend_name() == "sqlite":
+            self.pragmas = SQLITE_PROFILES[self.profile]
+        else:
+            self.pragmas = dict()
+        event.listen(engine, "connect", self._on_connect)
+        return engine
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.connections_created += 1
+        if self.pragmas:
+            cursor = dbapi_connection.cursor()
+            for name, value in self.pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    def _dispose(self):
+        if self.engine is not None:
+            self.engine.dispose()
+        self.engine = None
+        self.engine_conn = None
+        self.Session = None
+
+    def dispose(self):
+        """
+        Closes pooled connections and discards the engine
+        """
+        with self._lock:
+            self._dispose()
 
 
 dal = DataAccessLayer()
 
 
 @contextmanager
-def session_scope(conn=None):
-    dal.connect()
-    session = dal.Session()
+def session_scope(store: Optional[DataAccessLayer] = None):
+    if store is None:
+        store = dal
+    # the factory is taken under the store's lock, a concurrent dispose
+    # clears store.Session
+    session = store.connect()()
     try:
         yield session
-        session.commit()
+        with metrics.timer("datastore.commit"):
+            session.commit()
     except:
         session.rollback()
         raise
@@ -57,17 +238,106 @@ def session_scope(conn=None):
         session.close()
 
 
+class DatastoreWriter:
+    """
+    Serializes datastore access of concurrent workers. Units of work run one
+    at a time, in order of submission, on a single thread, so workers never
+    compete for SQLite's write lock. Each unit runs in its own session that
+    is committed when it completes.
+    """
+
+    def __init__(self, store: Optional[DataAccessLayer] = None):
+        """
+        Args:
+            store:              datastore written to, defaults to module's dal
+        """
+        self.store = store
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="watchdog-writer"
+        )
+        # label: number of seconds spent in units of work submitted with it
+        self.seconds: Dict[str, float] = dict()
+
+    def submit(self, fn: Callable, *args, label: Optional[str] = None) -> Future:
+        """
+        Queues unit of work fn(session, *args)
+
+        Args:
+            fn:                 callable taking db session as first argument
+            args:               remaining arguments of fn
+            label:              name the unit's time is accounted under
+
+        Returns:
+            future of fn's result
+        """
+        return self._executor.submit(self._run, fn, args, label)
+
+    def _run(self, fn: Callable, args: tuple, label: Optional[str]):
+        start = time.perf_counter()
+        try:
+            with session_scope(self.store) as session:
+                return fn(session, *args)
+        finally:
+            if label is not None:
+                elapsed = time.perf_counter() - start
+                self.seconds[label] = self.seconds.get(label, 0.0) + elapsed
+
+    def close(self) -> None:
+        """
+        Waits for queued units of work and stops the writer thread
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class File(Base):
     __tablename__ = "file"
+    __table_args__ = (Index("ix_file_library_wid_handle", "library_wid", "handle"),)
     wid = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, nullable=False, default=datetime.now())
     handle = Column(String, nullable=False)
     library_wid = Column(Integer, ForeignKey("library.wid"), nullable=False)
+    # ingest checkpoint: byte offset and number of rows committed so far
+    checkpoint_offset = Column(Integer, nullable=False, default=0)
+    checkpoint_row = Column(Integer, nullable=False, default=0)
+    completed = Column(Boolean, nullable=False, default=False)
+    # size and modification time (ns) of the ingested export, a checkpoint
+    # applies only to the same content
+    source_size = Column(Integer)
+    source_mtime = Column(Integer)
 
     def __repr__(self):
         return (
             f"<File(wid='{self.wid}', timestamp='{self.timestamp}', "
-            f"handle='{self.handle}', library_wid='{self.library_wid}')>"
+            f"handle='{self.handle}', library_wid='{self.library_wid}', "
+            f"checkpoint_offset='{self.checkpoint_offset}', "
+            f"checkpoint_row='{self.checkpoint_row}', "
+            f"completed='{self.completed}', "
+            f"source_size='{self.source_size}', "
+            f"source_mtime='{self.source_mtime}')>"
+        )
+
+
+class FileChange(Base):
+    """
+    Bibs and orders included in a Sierra export (file)
+    """
+
+    __tablename__ = "file_change"
+    wid = Column(Integer, primary_key=True)
+    file_wid = Column(Integer, ForeignKey("file.wid"), nullable=False, index=True)
+    bib_wid = Column(Integer, nullable=False)
+    order_wid = Column(Integer)
+
+    def __repr__(self):
+        return (
+            f"<FileChange(wid='{self.wid}', file_wid='{self.file_wid}', "
+            f"bib_wid='{self.bib_wid}', order_wid='{self.order_wid}')>"
         )
 
 
@@ -143,7 +413,7 @@ class Bib(Base):
 class Order(Base):
     __tablename__ = "order"
     wid = Column(Integer, primary_key=True, autoincrement=False)
-    bib_wid = Column(Integer, ForeignKey("bib.wid"), nullable=False)
+    bib_wid = Column(Integer, ForeignKey("bib.wid"), nullable=False, index=True)
     copies = Column(Integer, nullable=False)
     orderDate = Column(Date)
     orderBranches = Column(String)
@@ -176,18 +446,32 @@ class Conflict(Base):
 
 class Ticket(Base):
     __tablename__ = "ticket"
+    __table_args__ = (
+        # a standalone index on low-cardinality 'reported' misleads the planner
+        Index("ix_ticket_reported_bib_wid", "reported", "bib_wid"),
+        # one ticket per conflict of an order/bib pair
+        Index(
+            "ix_ticket_conflict_order_bib",
+            "conflict_wid",
+            "order_wid",
+            "bib_wid",
+            unique=True,
+        ),
+    )
     wid = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, nullable=False, default=datetime.now())
     conflict_wid = Column(Integer, ForeignKey("conflict.wid"), nullable=False)
-    order_wid = Column(Integer, nullable=False)
-    bib_wid = Column(Integer, nullable=False)
+    order_wid = Column(Integer, nullable=False, index=True)
+    bib_wid = Column(Integer, nullable=False, index=True)
     copies = Column(Integer, nullable=False, default=0)
     reported = Column(Boolean, nullable=False, default=False)
+    closed = Column(Boolean, nullable=False, default=False)
 
     def __repr__(self):
         return (
             f"<Ticket(wid='{self.wid}', timestamp='{self.timestamp}', "
             f"conflict_wid='{self.conflict_wid}', "
             f"order_wid='{self.order_wid}', bib_wid='{self.bib_wid}', "
-            f"copies='{self.copies}', reported='{self.reported}')>"
+            f"copies='{self.copies}', reported='{self.reported}', "
+            f"closed='{self.closed}')>"
         )
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+Logging handlers that keep slow log sinks (Loggly) off the processing thread
+"""
+
+import copy
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bookops_watchdog.metrics import metrics
+
+# max number of records waiting for delivery; records over it are dropped
+QUEUE_SIZE = 10000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts log records on a bounded queue without blocking. Records that do
+    not fit in the queue are dropped and counted.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # merges message arguments, formatting of tracebacks is left to
+        # handlers on the listener's thread
+        record = copy.copy(record)
+        record.template = record.msg
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.count("log.dropped")
+
+
+class LogglyBatchHandler(logging.Handler):
+    """
+    Sends formatted records to Loggly bulk endpoint in batches. A batch is
+    posted when it reaches capacity, when flush_interval has elapsed since
+    its first event was buffered (a timer posts it even if no other record
+    arrives), or when the handler is flushed or closed.
+
+    Floods of the same message are aggregated: within each flood_interval
+    only the first flood_limit records logged from the same call are sent,
+    the rest is summarized in a single event.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        capacity: int = 100,
+        flush_interval: float = 5.0,
+        flood_limit: int = 10,
+        flood_interval: float = 60.0,
+        timeout: float = 10.0,
+    ):
+        """
+        Args:
+            url:                Loggly bulk endpoint
+            capacity:           max number of events in a single post
+            flush_interval:     max number of seconds an event waits for post
+            flood_limit:        max number of the same message sent within
+                                flood_interval
+            flood_interval:     length in seconds of the flood window
+            timeout:            request timeout in seconds
+        """
+        super().__init__()
+        self.url = url
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.flood_limit = flood_limit
+        self.flood_interval = flood_interval
+        self.timeout = timeout
+        self.buffer: List[str] = []
+        self.last_flush = time.monotonic()
+        self.flood_start = self.last_flush
+        # (logger name, level, message template): [count, last record]
+        self.floods: Dict[Tuple, List] = dict()
+        self.dropped = 0
+        # posts a partial batch flush_interval after its first event
+        self._timer: Optional[threading.Timer] = None
+        # imported on use, requests is not needed unless Loggly is configured
+        import requests
+
+        self.session = requests.Session()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            now = time.monotonic()
+            if now - self.flood_start >= self.flood_interval:
+                self._summarize_floods()
+                self.flood_start = now
+
+            template = getattr(record, "template", record.msg)
+            key = (record.name, record.levelno, str(template))
+            flood = self.floods.setdefault(key, [0, None])
+            flood[0] += 1
+            if flood[0] > self.flood_limit:
+                flood[1] = record
+            else:
+                self.buffer.append(self._event(record))
+
+            if (
+                len(self.buffer) >= self.capacity
+                or now - self.last_flush >= self.flush_interval
+            ):
+                self.flush()
+            elif self.buffer and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        except Exception:
+            self.handleError(record)
+
+    def _event(self, record: logging.LogRecord) -> str:
+        # one event per line in a bulk post
+        return self.format(record).replace("\r", "\\r").replace("\n", "\\n")
+
+    def _summarize_floods(self) -> None:
+        for count, record in self.floods.values():
+            if record is None:
+                continue
+            suppressed = count - self.flood_limit
+            summary = logging.makeLogRecord(record.__dict__)
+            summary.msg = f"Suppressed {suppressed} repeated message(s): %s"
+            summary.args = (record.getMessage(),)
+            summary.exc_info = None
+            summary.exc_text = None
+            self.buffer.append(self._event(summary))
+        self.floods = dict()
+
+    def flush(self) -> None:
+        import requests
+
+        self.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+            if not batch:
+                return
+            data = "\n".join(batch).encode("utf-8")
+            try:
+                with metrics.timer("log.loggly_post") as timer:
+                    timer.rows = len(batch)
+                    timer.bytes = len(data)
+                    response = self.session.post(
+                        self.url,
+                        data=data,
+                        headers={"Content-Type": "text/plain"},
+                        timeout=self.timeout,
+                    )
+                response.raise_for_status()
+            except requests.RequestException:
+                self.dropped += len(batch)
+                metrics.count("log.dropped", len(batch))
+        finally:
+            self.release()
+
+    def close(self) -> None:
+        try:
+            self._summarize_floods()
+            self.flush()
+            self.session.close()
+        finally:
+            super().close()
+
+
+class FlushingQueueListener(QueueListener):
+    """
+    QueueListener flushing its handlers once remaining records are handled
+    on stop, so buffered events are not left waiting for a later record
+    """
+
+    def stop(self) -> None:
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+def enqueue_handlers(
+    logger: logging.Logger, queue_size: int = QUEUE_SIZE
+) -> QueueListener:
+    """
+    Moves logger's handlers behind a queue processed by a background thread,
+    so the logging thread does not wait for handlers' I/O. The logger's
+    level is raised to the lowest level of its handlers, so calls below it
+    return before a record is created.
+
+    Args:
+        logger:                 logger to reconfigure
+        queue_size:             max number of records waiting in the queue
+
+    Returns:
+        started QueueListener, stop it to flush remaining records
+    """
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    if handlers:
+        level = min(handler.level for handler in handlers)
+        logger.setLevel(max(logger.getEffectiveLevel(), level))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    listener = FlushingQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight instrumentation of processing stages: timers, counters and
+per-run summaries
+"""
+
+from datetime import datetime
+import functools
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+mlogger = logging.getLogger("bookops-watchdog")
+
+
+class _Timer:
+    """
+    Times a block of code; rows and bytes processed within it may be set
+    on the timer to report throughput
+    """
+
+    __slots__ = ("metrics", "name", "rows", "bytes", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+        self.rows = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.metrics.add(self.name, seconds, self.rows, self.bytes)
+
+
+class _NullTimer:
+    """
+    Stands in for _Timer when metrics are disabled
+    """
+
+    __slots__ = ()
+    rows = 0
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    Collects timings and counters of processing stages. Timings of a stage
+    accumulate number of calls, total and max seconds, and rows and bytes
+    processed, which give its throughput. When disabled, timers and counters
+    return immediately.
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        Args:
+            enabled:            collect metrics
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        # stage: [calls, seconds, max seconds, rows, bytes]
+        self.timers: Dict[str, list] = dict()
+        self.counters: Dict[str, float] = dict()
+        self.started = time.perf_counter()
+
+    def add(self, name: str, seconds: float, rows: int = 0, size: int = 0) -> None:
+        """
+        Records a single timing of a stage
+
+        Args:
+            name:               stage name, example: 'reader.parse'
+            seconds:            elapsed time
+            rows:               number of rows processed
+            size:               number of bytes processed
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            timing = self.timers.get(name)
+            if timing is None:
+                self.timers[name] = [1, seconds, seconds, rows, size]
+            else:
+                timing[0] += 1
+                timing[1] += seconds
+                timing[2] = max(timing[2], seconds)
+                timing[3] += rows
+                timing[4] += size
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Increments a counter
+
+        Args:
+            name:               counter name, example: 'drive.files'
+            value:              increment
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timer(self, name: str):
+        """
+        Returns context manager timing its block as a stage
+
+        Args:
+            name:               stage name
+
+        Returns:
+            timer accepting rows and bytes attributes
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def timed(self, name: str) -> Callable:
+        """
+        Decorator timing each call of a function as a stage
+
+        Args:
+            name:               stage name
+        """
+
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.add(name, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    def reset(self) -> None:
+        with self._lock:
+            self.timers = dict()
+            self.counters = dict()
+            self.started = time.perf_counter()
+
+    def summary(self) -> Dict:
+        """
+        Returns timings and counters collected since the last reset
+
+        Returns:
+            dictionary of elapsed seconds, stages and counters
+        """
+        with self._lock:
+            stages = dict()
+            for name, (calls, seconds, longest, rows, size) in sorted(
+                self.timers.items()
+            ):
+                stage = dict(calls=calls, seconds=round(seconds, 6))
+                stage["max_seconds"] = round(longest, 6)
+                if rows:
+                    stage["rows"] = rows
+                    stage["rows_per_sec"] = round(rows / seconds) if seconds else None
+                if size:
+                    stage["bytes"] = size
+                    stage["bytes_per_sec"] = round(size / seconds) if seconds else None
+                stages[name] = stage
+            return dict(
+                elapsed=round(time.perf_counter() - self.started, 6),
+                stages=stages,
+                counters=dict(sorted(self.counters.items())),
+            )
+
+    def report(self, metrics_fh: Optional[str] = None) -> Optional[Dict]:
+        """
+        Logs summary of collected metrics, appends it as a line of JSON to
+        the metrics file, and resets metrics. Nothing is reported when
+        disabled or nothing was collected.
+
+        Args:
+            metrics_fh:         path of the metrics file
+
+        Returns:
+            reported summary
+        """
+        if not self.enabled or not (self.timers or self.counters):
+            return None
+        summary = dict(timestamp=datetime.now().isoformat(timespec="seconds"))
+        summary.update(self.summary())
+        self.reset()
+        line = json.dumps(summary)
+        mlogger.info("Run metrics: %s", line)
+        if metrics_fh:
+            try:
+                with open(metrics_fh, "a") as f:
+                    f.write(line + "\n")
+            except OSError as exc:
+                mlogger.warning("Unable to write metrics file. Error: %s", exc)
+        return summary
+
+
+metrics = Metrics()
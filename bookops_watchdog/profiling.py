@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""
+CPU (cProfile) and memory (tracemalloc) profiling of the app's run
+"""
+
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from typing import Dict, Iterator, List, Optional, Tuple
+
+mlogger = logging.getLogger("bookops-watchdog")
+
+
+PROFILE_MODES = ("cpu", "mem")
+
+# number of functions or allocation sites listed in the summary
+TOP_N = 20
+
+# number of frames kept for each traced allocation
+TRACEMALLOC_FRAMES = 10
+
+
+class ThreadedProfile:
+    """
+    cProfile profiler of the calling thread and of threads started while it
+    is enabled (library pipelines, datastore writer, email senders). Each
+    thread gets its own profiler and their stats are merged.
+    """
+
+    def __init__(self):
+        self.main = cProfile.Profile()
+        self.profiles: List[cProfile.Profile] = [self.main]
+        self._lock = threading.Lock()
+
+    def _start_thread(self, frame, event, arg):
+        # called on the first profiling event of a new thread
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # since Python 3.12 a single profiler already covers all threads
+            return
+        with self._lock:
+            self.profiles.append(profile)
+
+    def enable(self) -> None:
+        threading.setprofile(self._start_thread)
+        self.main.enable()
+
+    def disable(self) -> None:
+        self.main.disable()
+        threading.setprofile(None)
+
+    def stats(self) -> pstats.Stats:
+        """
+        Returns merged stats of all profiled threads
+        """
+        with self._lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def _profile_fh(out_dir: str, mode: str, extension: str) -> str:
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(out_dir, f"profile-{mode}-{timestamp}.{extension}")
+
+
+def _function_label(func) -> str:
+    filename, line, name = func
+    if filename == "~":
+        # built-in functions
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def _stats_table(stats: pstats.Stats) -> Dict[Tuple, Tuple]:
+    # {(file, line, name): (primitive calls, calls, own time, cumulative time,
+    # callers)}; the table is not part of the pstats type stubs
+    return stats.stats  # type: ignore[attr-defined]
+
+
+def cpu_hot_spots(stats: pstats.Stats, top: int = TOP_N) -> List[str]:
+    """
+    Returns summary lines of functions with the most own (exclusive) time
+
+    Args:
+        stats:                  profiler stats
+        top:                    number of functions listed
+
+    Returns:
+        list of formatted lines
+    """
+    table = _stats_table(stats)
+    entries = sorted(table.items(), key=lambda item: item[1][2], reverse=True)
+    lines = []
+    for func, (_, calls, own, cumulative, _) in entries[:top]:
+        lines.append(
+            f"{own:9.3f}s own {cumulative:9.3f}s cumulative {calls:>9} calls  "
+            f"{_function_label(func)}"
+        )
+    return lines
+
+
+def memory_hot_spots(snapshot: tracemalloc.Snapshot, top: int = TOP_N) -> List[str]:
+    """
+    Returns summary lines of source lines with the largest allocations still
+    held when the snapshot was taken
+
+    Args:
+        snapshot:               tracemalloc snapshot
+        top:                    number of allocation sites listed
+
+    Returns:
+        list of formatted lines
+    """
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+    )
+    lines = []
+    for stat in snapshot.statistics("lineno")[:top]:
+        frame = stat.traceback[0]
+        lines.append(
+            f"{stat.size / 1024:11.1f} KiB {stat.count:>9} blocks  "
+            f"{os.path.basename(frame.filename)}:{frame.lineno}"
+        )
+    return lines
+
+
+def _log_summary(title: str, lines: List[str]) -> None:
+    mlogger.info("%s\n%s", title, "\n".join(lines))
+
+
+@contextmanager
+def profile(
+    mode: Optional[str], out_dir: Optional[str], top: int = TOP_N
+) -> Iterator[None]:
+    """
+    Profiles the enclosed block. In 'cpu' mode a pstats dump is written to
+    out_dir, in 'mem' mode a tracemalloc snapshot together with a text file
+    of the top allocation sites. Hot spots are summarized in the log.
+    Without a mode the block runs unprofiled.
+
+    Args:
+        mode:                   'cpu', 'mem' or None
+        out_dir:                directory of profile files, the app data
+                                directory when run from the CLI
+        top:                    number of hot spots in the summary
+
+    usage:
+        with profile("cpu", data_dir):
+            run()
+    """
+    if mode is None:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}.")
+    out_dir = out_dir or os.getcwd()
+
+    if mode == "cpu":
+        profiler = ThreadedProfile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stats = profiler.stats()
+            stats_fh = _profile_fh(out_dir, mode, "pstats")
+            stats.dump_stats(stats_fh)
+            mlogger.info("CPU profile saved to '%s'.", stats_fh)
+            entries = _stats_table(stats).values()
+            total_time = sum(entry[2] for entry in entries)
+            total_calls = sum(entry[1] for entry in entries)
+            _log_summary(
+                f"Top {top} functions by own time "
+                f"(total {total_time:.3f}s, {total_calls} calls):",
+                cpu_hot_spots(stats, top),
+            )
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        snapshot_fh = _profile_fh(out_dir, mode, "tracemalloc")
+        snapshot.dump(snapshot_fh)
+        peak_mib = peak / 1024**2
+        title = f"Top {top} allocation sites (peak traced memory {peak_mib:.1f} MiB):"
+        lines = memory_hot_spots(snapshot, top)
+        top_fh = _profile_fh(out_dir, mode, "txt")
+        with open(top_fh, "w") as f:
+            f.write("\n".join([title] + lines) + "\n")
+        mlogger.info("Memory snapshot saved to '%s'.", snapshot_fh)
+        _log_summary(title, lines)
@@ -4,6 +4,60 @@
 This module provides methods to add, update, and retrieve data from app's datastore
 """
 
+from datetime import datetime
+from itertools import islice
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.sqlite import insert
+
+from bookops_watchdog.datastore import Bib, File, FileChange, Library, Order
+from bookops_watchdog.errors import WatchdogError
+from bookops_watchdog.metrics import metrics
+from bookops_watchdog.worker_drive import is_sierra_export
+from bookops_watchdog.worker_reports import sierra_no_to_int
+
+mlogger = logging.getLogger("bookops-watchdog")
+
+
+# datastore Library codes of libraries (as named on the shared drive)
+LIBRARY_CODES = dict(bpl="bpl", nypl="nyp")
+
+# number of export rows committed between ingest checkpoints
+CHECKPOINT_ROWS = 10000
+
+# max number of bound parameters in a single IN clause; stays below
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER of older versions (999)
+IN_CLAUSE_BATCH_SIZE = 500
+
+# Bib attributes required by the schema that are not present in Sierra exports;
+# they are populated by later analysis of the full MARC record
+BIB_DEFAULTS = dict(
+    callFormat="",
+    callAudn="",
+    callWl=False,
+    callCutter=False,
+    critWork=False,
+    subjectPerson=False,
+    worldLang=False,
+)
+
+# counts reported by ingest
+INGEST_COUNTS = (
+    "bibs_inserted",
+    "bibs_updated",
+    "bibs_skipped",
+    "orders_inserted",
+    "orders_updated",
+    "orders_skipped",
+)
+
+# Bib and Order columns populated from Sierra exports, updated when
+# a record is exported again with changed values
+BIB_COLUMNS = ("library_wid", "author", "catDate", "subjects", "title")
+ORDER_COLUMNS = ("bib_wid", "copies", "orderDate")
+
 
 def insert_or_ignore(session, model, **kwargs):
     """
@@ -24,3 +78,311 @@ def insert_or_ignore(session, model, **kwargs):
         instance = model(**kwargs)
         session.add(instance)
     return instance
+
+
+def get_library_wid(session, library: str) -> int:
+    """
+    Returns datastore wid of the library, adds the library if missing
+
+    Args:
+        session:                db session
+        library:                'bpl' or 'nypl'
+
+    Returns:
+        library wid
+    """
+    instance = insert_or_ignore(session, Library, code=LIBRARY_CODES[library])
+    session.flush()
+    return instance.wid
+
+
+def bulk_upsert(session, model, rows: List[Dict], columns: Iterable[str]) -> int:
+    """
+    Adds multiple records to a table (model) in a single statement. Records
+    that already exist based on 'wid' have given columns updated, unless
+    their values are unchanged.
+
+    Args:
+        session:                db session
+        model:                  datastore module table
+        rows:                   list of record arguments
+        columns:                names of columns updated on existing records
+
+    Returns:
+        number of inserted or updated rows
+    """
+    if not rows:
+        return 0
+    table = model.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["wid"],
+        set_={c: stmt.excluded[c] for c in columns},
+        where=or_(*[table.c[c].is_distinct_from(stmt.excluded[c]) for c in columns]),
+    )
+    result = session.execute(stmt, rows)
+    return result.rowcount
+
+
+@metrics.timed("datastore.find_unprocessed")
+def find_unprocessed_handles(
+    session, library_wid: int, delivered: Iterable[str]
+) -> List[str]:
+    """
+    Returns delivered Sierra export file handles that have not been recorded
+    as completed in the File table for given library. Handles not following
+    Sierra export naming schema are dropped before the datastore is queried.
+
+    Args:
+        session:                db session
+        library_wid:            datastore wid of the library
+        delivered:              file handles found on the shared drive
+
+    Returns:
+        unprocessed:            list of file handles for processing
+    """
+    candidates = list(dict.fromkeys(fh for fh in delivered if is_sierra_export(fh)))
+    processed: Set[str] = set()
+    for i in range(0, len(candidates), IN_CLAUSE_BATCH_SIZE):
+        batch = candidates[i : i + IN_CLAUSE_BATCH_SIZE]
+        rows = (
+            session.query(File.handle)
+            .filter(
+                File.library_wid == library_wid,
+                File.handle.in_(batch),
+                File.completed.is_(True),
+            )
+            .all()
+        )
+        processed.update(handle for (handle,) in rows)
+    unprocessed = [fh for fh in candidates if fh not in processed]
+    return unprocessed
+
+
+def _as_date(value):
+    # Date columns are read back as dates, compared with export values
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def _bib_row(record: Dict, bib_wid: int, library_wid: int) -> Dict:
+    row = dict(
+        BIB_DEFAULTS,
+        wid=bib_wid,
+        library_wid=library_wid,
+        author=record["author"],
+        catDate=_as_date(record["catDate"]),
+        subjects="~".join(record["subjects"]),
+        title=record["title"],
+    )
+    return row
+
+
+def _order_row(record: Dict, order_wid: int, bib_wid: int) -> Dict:
+    row = dict(
+        wid=order_wid,
+        bib_wid=bib_wid,
+        copies=record["copies"] or 0,
+        orderDate=_as_date(record["orderDate"]),
+    )
+    return row
+
+
+def find_changed_rows(
+    session, model, rows: Dict[int, Dict], columns: Iterable[str]
+) -> Tuple[Set[int], Set[int]]:
+    """
+    Compares rows with records stored in a table (model)
+
+    Args:
+        session:                db session
+        model:                  datastore module table
+        rows:                   record arguments by wid
+        columns:                names of compared columns
+
+    Returns:
+        wids of new rows and wids of rows with changed values
+    """
+    table = model.__table__
+    columns = list(columns)
+    wids = list(rows)
+    stored = dict()
+    for i in range(0, len(wids), IN_CLAUSE_BATCH_SIZE):
+        batch = wids[i : i + IN_CLAUSE_BATCH_SIZE]
+        stmt = select(table.c.wid, *[table.c[c] for c in columns]).where(
+            table.c.wid.in_(batch)
+        )
+        for wid, *values in session.execute(stmt):
+            stored[wid] = tuple(values)
+    new = {wid for wid in wids if wid not in stored}
+    changed = {
+        wid
+        for wid, values in stored.items()
+        if values != tuple(rows[wid][c] for c in columns)
+    }
+    return new, changed
+
+
+def bulk_ingest(
+    session,
+    records: Iterable[Dict],
+    library_wid: int,
+    batch_size: int = 5000,
+    file_wid: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Writes Bib and Order rows produced by SierraExportReader in batches.
+    Records already present in the datastore are updated with the export's
+    values, unchanged ones are skipped. When file_wid is given, bibs and
+    orders the export inserted or modified are recorded as the file's
+    change set.
+
+    Args:
+        session:                db session
+        records:                iterable of normalized Sierra export records
+        library_wid:            datastore wid of the library
+        batch_size:             number of export rows written per statement
+        file_wid:               datastore wid of the export's File
+
+    Returns:
+        counts of inserted, updated and skipped bibs and orders
+    """
+    if batch_size < 1:
+        raise ValueError("Batch size must be a positive integer.")
+
+    counts = dict.fromkeys(INGEST_COUNTS, 0)
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+
+        bibs = dict()
+        orders = dict()
+        # ordered set of (bib_wid, order_wid) pairs included in the batch
+        pairs: Dict[Tuple[int, Optional[int]], None] = dict()
+        bib_total = 0
+        order_total = 0
+        for record in batch:
+            bib_wid = sierra_no_to_int(record["bibNo"])
+            if bib_wid is None:
+                mlogger.debug(
+                    "Skipping row with invalid bib number %r", record["bibNo"]
+                )
+                counts["bibs_skipped"] += 1
+                continue
+            bib_total += 1
+            if bib_wid not in bibs:
+                bibs[bib_wid] = _bib_row(record, bib_wid, library_wid)
+
+            order_wid = sierra_no_to_int(record["orderNo"])
+            pairs[(bib_wid, order_wid)] = None
+            if order_wid is None:
+                continue
+            order_total += 1
+            if order_wid not in orders:
+                orders[order_wid] = _order_row(record, order_wid, bib_wid)
+
+        with metrics.timer("datastore.ingest") as timer:
+            timer.rows = len(batch)
+            new, changed = find_changed_rows(session, Bib, bibs, BIB_COLUMNS)
+            written_bibs = new | changed
+            bulk_upsert(session, Bib, [bibs[w] for w in written_bibs], BIB_COLUMNS)
+            counts["bibs_inserted"] += len(new)
+            counts["bibs_updated"] += len(changed)
+            counts["bibs_skipped"] += bib_total - len(written_bibs)
+
+            new, changed = find_changed_rows(session, Order, orders, ORDER_COLUMNS)
+            written_orders = new | changed
+            bulk_upsert(
+                session, Order, [orders[w] for w in written_orders], ORDER_COLUMNS
+            )
+            counts["orders_inserted"] += len(new)
+            counts["orders_updated"] += len(changed)
+            counts["orders_skipped"] += order_total - len(written_orders)
+
+            change_rows = [
+                dict(file_wid=file_wid, bib_wid=b, order_wid=o)
+                for b, o in pairs
+                if b in written_bibs or o in written_orders
+            ]
+            if file_wid is not None and change_rows:
+                session.execute(FileChange.__table__.insert(), change_rows)
+
+    mlogger.debug("Bulk ingest completed: %s", counts)
+    return counts
+
+
+def get_file(
+    session,
+    library_wid: int,
+    handle: str,
+    size: Optional[int] = None,
+    mtime_ns: Optional[int] = None,
+) -> File:
+    """
+    Returns File of the export, adds one if missing. An existing incomplete
+    File carries the checkpoint of an interrupted ingest. When the export's
+    size or modification time differ from the ones recorded with the
+    checkpoint, the export was delivered again with new content and its
+    checkpoint and completion are reset.
+
+    Args:
+        session:                db session
+        library_wid:            datastore wid of the library
+        handle:                 export file handle
+        size:                   current size of the export in bytes
+        mtime_ns:               current modification time of the export
+
+    Returns:
+        File instance
+    """
+    instance = insert_or_ignore(session, File, library_wid=library_wid, handle=handle)
+    source = (size, mtime_ns)
+    if size is not None and (instance.source_size, instance.source_mtime) != source:
+        # Files completed before their source was recorded are kept as they are
+        changed = instance.source_size is not None or not instance.completed
+        if changed and (instance.checkpoint_offset or instance.completed):
+            mlogger.info("Export %s changed since its ingest, restarting it.", handle)
+            instance.checkpoint_offset = 0
+            instance.checkpoint_row = 0
+            instance.completed = False
+        instance.source_size, instance.source_mtime = source
+    session.flush()
+    return instance
+
+
+def ingest_chunk(
+    session, file: File, records: List[Dict], start: int, end: int
+) -> Dict[str, int]:
+    """
+    Writes a chunk of export records and advances the File's checkpoint past
+    it. A chunk that does not begin at the current checkpoint is rejected,
+    so a failed write of an earlier chunk is never skipped over.
+
+    Args:
+        session:                db session
+        file:                   File of the export
+        records:                normalized Sierra export records of the chunk
+        start:                  byte offset the chunk begins at
+        end:                    byte offset right after the chunk
+
+    Returns:
+        counts of inserted and skipped bibs and orders
+    """
+    if file.checkpoint_offset != start:
+        raise WatchdogError(
+            f"Chunk of {file.handle} at byte {start} does not follow "
+            f"its checkpoint at byte {file.checkpoint_offset}."
+        )
+    counts = bulk_ingest(
+        session,
+        records,
+        file.library_wid,
+        batch_size=max(len(records), 1),
+        file_wid=file.wid,
+    )
+    file.checkpoint_offset = end
+    file.checkpoint_row += len(records)
+    return counts
@@ -3,15 +3,34 @@
 """
 This module handles retrieval of Sierra exports from a shared drive
 """
+
+import ctypes
+import ctypes.util
+from collections import Counter
 from datetime import datetime
+import hashlib
+import json
 import logging
 import os
-from typing import List
+import select
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
 
+from bookops_watchdog.errors import WatchdogError
+from bookops_watchdog.metrics import metrics
 
 mlogger = logging.getLogger("bookops-watchdog")
 
 
+# default max size in bytes of locally staged exports
+STAGING_CACHE_SIZE = 1024 * 1024 * 1024
+
+# size in bytes of reads when copying and hashing exports
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
 def is_sierra_export(file_handle: str) -> bool:
     """
     Returns only file handles that follow Sierra export naming schema
@@ -40,6 +59,7 @@ def is_sierra_export(file_handle: str) -> bool:
     return True
 
 
+@metrics.timed("drive.find_unprocessed")
 def find_unprocessed_files(delivered: List[str], processed: List[str]) -> List[str]:
     """
     Compares two lists: delivered files names and processed file names and
@@ -60,17 +80,405 @@ def find_unprocessed_files(delivered: List[str], processed: List[str]) -> List[s
     return unprocessed
 
 
-def get_sierra_files(library: str) -> List[str]:
+def get_library_dir(library: str, drive: str) -> str:
+    """
+    Returns library's directory on the shared drive
+
+    Args:
+        library                 relevant library: 'bpl' or 'nypl'
+        drive:                  shared drive root directory
+    """
+    return os.path.join(drive, library.upper())
+
+
+@metrics.timed("drive.list")
+def get_sierra_files(library: str, drive: str) -> List[str]:
     """
     Returns all files in given folder
 
     Args:
-        folder:                 directory's path
         library                 relevant library: 'bpl' or 'nypl'
+        drive:                  shared drive root directory
     """
-    root_dir = os.getenv("watchdog_drive")
-    directory = os.path.join(root_dir, library.upper())
-    files = [
-        f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))
-    ]
+    directory = get_library_dir(library, drive)
+    with os.scandir(directory) as entries:
+        files = [e.name for e in entries if e.is_file()]
+    metrics.count("drive.files", len(files))
     return files
+
+
+class DriveIndex:
+    """
+    Persisted index of Sierra exports found on the shared drive. Keeps size
+    and modification time of each export, so a scan returns only exports
+    that are new or changed since the previous one.
+    """
+
+    def __init__(self, index_fh: Optional[str], drive: str):
+        """
+        Args:
+            index_fh:           path to index file, when not given the
+                                index is kept in memory only
+            drive:              shared drive root directory
+        """
+        self.index_fh = index_fh
+        self.drive = drive
+        self.entries: Dict[str, Dict[str, List[int]]] = self._load()
+
+    def _load(self) -> Dict[str, Dict[str, List[int]]]:
+        if not self.index_fh or not os.path.isfile(self.index_fh):
+            return dict()
+        try:
+            with open(self.index_fh, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as exc:
+            mlogger.warning("Unable to read drive index, rebuilding. Error: %s", exc)
+            return dict()
+
+    def save(self) -> None:
+        """
+        Writes index to disk
+        """
+        if not self.index_fh:
+            return
+        temp_fh = f"{self.index_fh}.tmp"
+        with open(temp_fh, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temp_fh, self.index_fh)
+
+    def scan(self, library: str) -> List[str]:
+        """
+        Scans library's directory and returns Sierra exports that were added
+        or changed since the last scan. Exports no longer present in the
+        directory are removed from the index.
+
+        Args:
+            library             relevant library: 'bpl' or 'nypl'
+
+        Returns:
+            list of file handles
+        """
+        known = self.entries.get(library, dict())
+        current = dict()
+        changed = []
+        with os.scandir(get_library_dir(library, self.drive)) as entries:
+            for entry in entries:
+                name = entry.name
+                if name not in known and not is_sierra_export(name):
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                signature = [stat.st_size, stat.st_mtime_ns]
+                current[name] = signature
+                if known.get(name) != signature:
+                    changed.append(name)
+        self.entries[library] = current
+        return changed
+
+
+def _copy_and_hash(src: str, dst: str) -> str:
+    # single sequential pass over the source, hashing what is written
+    digest = hashlib.sha256()
+    with open(src, "rb") as r, open(dst, "wb") as w:
+        while True:
+            block = r.read(COPY_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            w.write(block)
+    return digest.hexdigest()
+
+
+def _hash_file(fh: str) -> str:
+    digest = hashlib.sha256()
+    with open(fh, "rb") as f:
+        while True:
+            block = f.read(COPY_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StagingCache:
+    """
+    Content-addressed local copies of Sierra exports. Each export is copied
+    from the shared drive once, verified by size and SHA-256 hash, and later
+    reads are served from the local copy as long as the export's size and
+    modification time do not change. Least recently used copies that are not
+    being read are evicted when the cache grows over its max size. The cache index is persisted, so
+    copies are reused across runs.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_size: Optional[int] = None):
+        """
+        Args:
+            cache_dir:          staging directory; when not given, exports
+                                are read from the drive
+            max_size:           max size of staged copies in bytes, defaults
+                                to STAGING_CACHE_SIZE
+        """
+        # empty when staging is disabled
+        self.cache_dir = cache_dir or ""
+        if max_size is None:
+            max_size = STAGING_CACHE_SIZE
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # number of pipelines reading each staged copy
+        self._in_use: Counter = Counter()
+        # sources: {path: [hash, size, mtime_ns]}, objects: {hash: [size, last_used]}
+        self.sources: Dict[str, List] = dict()
+        self.objects: Dict[str, List] = dict()
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load()
+
+    @property
+    def index_fh(self) -> str:
+        return os.path.join(self.cache_dir, "index.json")
+
+    def object_fh(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest)
+
+    def _load(self) -> None:
+        if not os.path.isfile(self.index_fh):
+            return
+        try:
+            with open(self.index_fh, "r") as f:
+                data = json.load(f)
+            sources, objects = data["sources"], data["objects"]
+        except (OSError, ValueError, KeyError) as exc:
+            mlogger.warning("Unable to read staging index, rebuilding. Error: %s", exc)
+            return
+        # drop entries of copies removed from disk
+        self.objects = {
+            digest: entry
+            for digest, entry in objects.items()
+            if os.path.isfile(self.object_fh(digest))
+        }
+        self.sources = {
+            path: entry for path, entry in sources.items() if entry[0] in self.objects
+        }
+
+    def save(self) -> None:
+        """
+        Writes cache index to disk
+        """
+        if not self.cache_dir:
+            return
+        temp_fh = f"{self.index_fh}.tmp"
+        with open(temp_fh, "w") as f:
+            json.dump(dict(sources=self.sources, objects=self.objects), f)
+        os.replace(temp_fh, self.index_fh)
+
+    @property
+    def size(self) -> int:
+        return sum(size for size, _ in self.objects.values())
+
+    def stage(self, fh: str) -> str:
+        """
+        Returns path to a verified local copy of the export, copies it from
+        the drive if needed. The copy is kept from eviction until released.
+
+        Args:
+            fh:                 path to export on the shared drive
+
+        Returns:
+            path to local copy
+        """
+        if not self.cache_dir:
+            return fh
+        path = os.path.abspath(fh)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self.sources.get(path)
+            if entry and entry[1:] == [stat.st_size, stat.st_mtime_ns]:
+                digest = entry[0]
+                self.objects[digest][1] = time.time()
+                self._in_use[digest] += 1
+                self.save()
+                mlogger.debug("Reading %s from staging cache.", fh)
+                return self.object_fh(digest)
+
+        # copying and verifying does not block other pipelines
+        temp_fh, digest = self._copy(path, stat)
+        with self._lock:
+            try:
+                if digest in self.objects:
+                    os.remove(temp_fh)
+                else:
+                    os.replace(temp_fh, self.object_fh(digest))
+            except BaseException:
+                if os.path.exists(temp_fh):
+                    os.remove(temp_fh)
+                raise
+            self.objects[digest] = [stat.st_size, time.time()]
+            self.sources[path] = [digest, stat.st_size, stat.st_mtime_ns]
+            self._in_use[digest] += 1
+            mlogger.debug("Staged %s (%s bytes) as %s.", path, stat.st_size, digest)
+            self._evict()
+            self.save()
+        return self.object_fh(digest)
+
+    def release(self, fh: str) -> None:
+        """
+        Marks local copy returned by stage() as no longer read, so it can be
+        evicted; evicts copies over the cache max size
+
+        Args:
+            fh:                 path to local copy
+        """
+        if not self.cache_dir:
+            return
+        digest = os.path.basename(fh)
+        with self._lock:
+            self._in_use[digest] -= 1
+            if self._in_use[digest] <= 0:
+                del self._in_use[digest]
+            # evict copies kept over max size while they were read
+            if self.size > self.max_size:
+                self._evict()
+                self.save()
+
+    def _copy(self, path: str, stat: os.stat_result) -> Tuple[str, str]:
+        # temp file per thread, the same export may be staged concurrently
+        name = f"{os.path.basename(path)}.{threading.get_ident()}.part"
+        temp_fh = os.path.join(self.cache_dir, name)
+        try:
+            with metrics.timer("drive.stage") as timer:
+                digest = _copy_and_hash(path, temp_fh)
+                timer.bytes = stat.st_size
+            after = os.stat(path)
+            if (after.st_size, after.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                raise WatchdogError(f"Export {path} changed while being staged.")
+            if os.path.getsize(temp_fh) != stat.st_size:
+                raise WatchdogError(f"Staged copy of {path} has wrong size.")
+            if _hash_file(temp_fh) != digest:
+                raise WatchdogError(f"Staged copy of {path} is corrupted.")
+        except BaseException:
+            if os.path.exists(temp_fh):
+                os.remove(temp_fh)
+            raise
+        return temp_fh, digest
+
+    def _evict(self) -> None:
+        total = self.size
+        for digest, (size, _) in sorted(self.objects.items(), key=lambda i: i[1][1]):
+            if total <= self.max_size:
+                break
+            if self._in_use[digest]:
+                continue
+            try:
+                os.remove(self.object_fh(digest))
+            except FileNotFoundError:
+                pass
+            except OSError as exc:
+                mlogger.warning(
+                    "Unable to evict %s from staging cache. Error: %s", digest, exc
+                )
+                continue
+            del self.objects[digest]
+            total -= size
+            mlogger.debug("Evicted %s from staging cache.", digest)
+        self.sources = {
+            path: entry
+            for path, entry in self.sources.items()
+            if entry[0] in self.objects
+        }
+
+
+class PollingBackend:
+    """
+    Watch backend that sleeps for the poll interval; changes are discovered
+    by scanning the directories afterwards.
+    """
+
+    name = "polling"
+
+    def __init__(self, directories: List[str], stop_event: threading.Event):
+        self.directories = directories
+        self.stop_event = stop_event
+
+    def wait(self, timeout: float) -> None:
+        """
+        Blocks until timeout expires or the watcher is stopped
+
+        Args:
+            timeout:            max number of seconds to wait
+        """
+        self.stop_event.wait(timeout)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyBackend(PollingBackend):
+    """
+    Linux watch backend that wakes up as soon as a file is created, written
+    or moved into watched directories. Falls back to the poll interval for
+    changes inotify does not see (for example on network mounts).
+    """
+
+    name = "inotify"
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+
+    def __init__(self, directories: List[str], stop_event: threading.Event):
+        super().__init__(directories, stop_event)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f"Unable to watch directory {directory}")
+
+    def wait(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while not self.stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # wake up regularly to notice a stop request
+            ready, _, _ = select.select([self.fd], [], [], min(remaining, 1.0))
+            if ready:
+                self._drain()
+                return
+
+    def _drain(self) -> None:
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def get_watch_backend(
+    directories: List[str], stop_event: threading.Event
+) -> PollingBackend:
+    """
+    Returns inotify backend where available, otherwise polling backend
+
+    Args:
+        directories:            list of directories to watch
+        stop_event:             event signaling watcher shutdown
+
+    Returns:
+        watch backend
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyBackend(directories, stop_event)
+        except (AttributeError, OSError) as exc:
+            mlogger.warning("Inotify unavailable, falling back to polling: %s", exc)
+    return PollingBackend(directories, stop_event)
@@ -3,3 +3,308 @@
 """
 This module handles email conflict notifications
 """
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+import logging
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import select, update
+from urllib3.util.retry import Retry
+
+from bookops_watchdog.datastore import Bib, Conflict, Library, Ticket
+from bookops_watchdog.errors import WatchdogError
+from bookops_watchdog.worker_datastore import IN_CLAUSE_BATCH_SIZE, LIBRARY_CODES
+
+mlogger = logging.getLogger("bookops-watchdog")
+
+
+SENDGRID_URL = "https://api.sendgrid.com/v3/mail/send"
+
+# max number of messages sent at the same time
+MAX_CONCURRENT_SENDS = 4
+
+# tiers in order of severity, digests list more severe tickets first
+TIERS = ("error", "warning")
+
+
+TicketRow = namedtuple(
+    "TicketRow",
+    [
+        "wid",
+        "library",
+        "tier",
+        "code",
+        "description",
+        "bib_wid",
+        "order_wid",
+        "copies",
+        "title",
+    ],
+)
+
+# one email: recipients, rendered subject and body, and wids of included tickets
+Digest = namedtuple("Digest", ["recipients", "subject", "body", "ticket_wids"])
+
+
+class SendGridTransport:
+    """
+    Sends emails via SendGrid Web API through a pooled HTTP session. Failed
+    requests (connection errors, throttling, server errors) are retried with
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        sender: str,
+        url: str = SENDGRID_URL,
+        pool_size: int = MAX_CONCURRENT_SENDS,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30.0,
+    ):
+        """
+        Args:
+            api_key:            SendGrid API key
+            sender:             email address of the sender
+            url:                send endpoint, may point to a local stub server
+            pool_size:          max number of pooled connections
+            retries:            max number of retries of a failed request
+            backoff:            backoff factor in seconds between retries
+            timeout:            request timeout in seconds
+        """
+        self.url = url
+        self.sender = sender
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+
+    def send(self, recipients: List[str], subject: str, body: str) -> None:
+        """
+        Sends plain text email, raises WatchdogError if it was not accepted
+
+        Args:
+            recipients:         list of email addresses
+            subject:            email subject
+            body:               email plain text content
+        """
+        payload: Dict[str, Any] = {
+            "personalizations": [{"to": [{"email": r} for r in recipients]}],
+            "from": {"email": self.sender},
+            "subject": subject,
+            "content": [{"type": "text/plain", "value": body}],
+        }
+        try:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        except requests.RequestException as exc:
+            raise WatchdogError(f"Unable to send email. Error: {exc}")
+        if response.status_code >= 400:
+            raise WatchdogError(
+                f"Email rejected with status {response.status_code}: {response.text}"
+            )
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def get_unreported_tickets(session) -> List[TicketRow]:
+    """
+    Retrieves open tickets that have not been reported yet ordered by
+    library, tier, and conflict
+
+    Args:
+        session:                db session
+
+    Returns:
+        list of TicketRow
+    """
+    libraries = {code: library for library, code in LIBRARY_CODES.items()}
+    stmt = (
+        select(
+            Ticket.wid,
+            Library.code,
+            Conflict.tier,
+            Conflict.code,
+            Conflict.description,
+            Ticket.bib_wid,
+            Ticket.order_wid,
+            Ticket.copies,
+            Bib.title,
+        )
+        .join(Conflict, Conflict.wid == Ticket.conflict_wid)
+        .join(Bib, Bib.wid == Ticket.bib_wid)
+        .join(Library, Library.wid == Bib.library_wid)
+        .where(Ticket.reported.is_(False), Ticket.closed.is_(False))
+        .order_by(Library.code, Conflict.code, Ticket.bib_wid, Ticket.order_wid)
+    )
+    rows = [
+        TicketRow(r[0], libraries.get(r[1], r[1]), *r[2:])
+        for r in session.execute(stmt)
+    ]
+    rows.sort(key=lambda r: (r.library, _tier_rank(r.tier)))
+    return rows
+
+
+def _tier_rank(tier: str) -> int:
+    try:
+        return TIERS.index(tier)
+    except ValueError:
+        return len(TIERS)
+
+
+def render_section(library: str, tier: str, tickets: List[TicketRow]) -> str:
+    """
+    Renders tickets of a library and tier as plain text
+
+    Args:
+        library:                'bpl' or 'nypl'
+        tier:                   conflict tier
+        tickets:                tickets to include
+
+    Returns:
+        rendered section
+    """
+    lines = [f"{library.upper()} {tier}s ({len(tickets)}):"]
+    for code, group in groupby(tickets, key=lambda t: t.code):
+        code_tickets = list(group)
+        lines.append(f"  [{code}] {code_tickets[0].description}")
+        for t in code_tickets:
+            lines.append(
+                f"    b{t.bib_wid} / o{t.order_wid} (copies: {t.copies}) {t.title}"
+            )
+    return "\n".join(lines)
+
+
+def build_digests(
+    tickets: Iterable[TicketRow], recipients: Mapping[str, Mapping[str, Sequence[str]]]
+) -> List[Digest]:
+    """
+    Groups tickets by library and conflict tier and renders one digest per
+    group of recipients. Tickets without configured recipients are skipped.
+
+    Args:
+        tickets:                unreported tickets ordered by library and tier
+        recipients:             email addresses by library and tier, example:
+                                {'bpl': {'error': ['foo@bar.org']}}
+
+    Returns:
+        list of Digest
+    """
+    groups: Dict[Tuple[str, ...], List[Tuple[str, str, List[TicketRow]]]] = dict()
+    for (library, tier), group in groupby(tickets, key=lambda t: (t.library, t.tier)):
+        section = list(group)
+        to = tuple(sorted(set(recipients.get(library, dict()).get(tier) or [])))
+        if not to:
+            mlogger.warning(
+                "No recipients of %s %s notifications, %s ticket(s) not reported.",
+                library.upper(),
+                tier,
+                len(section),
+            )
+            continue
+        groups.setdefault(to, []).append((library, tier, section))
+
+    digests = []
+    for to, sections in groups.items():
+        count = sum(len(s) for _, _, s in sections)
+        names = ", ".join(f"{lib.upper()} {tier}s" for lib, tier, _ in sections)
+        body = "\n\n".join(render_section(*s) for s in sections)
+        wids = [t.wid for _, _, s in sections for t in s]
+        digests.append(
+            Digest(
+                recipients=list(to),
+                subject=f"Watchdog: {count} new ticket(s) - {names}",
+                body=body,
+                ticket_wids=wids,
+            )
+        )
+    return digests
+
+
+def mark_reported(session, ticket_wids: List[int]) -> int:
+    """
+    Marks tickets as reported with bulk updates of up to IN_CLAUSE_BATCH_SIZE
+    tickets each
+
+    Args:
+        session:                db session
+        ticket_wids:            datastore wids of Ticket
+
+    Returns:
+        number of updated tickets
+    """
+    updated = 0
+    for i in range(0, len(ticket_wids), IN_CLAUSE_BATCH_SIZE):
+        batch = ticket_wids[i : i + IN_CLAUSE_BATCH_SIZE]
+        result = session.execute(
+            update(Ticket)
+            .where(Ticket.wid.in_(batch))
+            .values(reported=True)
+            .execution_options(synchronize_session=False)
+        )
+        updated += result.rowcount
+    return updated
+
+
+def send_digests(
+    session,
+    transport,
+    recipients: Mapping[str, Mapping[str, Sequence[str]]],
+    max_workers: int = MAX_CONCURRENT_SENDS,
+) -> Dict[str, int]:
+    """
+    Emails digests of unreported tickets and marks tickets of successfully
+    sent digests as reported. Digests are sent concurrently.
+
+    Args:
+        session:                db session
+        transport:              object with send(recipients, subject, body)
+                                method raising an exception on failure
+        recipients:             email addresses by library and tier
+        max_workers:            max number of digests sent at the same time
+
+    Returns:
+        counts of sent and failed digests and reported tickets
+    """
+    digests = build_digests(get_unreported_tickets(session), recipients)
+    counts = dict(sent=0, failed=0, reported=0)
+    if not digests:
+        return counts
+
+    def send(digest: Digest) -> Optional[Digest]:
+        try:
+            transport.send(digest.recipients, digest.subject, digest.body)
+        except Exception:
+            mlogger.exception("Unable to send digest to %s.", digest.recipients)
+            return None
+        return digest
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(send, digests))
+
+    reported = []
+    for digest in results:
+        if digest is None:
+            counts["failed"] += 1
+        else:
+            counts["sent"] += 1
+            reported.extend(digest.ticket_wids)
+    counts["reported"] = mark_reported(session, reported)
+    mlogger.info("Sent ticket digests: %s", counts)
+    return counts
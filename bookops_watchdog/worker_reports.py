@@ -3,11 +3,26 @@
 """
 This module includes methods for parsing Sierra reports
 """
-from collections import namedtuple
+
+from collections import deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import csv
 from datetime import datetime
+from contextlib import contextmanager
+from functools import lru_cache
+import gzip
+import io
+from itertools import islice
+import locale
 import logging
+import os
+import time
+from typing import IO, Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+import zipfile
+
 
+from bookops_watchdog.metrics import metrics
 
 mlogger = logging.getLogger("bookops-watchdog")
 
@@ -31,31 +46,725 @@ Row = namedtuple(
     ],
 )
 
-# Record = namedtuple()
+
+class Record(Mapping):
+    """
+    Compact normalized Sierra export record. Stores values in slots instead
+    of a per-row dict, while supporting dict-style reads. Like the Mapping it
+    implements, it does not support item assignment; its attributes are not
+    guarded, so consumers are expected to treat records as values.
+    """
+
+    __slots__ = (
+        "author",
+        "bibNo",
+        "catDate",
+        "orderDate",
+        "orderNo",
+        "copies",
+        "subjects",
+        "title",
+    )
+
+    def __init__(
+        self, author, bibNo, catDate, orderDate, orderNo, copies, subjects, title
+    ):
+        self.author = author
+        self.bibNo = bibNo
+        self.catDate = catDate
+        self.orderDate = orderDate
+        self.orderNo = orderNo
+        self.copies = copies
+        self.subjects = subjects
+        self.title = title
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{k}={getattr(self, k)!r}" for k in self.__slots__)
+        return f"Record({fields})"
+
+    def to_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+DELIMITER = "^"
+QUOTECHAR = '"'
+DATE_CACHE_SIZE = 1024
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+COLUMNAR_BATCH_SIZE = 10000
+READ_BLOCK_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+# local file header and end of central directory of an empty archive
+ZIP_MAGIC = (b"PK\x03\x04", b"PK\x05\x06")
+
+
+# statistics of a single read of an export; bytes are counted at the source,
+# before decompression
+ReadStats = namedtuple(
+    "ReadStats", ["bytes_read", "reads", "seconds", "bytes_per_second"]
+)
+
+
+class _CountingReader(io.RawIOBase):
+    """
+    Raw binary stream counting bytes and read calls made to the wrapped
+    source. Closes the source only if it owns it.
+    """
+
+    def __init__(self, source: BinaryIO, owned: bool = True):
+        self.source = source
+        self.owned = owned
+        self.bytes_read = 0
+        self.reads = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if hasattr(self.source, "readinto"):
+            n = self.source.readinto(b)
+        else:
+            data = self.source.read(len(b))
+            n = len(data)
+            b[:n] = data
+        if n:
+            self.bytes_read += n
+        self.reads += 1
+        return n
+
+    def seekable(self) -> bool:
+        return self.source.seekable()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self.source.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.source.tell()
+
+    def close(self) -> None:
+        if self.owned and not self.closed:
+            self.source.close()
+        super().close()
+
+
+def _skip(stream: BinaryIO, n: int) -> None:
+    # forward-only streams are read through to the position
+    while n > 0:
+        data = stream.read(min(n, READ_BLOCK_SIZE))
+        if not data:
+            break
+        n -= len(data)
+
+
+@contextmanager
+def open_export(source: Union[str, BinaryIO], block_size: int = READ_BLOCK_SIZE):
+    """
+    Opens Sierra export for binary reading in blocks of block_size bytes.
+    Gzip and zip compressed exports are decompressed on the fly (the first
+    file of a zip archive is read). Streams passed by the caller are not
+    closed.
+
+    Args:
+        source:                 path to Sierra export or binary stream
+        block_size:             size in bytes of reads from the source
+
+    Yields:
+        (binary stream, counting reader of the source)
+    """
+    if block_size < 1:
+        raise ValueError("Block size must be a positive integer.")
+    if isinstance(source, (str, os.PathLike)):
+        counter = _CountingReader(open(source, "rb", buffering=0))
+    else:
+        counter = _CountingReader(source, owned=False)
+
+    buffered = io.BufferedReader(counter, buffer_size=block_size)
+    stream: Union[IO[bytes], gzip.GzipFile] = buffered
+    archive = None
+    try:
+        magic = buffered.peek(4)[:4]
+        if magic.startswith(GZIP_MAGIC):
+            stream = gzip.GzipFile(fileobj=buffered, mode="rb")
+        elif magic in ZIP_MAGIC:
+            archive = zipfile.ZipFile(buffered)
+            members = [i for i in archive.infolist() if not i.is_dir()]
+            if not members:
+                raise ValueError("Zip archive does not include any files.")
+            stream = archive.open(members[0])
+        yield stream, counter
+    finally:
+        stream.close()
+        if archive is not None:
+            archive.close()
+        counter.close()
+
+
+# record counts of scanned exports: {path: (size, mtime_ns, count)}
+_length_cache: Dict[str, Tuple[int, int, int]] = dict()
+
+
+def _scan_line(line: bytes, in_quotes: bool) -> bool:
+    """
+    Follows CSV quoting rules through a line and returns the quoting state
+    at its end. A quote opens a quoted field only at the start of a field,
+    doubled quotes inside a quoted field are escapes. Jumps from one quote
+    to the next, bytes between them do not change the state.
+    """
+    quote = QUOTECHAR.encode()
+    delimiter = ord(DELIMITER)
+    # whether the byte at i starts a field
+    field_start = not in_quotes
+    i = 0
+    while True:
+        j = line.find(quote, i)
+        if j < 0:
+            return in_quotes
+        if in_quotes:
+            if line[j + 1 : j + 2] == quote:
+                j += 1
+            else:
+                in_quotes = False
+        elif field_start if j == i else line[j - 1] == delimiter:
+            in_quotes = True
+        field_start = False
+        i = j + 1
+
+
+def _record_offsets(f: BinaryIO) -> Iterator[int]:
+    """
+    Yields byte offsets at which records of a binary stream end, skipping
+    newlines embedded in quoted fields. The header is the first record.
+    Only lines containing a quote or continuing a quoted field are scanned.
+    """
+    in_quotes = False
+    offset = 0
+    quote = QUOTECHAR.encode()
+    for line in f:
+        offset += len(line)
+        if not in_quotes and quote not in line:
+            if line.strip(b"\r\n"):
+                yield offset
+            continue
+        in_quotes = _scan_line(line, in_quotes)
+        if not in_quotes:
+            yield offset
+    if in_quotes:
+        # unterminated quoted field at the end of file is a record on its own
+        yield offset
+
+
+def _raw_records(f: BinaryIO) -> Iterator[bytes]:
+    """
+    Yields raw records of a binary stream keeping newlines embedded in
+    quoted fields within a record
+    """
+    in_quotes = False
+    quote = QUOTECHAR.encode()
+    parts: List[bytes] = []
+    for line in f:
+        if not parts and quote not in line:
+            yield line
+            continue
+        parts.append(line)
+        in_quotes = _scan_line(line, in_quotes)
+        if not in_quotes:
+            yield b"".join(parts)
+            parts = []
+    if parts:
+        yield b"".join(parts)
+
+
+def count_records(fh: str) -> int:
+    """
+    Counts records in a Sierra export without parsing them. Scans raw lines
+    and skips newlines embedded in quoted fields.
+
+    Args:
+        fh:                     path to Sierra export
+
+    Returns:
+        number of records excluding the header
+    """
+    with open(fh, "rb") as f:
+        count = sum(1 for _ in _record_offsets(f))
+    return max(count - 1, 0)
+
+
+def chunk_ranges(fh: str, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    Splits Sierra export into record-aligned byte ranges of at least
+    chunk_size bytes (the last one may be smaller). The header is excluded.
+
+    Args:
+        fh:                     path to Sierra export
+        chunk_size:             minimum size of a range in bytes
+
+    Returns:
+        list of (start, end) byte offsets
+    """
+    ranges: List[Tuple[int, int]] = []
+    with open(fh, "rb") as f:
+        offsets = _record_offsets(f)
+        start = next(offsets, None)
+        if start is None:
+            return ranges
+        end = start
+        for end in offsets:
+            if end - start >= chunk_size:
+                ranges.append((start, end))
+                start = end
+        if end > start:
+            ranges.append((start, end))
+    return ranges
+
+
+def _parse_chunk(
+    fh: str,
+    start: int,
+    end: int,
+    compact: bool = False,
+    encoding: Optional[str] = None,
+) -> List[Union[Dict, Record]]:
+    """
+    Parses and normalizes records in a byte range of Sierra export.
+    Runs in a worker process.
+    """
+    with open(fh, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # decode the same way as the text mode used by the serial reader
+    reader = csv.reader(
+        io.TextIOWrapper(io.BytesIO(data), encoding=encoding),
+        delimiter=DELIMITER,
+        quotechar=QUOTECHAR,
+    )
+    normalize = SierraExportReader(fh, compact=compact)._normalize_data
+    return [normalize(row) for row in map(Row._make, reader)]
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value: str) -> Optional[datetime]:
+    """
+    Parses Sierra export date in MM-DD-YYYY format. Results are memoized,
+    use `parse_date.cache_info()` to inspect cache hits and misses.
+
+    Args:
+        value:                  date string, example: '07-06-2021'
+
+    Returns:
+        datetime or None if value is not a valid date
+    """
+    if (
+        len(value) == 10
+        and value[2] == "-"
+        and value[5] == "-"
+        and value[:2].isdigit()
+        and value[3:5].isdigit()
+        and value[6:].isdigit()
+    ):
+        try:
+            return datetime(int(value[6:]), int(value[:2]), int(value[3:5]))
+        except ValueError:
+            pass
+
+    try:
+        return datetime.strptime(value, "%m-%d-%Y")
+    except ValueError:
+        mlogger.debug("Unable to parse date from value %r", value)
+        return None
+
+
+def sierra_no_to_int(value: Optional[str]) -> Optional[int]:
+    """
+    Converts normalized Sierra record number into an integer, which is also
+    its datastore wid
+
+    Args:
+        value:                  Sierra record number, example: '12203913'
+                                or 'b12203913'
+
+    Returns:
+        record number or None if value is not a valid record number
+    """
+    if value is None:
+        return None
+    try:
+        return int(value.lstrip(".bo"))
+    except ValueError:
+        return None
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError(
+            "Columnar mode requires numpy. "
+            "Install it with 'pip install bookops-watchdog[analytics]'."
+        )
+    return numpy
+
+
+def _object_array(np, values: List) -> Any:
+    # assign one by one, so nested lists (subjects) are not broadcast into 2-D
+    arr = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        arr[i] = value
+    return arr
+
+
+def _int_array(np, values: List[Optional[int]]) -> Any:
+    return np.ma.masked_array(
+        [0 if v is None else v for v in values],
+        mask=[v is None for v in values],
+        dtype=np.int64,
+    )
+
+
+def records_to_batch(records: List[Dict]) -> Dict[str, Any]:
+    """
+    Converts normalized records into columnar form. Record numbers and copies
+    are stored in masked int64 arrays (invalid values are masked), dates in
+    datetime64[D] arrays (invalid dates are NaT), and remaining values in
+    object arrays.
+
+    Args:
+        records:                list of normalized records
+
+    Returns:
+        batch as dictionary of column name and numpy array
+    """
+    np = _import_numpy()
+    batch = dict(
+        author=_object_array(np, [r["author"] for r in records]),
+        bibNo=_int_array(np, [sierra_no_to_int(r["bibNo"]) for r in records]),
+        catDate=np.array([r["catDate"] for r in records], dtype="datetime64[D]"),
+        orderDate=np.array([r["orderDate"] for r in records], dtype="datetime64[D]"),
+        orderNo=_int_array(np, [sierra_no_to_int(r["orderNo"]) for r in records]),
+        copies=_int_array(np, [r["copies"] for r in records]),
+        subjects=_object_array(np, [r["subjects"] for r in records]),
+        title=_object_array(np, [r["title"] for r in records]),
+    )
+    return batch
+
+
+def batch_to_records(batch: Dict[str, Any]) -> List[Dict]:
+    """
+    Converts columnar batch back into records in the form produced by
+    SierraExportReader row mode. Masked record numbers are returned as None.
+
+    Args:
+        batch:                  columnar batch
+
+    Returns:
+        list of normalized records
+    """
+    np = _import_numpy()
+
+    def ints(arr):
+        return [
+            None if masked else value
+            for value, masked in zip(
+                arr.filled(0).tolist(), np.ma.getmaskarray(arr).tolist()
+            )
+        ]
+
+    def sierraNos(arr):
+        return [None if v is None else str(v) for v in ints(arr)]
+
+    def dates(arr):
+        return [
+            None if d is None else datetime(d.year, d.month, d.day)
+            for d in arr.tolist()
+        ]
+
+    columns = zip(
+        batch["author"].tolist(),
+        sierraNos(batch["bibNo"]),
+        dates(batch["catDate"]),
+        dates(batch["orderDate"]),
+        sierraNos(batch["orderNo"]),
+        ints(batch["copies"]),
+        batch["subjects"].tolist(),
+        batch["title"].tolist(),
+    )
+    return [
+        dict(
+            author=author,
+            bibNo=bibNo,
+            catDate=catDate,
+            orderDate=orderDate,
+            orderNo=orderNo,
+            copies=copies,
+            subjects=subjects,
+            title=title,
+        )
+        for author, bibNo, catDate, orderDate, orderNo, copies, subjects, title in columns
+    ]
 
 
 class SierraExportReader(object):
-    def __init__(self, fh: str):
+    def __init__(
+        self,
+        fh: Union[str, BinaryIO],
+        compact: bool = False,
+        block_size: int = READ_BLOCK_SIZE,
+        encoding: Optional[str] = None,
+    ):
+        """
+        Args:
+            fh:                 path to Sierra export or binary stream,
+                                may be gzip or zip compressed
+            compact:            when True yields Record objects instead of
+                                dictionaries
+            block_size:         size in bytes of reads from the export
+            encoding:           export encoding, defaults to the same locale
+                                encoding as used by open()
+        """
         self.fh = fh
+        self.compact = compact
+        self.block_size = block_size
+        self.encoding = encoding
+        self.stats: Optional[ReadStats] = None
 
-        self._length = None
+    def _plain_file(self) -> Optional[str]:
+        # parallel parsing and cached counts require seeking in a plain file,
+        # returns its path or None for streams and compressed exports
+        if not isinstance(self.fh, (str, os.PathLike)):
+            return None
+        fh = os.fspath(self.fh)
+        with open(fh, "rb") as f:
+            magic = f.read(4)
+        if magic.startswith(GZIP_MAGIC) or magic in ZIP_MAGIC:
+            return None
+        return fh
 
     def __iter__(self):
-        mlogger.debug(f"Intitating parsing of a Sirra export.")
-        self._length = 0
-        with open(self.fh, "r") as f:
-            reader = csv.reader(f, delimiter="^")
-            reader.__next__()
-            for row in map(Row._make, reader):
-                data = self._normalize_data(row)
-                self._length += 1
-                yield data
+        mlogger.debug("Intitating parsing of a Sierra export.")
+        start = time.perf_counter()
+        with open_export(self.fh, self.block_size) as (stream, counter):
+            f = io.TextIOWrapper(stream, encoding=self.encoding)
+            # decode in large chunks as well
+            f._CHUNK_SIZE = self.block_size
+            rows = 0
+            try:
+                reader = csv.reader(f, delimiter=DELIMITER, quotechar=QUOTECHAR)
+                next(reader, None)
+                for rows, row in enumerate(map(Row._make, reader), 1):
+                    yield self._normalize_data(row)
+            finally:
+                f.detach()
+                seconds = time.perf_counter() - start
+                self.stats = ReadStats(
+                    counter.bytes_read,
+                    counter.reads,
+                    seconds,
+                    counter.bytes_read / seconds if seconds else 0.0,
+                )
+                # wall time of the iteration, includes time spent by consumer
+                metrics.add("reader.iter", seconds, rows, counter.bytes_read)
+        mlogger.debug(
+            "Read %s bytes in %s reads (%.0f bytes/s).",
+            self.stats.bytes_read,
+            self.stats.reads,
+            self.stats.bytes_per_second,
+        )
+        mlogger.debug("Date parsing cache stats: %s", parse_date.cache_info())
+
+    def iter_parallel(
+        self,
+        workers: Optional[int] = None,
+        chunk_size: int = PARALLEL_CHUNK_SIZE,
+        ordered: bool = True,
+    ) -> Iterator[Dict]:
+        """
+        Parses the export in a pool of worker processes. Yields the same
+        records as serial iteration. With a single worker or chunk the
+        export is parsed serially, a pool would only add overhead.
+
+        Args:
+            workers:            number of worker processes, defaults to
+                                number of CPUs
+            chunk_size:         approximate size in bytes of a chunk of
+                                the export handed to a worker
+            ordered:            when False records are yielded in order
+                                of chunk completion
+
+        Yields:
+            normalized record
+        """
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be a positive integer.")
+        fh = self._plain_file()
+        if fh is None:
+            mlogger.debug("Export is not a plain file, parsing serially.")
+            yield from self
+            return
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            yield from self
+            return
+        ranges = chunk_ranges(fh, chunk_size)
+        if len(ranges) < 2:
+            yield from self
+            return
+        mlogger.debug(
+            "Parsing Sierra export in %s chunks using %s workers.",
+            len(ranges),
+            workers,
+        )
+
+        max_pending = workers * 2
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending: deque = deque()
+            try:
+                for start, end in ranges:
+                    pending.append(
+                        executor.submit(
+                            _parse_chunk,
+                            fh,
+                            start,
+                            end,
+                            self.compact,
+                            self.encoding,
+                        )
+                    )
+                    while len(pending) >= max_pending:
+                        yield from self._collect(pending, ordered)
+                while pending:
+                    yield from self._collect(pending, ordered)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _collect(self, pending: deque, ordered: bool) -> Iterator[Dict]:
+        if ordered:
+            yield from pending.popleft().result()
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                yield from future.result()
+
+    def iter_columnar(
+        self, batch_size: int = COLUMNAR_BATCH_SIZE
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the export in fixed-size batches in columnar form. Requires numpy.
+        See `records_to_batch` for column types and `batch_to_records`
+        to convert a batch back into row mode records.
+
+        Args:
+            batch_size:         number of records in a batch (the last one
+                                may be smaller)
+
+        Yields:
+            batch as dictionary of column name and numpy array
+        """
+        if batch_size < 1:
+            raise ValueError("Batch size must be a positive integer.")
+        _import_numpy()
+
+        records = []
+        for record in self:
+            records.append(record)
+            if len(records) == batch_size:
+                yield records_to_batch(records)
+                records = []
+        if records:
+            yield records_to_batch(records)
 
     def __len__(self):
-        if self._length is None:
-            for row in self:
-                continue
-        return self._length
+        fh = self._plain_file()
+        if fh is None:
+            return self._count_stream()
+        path = os.path.abspath(fh)
+        stat = os.stat(path)
+        cached = _length_cache.get(path)
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+
+        length = count_records(path)
+        _length_cache[path] = (stat.st_size, stat.st_mtime_ns, length)
+        return length
+
+    def iter_chunks(
+        self, size: int, offset: Optional[int] = None
+    ) -> Iterator[Tuple[List[Union[Dict, Record]], int]]:
+        """
+        Yields normalized records in chunks together with the byte offset
+        (in the uncompressed export) at which the chunk ends. Passing that
+        offset back resumes parsing right after the chunk.
+
+        Args:
+            size:               number of records in a chunk (the last one
+                                may be smaller)
+            offset:             byte offset to start from, defaults to the
+                                first record after the header
+
+        Yields:
+            (list of records, end offset)
+        """
+        if size < 1:
+            raise ValueError("Chunk size must be a positive integer.")
+        encoding = self.encoding or locale.getpreferredencoding(False)
+        with open_export(self.fh, self.block_size) as (stream, _):
+            records = _raw_records(stream)
+            if offset:
+                if stream.seekable():
+                    stream.seek(offset)
+                else:
+                    _skip(stream, offset)
+            else:
+                header = next(records, b"")
+                offset = len(header)
+
+            while True:
+                raw = list(islice(records, size))
+                if not raw:
+                    break
+                data = b"".join(raw)
+                offset += len(data)
+                with metrics.timer("reader.parse") as timer:
+                    reader = csv.reader(
+                        io.StringIO(data.decode(encoding), newline=None),
+                        delimiter=DELIMITER,
+                        quotechar=QUOTECHAR,
+                    )
+                    rows = list(map(Row._make, reader))
+                    timer.rows = len(rows)
+                    timer.bytes = len(data)
+                with metrics.timer("reader.normalize") as timer:
+                    chunk = [self._normalize_data(row) for row in rows]
+                    timer.rows = len(chunk)
+                yield chunk, offset
+
+    def _count_stream(self) -> int:
+        source = self.fh
+        # streams are rewound to where counting started
+        seekable, position = None, 0
+        if not isinstance(source, (str, os.PathLike)):
+            if not source.seekable():
+                raise TypeError("Length of a non-seekable stream is unknown.")
+            seekable, position = source, source.tell()
+        try:
+            with open_export(source, self.block_size) as (stream, _):
+                count = sum(1 for _ in _record_offsets(stream))
+        finally:
+            if seekable is not None:
+                seekable.seek(position)
+        return max(count - 1, 0)
 
     def _normalize_data(self, row):
         bibNo = self._normalize_sierraNo(row.bibNo)
@@ -64,8 +773,12 @@ class SierraExportReader(object):
         orderDate = self._normalize_date(row.orderDate)
         copies = self._normalize_copies(row.copies)
         title = self._normalize_title(row.title)
-        author = self._normalize_desc(row.author)
+        author = self._normalize_author(row.author)
         subjects = self._normalize_subjects(row.subjects)
+        if self.compact:
+            return Record(
+                author, bibNo, catDate, orderDate, orderNo, copies, subjects, title
+            )
         record = dict(
             author=author,
             bibNo=bibNo,
@@ -82,19 +795,14 @@ class SierraExportReader(object):
         try:
             return int(value)
         except (TypeError, ValueError):
-            mlogger.debug(f"Unable to parse quantity from value '{value}'")
+            mlogger.debug("Unable to parse quantity from value %r", value)
             return None
 
     def _normalize_sierraNo(self, value):
         return value[1:-1]
 
     def _normalize_date(self, value):
-        try:
-            date = datetime.strptime(value, "%m-%d-%Y")
-            return date
-        except ValueError:
-            mlogger.debug(f"Unable to parse date from value '{value}'")
-            return None
+        return parse_date(value)
 
     def _normalize_subjects(self, value):
         subs = [s for s in value.split("~") if "fast" not in s]
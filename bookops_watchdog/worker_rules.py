@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module evaluates QC conflict rules against bibs and orders in the datastore
+"""
+
+from collections import namedtuple
+from datetime import datetime
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import and_, case, exists, literal, or_, select, true, union, update
+from sqlalchemy.dialects.sqlite import insert
+
+from bookops_watchdog.datastore import Bib, Conflict, FileChange, Order, Ticket
+
+mlogger = logging.getLogger("bookops-watchdog")
+
+
+# condition is an SQL expression over Bib and Order columns that is true
+# for order/bib pairs in conflict; optional dependents is a callable that
+# takes a select of changed bib wids and returns a select of other bib wids
+# whose conflict status may change with them (for example duplicates)
+Rule = namedtuple(
+    "Rule",
+    ["code", "tier", "description", "condition", "dependents"],
+    defaults=(None,),
+)
+
+
+DEFAULT_RULES = [
+    Rule(
+        code="BIB001",
+        tier="error",
+        description="Bib has no cataloging date.",
+        condition=Bib.catDate.is_(None),
+    ),
+    Rule(
+        code="BIB002",
+        tier="warning",
+        description="Bib has no subject headings.",
+        condition=or_(Bib.subjects.is_(None), Bib.subjects == ""),
+    ),
+    Rule(
+        code="ORD001",
+        tier="warning",
+        description="Order has no copies.",
+        condition=Order.copies == 0,
+    ),
+    Rule(
+        code="ORD002",
+        tier="warning",
+        description="Bib cataloged before its order was created.",
+        condition=and_(
+            Bib.catDate.isnot(None),
+            Order.orderDate.isnot(None),
+            Bib.catDate < Order.orderDate,
+        ),
+    ),
+]
+
+
+def get_conflict_wids(session, rules: Iterable[Rule]) -> Dict[str, int]:
+    """
+    Returns datastore wids of rules' conflicts, adds missing ones
+
+    Args:
+        session:                db session
+        rules:                  conflict rules
+
+    Returns:
+        dictionary of conflict code and wid
+    """
+    rules = list(rules)
+    codes = [rule.code for rule in rules]
+    conflicts = {
+        c.code: c for c in session.query(Conflict).filter(Conflict.code.in_(codes))
+    }
+    for rule in rules:
+        if rule.code not in conflicts:
+            conflict = Conflict(
+                code=rule.code, tier=rule.tier, description=rule.description
+            )
+            session.add(conflict)
+            conflicts[rule.code] = conflict
+    session.flush()
+    return {code: conflict.wid for code, conflict in conflicts.items()}
+
+
+def changed_bibs(file_wids: Iterable[int]):
+    """
+    Returns select statement of bib wids included in the change sets of
+    given files
+
+    Args:
+        file_wids:              datastore wids of File
+
+    Returns:
+        sqlalchemy select
+    """
+    return select(FileChange.bib_wid).where(FileChange.file_wid.in_(list(file_wids)))
+
+
+def _scope(rule: Rule, bib_wids):
+    # bibs re-evaluated in incremental mode: changed ones and their dependents
+    if rule.dependents is None:
+        return bib_wids
+    return union(bib_wids, rule.dependents(bib_wids))
+
+
+def rule_matches(rule: Rule, library_wid: Optional[int] = None, bib_wids=None):
+    """
+    Returns select statement of (order_wid, bib_wid, copies) in conflict
+    with a rule
+
+    Args:
+        rule:                   conflict rule
+        library_wid:            limits evaluation to bibs of the library
+        bib_wids:               select of bib wids limiting evaluation to these
+                                bibs and their dependents declared by the rule
+
+    Returns:
+        sqlalchemy select
+    """
+    stmt = (
+        select(Order.wid, Order.bib_wid, Order.copies)
+        .join(Bib, Bib.wid == Order.bib_wid)
+        .where(rule.condition)
+    )
+    if library_wid is not None:
+        stmt = stmt.where(Bib.library_wid == library_wid)
+    if bib_wids is not None:
+        stmt = stmt.where(Bib.wid.in_(_scope(rule, bib_wids)))
+    return stmt
+
+
+def upsert_tickets(session, conflict_wid: int, matches, timestamp: datetime) -> int:
+    """
+    Writes tickets for order/bib pairs in conflict in a single statement.
+    Open unreported tickets get their copies and timestamp updated, closed
+    tickets are reopened, and open reported tickets are left untouched.
+
+    Args:
+        session:                db session
+        conflict_wid:           datastore wid of the Conflict
+        matches:                select of (order_wid, bib_wid, copies)
+        timestamp:              time of evaluation
+
+    Returns:
+        number of inserted or updated tickets
+    """
+    matches = matches.subquery()
+    # 'WHERE true' keeps SQLite from parsing ON CONFLICT as a join constraint
+    stmt = insert(Ticket.__table__).from_select(
+        ["conflict_wid", "order_wid", "bib_wid", "copies", "timestamp", "reported"],
+        select(
+            literal(conflict_wid),
+            matches.c.wid,
+            matches.c.bib_wid,
+            matches.c.copies,
+            literal(timestamp),
+            literal(False),
+        ).where(true()),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["conflict_wid", "order_wid", "bib_wid"],
+        set_=dict(
+            copies=stmt.excluded.copies,
+            timestamp=stmt.excluded.timestamp,
+            reported=case((Ticket.closed, False), else_=Ticket.reported),
+            closed=False,
+        ),
+        where=or_(Ticket.reported.is_(False), Ticket.closed),
+    )
+    return session.execute(stmt).rowcount
+
+
+def close_resolved_tickets(
+    session,
+    rule: Rule,
+    conflict_wid: int,
+    library_wid: Optional[int] = None,
+    bib_wids=None,
+) -> int:
+    """
+    Closes open tickets of the rule's conflict whose order/bib pair is no
+    longer in conflict. Only tickets of evaluated bibs, and tickets of their
+    orders left on another bib, are considered.
+
+    Args:
+        session:                db session
+        rule:                   conflict rule
+        conflict_wid:           datastore wid of the rule's Conflict
+        library_wid:            limits closing to bibs of the library
+        bib_wids:               select of bib wids limiting closing to these
+                                bibs and their dependents declared by the rule
+
+    Returns:
+        number of closed tickets
+    """
+    still_matching = rule_matches(rule).where(
+        Order.wid == Ticket.order_wid, Order.bib_wid == Ticket.bib_wid
+    )
+    stmt = (
+        update(Ticket)
+        .where(
+            Ticket.conflict_wid == conflict_wid,
+            Ticket.closed.is_(False),
+            ~exists(still_matching),
+        )
+        .values(closed=True)
+        .execution_options(synchronize_session=False)
+    )
+    if library_wid is not None:
+        stmt = stmt.where(
+            Ticket.bib_wid.in_(select(Bib.wid).where(Bib.library_wid == library_wid))
+        )
+    if bib_wids is not None:
+        # an order moved to a changed bib leaves its ticket on the old bib
+        moved_orders = select(Order.wid).where(Order.bib_wid.in_(bib_wids))
+        stmt = stmt.where(
+            or_(
+                Ticket.bib_wid.in_(_scope(rule, bib_wids)),
+                Ticket.order_wid.in_(moved_orders),
+            )
+        )
+    return session.execute(stmt).rowcount
+
+
+def evaluate_rules(
+    session,
+    rules: Optional[List[Rule]] = None,
+    library_wid: Optional[int] = None,
+    bib_wids=None,
+) -> Dict[str, int]:
+    """
+    Evaluates conflict rules as set-based queries. Tickets are upserted for
+    each order/bib pair in conflict and open tickets of pairs no longer in
+    conflict are closed. Without bib_wids all bibs are audited.
+
+    Args:
+        session:                db session
+        rules:                  conflict rules, defaults to DEFAULT_RULES
+        library_wid:            limits evaluation to bibs of the library
+        bib_wids:               select of bib wids limiting evaluation
+
+    Returns:
+        dictionary of conflict code and number of inserted or updated tickets
+    """
+    if rules is None:
+        rules = DEFAULT_RULES
+    conflict_wids = get_conflict_wids(session, rules)
+    timestamp = datetime.now()
+
+    counts = dict()
+    for rule in rules:
+        conflict_wid = conflict_wids[rule.code]
+        matches = rule_matches(rule, library_wid, bib_wids)
+        counts[rule.code] = upsert_tickets(session, conflict_wid, matches, timestamp)
+        closed = close_resolved_tickets(
+            session, rule, conflict_wid, library_wid, bib_wids
+        )
+        mlogger.debug(
+            "Rule %s wrote %s and closed %s ticket(s).",
+            rule.code,
+            counts[rule.code],
+            closed,
+        )
+    return counts
+
+
+def evaluate_file_changes(
+    session, file_wids: Iterable[int], rules: Optional[List[Rule]] = None
+) -> Dict[str, int]:
+    """
+    Evaluates conflict rules only for bibs included in given files (and their
+    dependents declared by rules)
+
+    Args:
+        session:                db session
+        file_wids:              datastore wids of File
+        rules:                  conflict rules, defaults to DEFAULT_RULES
+
+    Returns:
+        dictionary of conflict code and number of inserted or updated tickets
+    """
+    return evaluate_rules(session, rules, bib_wids=changed_bibs(file_wids))
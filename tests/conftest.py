@@ -3,7 +3,7 @@
 import pytest
 
 
-# from bookops_watchdog.worker_reports import SierraExportReader
+from bookops_watchdog.worker_reports import SierraExportReader
 from bookops_watchdog.datastore import dal
 
 
@@ -13,13 +13,8 @@ def fake_yaml_data():
 
 
 @pytest.fixture
-def mock_all_env_variables(monkeypatch):
-    monkeypatch.setenv("USERPROFILE", "C:\\Users\\Foo")
-    monkeypatch.setenv("LOCALAPPDATA", "C:\\Users\\Foo\\APPDATA\\LOCAL")
-    monkeypatch.setenv(
-        "watchdog_store",
-        "C:\\Users\\Foo\\APPDATA\\TEMP\\Bookops-Watchdog\\datastore.db",
-    )
+def ser():
+    return SierraExportReader("tests/sierra_export_bpl_sample.txt")
 
 
 @pytest.fixture
@@ -46,16 +41,11 @@ def mock_app_data_dir(tmpdir):
     return tmpdir.mkdir("Bookops-Watchog")
 
 
-@pytest.fixture
-def mock_datastore_file(mock_app_data_dir, monkeypatch):
-    store_fh = mock_app_data_dir.join("datastore.db")
-    monkeypatch.setenv("watchdog_store", str(store_fh))
-
-
 @pytest.fixture
 def mock_datastore_session():
     # setUp
     dal.conn = "sqlite:///:memory:"
+    dal.dispose()
     dal.connect()
     session = dal.Session()
     yield session
@@ -63,3 +53,4 @@ def mock_datastore_session():
     # tearDown
     session.rollback()
     session.close()
+    dal.dispose()
@@ -3,14 +3,459 @@
 """
 Test app.py module
 """
+
 import argparse
+import json
+import logging
+import os
+from shutil import copyfile
+import subprocess
+import sys
+import threading
+import time
 
+import pytest
 
 from bookops_watchdog.app import (
+    Watcher,
     createArgParser,
+    process_export,
+    process_library,
+    run,
+    watch,
+)
+from bookops_watchdog.config import build_config, validate_config_settings
+from bookops_watchdog.datastore import (
+    Bib,
+    DataAccessLayer,
+    DatastoreWriter,
+    File,
+    FileChange,
+    Order,
+    Ticket,
+    dal,
+    session_scope,
 )
+from bookops_watchdog.metrics import metrics
+from bookops_watchdog.worker_datastore import find_unprocessed_handles
+from bookops_watchdog.worker_drive import StagingCache
+from bookops_watchdog.worker_reports import SierraExportReader
+
+EXPORT = "BookOpsQCb.20210801603001"
+
+
+@pytest.fixture
+def mock_drive(tmpdir):
+    root = tmpdir.mkdir("BookOpsWatchdog")
+    root.mkdir("NYPL")
+    return root.mkdir("BPL")
+
+
+@pytest.fixture
+def mock_config(mock_drive, mock_app_data_dir):
+    settings = validate_config_settings(
+        dict(
+            loggly_token="spam", log_handlers=["file"], drive=str(mock_drive.dirpath())
+        )
+    )
+    return build_config("dev", str(mock_app_data_dir), settings)
+
+
+@pytest.fixture
+def mock_store(mock_app_data_dir, monkeypatch):
+    store_fh = mock_app_data_dir.join("datastore.db")
+    monkeypatch.setattr(dal, "conn", f"sqlite:///{store_fh}")
+
+
+def add_export(directory, handle=EXPORT, old=True):
+    dst = os.path.join(directory, handle)
+    copyfile("tests/sierra_export_bpl_sample.txt", dst)
+    if old:
+        os.utime(dst, (0, 0))
+    return dst
 
 
 def test_createArgParser_correct_obj_returned():
     parser = createArgParser()
     assert type(parser) == argparse.ArgumentParser
+
+
+def test_createArgParser_defaults():
+    args = createArgParser().parse_args(["--env", "dev"])
+    assert args.watch is False
+    assert args.interval == 30.0
+    assert args.debounce == 10.0
+
+
+def test_createArgParser_watch_mode():
+    args = createArgParser().parse_args(
+        ["--env", "prod", "--watch", "--interval", "5", "--debounce", "2.5"]
+    )
+    assert args.watch is True
+    assert args.interval == 5.0
+    assert args.debounce == 2.5
+
+
+def test_process_export(mock_drive, mock_store, mock_config):
+    add_export(mock_drive)
+    process_export("bpl", EXPORT, mock_config.drive)
+    process_export("bpl", EXPORT, mock_config.drive)
+    with session_scope() as s:
+        assert s.query(File).filter_by(handle=EXPORT).count() == 1
+        assert s.query(Bib).count() == 4
+        assert s.query(FileChange).count() == 5
+        # sample export has no conflicts
+        assert s.query(Ticket).count() == 0
+
+
+def test_process_export_resumes_interrupted_ingest(
+    mock_drive, mock_store, monkeypatch, mocker, mock_config
+):
+    monkeypatch.setattr("bookops_watchdog.worker_datastore.CHECKPOINT_ROWS", 2)
+    add_export(mock_drive)
+    mocker.patch(
+        "bookops_watchdog.worker_rules.evaluate_file_changes", side_effect=RuntimeError
+    )
+    with pytest.raises(RuntimeError):
+        process_export("bpl", EXPORT, mock_config.drive)
+    with session_scope() as s:
+        file = s.query(File).filter_by(handle=EXPORT).one()
+        assert (file.checkpoint_row, file.completed) == (5, False)
+        assert find_unprocessed_handles(s, file.library_wid, [EXPORT]) == [EXPORT]
+
+    mocker.patch("bookops_watchdog.worker_rules.evaluate_file_changes", return_value={})
+    spy = mocker.spy(SierraExportReader, "_normalize_data")
+    process_export("bpl", EXPORT, mock_config.drive)
+    assert spy.call_count == 0
+    with session_scope() as s:
+        file = s.query(File).filter_by(handle=EXPORT).one()
+        assert file.completed is True
+        assert s.query(Bib).count() == 4
+
+
+def test_process_export_closes_ticket_of_corrected_order(
+    mock_drive, mock_store, mock_config
+):
+    # first export has an order without copies, next one corrects it
+    with open("tests/sierra_export_bpl_sample.txt") as src:
+        lines = src.readlines()
+    lines[1] = lines[1].replace("^10^^o", "^0^^o")
+    with open(os.path.join(mock_drive, "BookOpsQCb.20210701603001"), "w") as dst:
+        dst.writelines(lines)
+    process_export("bpl", "BookOpsQCb.20210701603001", mock_config.drive)
+    with session_scope() as s:
+        ticket = s.query(Ticket).filter_by(order_wid=2005302).one()
+        assert ticket.closed is False
+
+    add_export(mock_drive)
+    process_export("bpl", EXPORT, mock_config.drive)
+    with session_scope() as s:
+        assert s.query(Order).filter_by(wid=2005302).one().copies == 10
+        ticket = s.query(Ticket).filter_by(order_wid=2005302).one()
+        assert ticket.closed is True
+
+
+def test_process_export_restarts_ingest_of_changed_export(
+    mock_drive, mock_store, monkeypatch, mocker, mock_config
+):
+    monkeypatch.setattr("bookops_watchdog.worker_datastore.CHECKPOINT_ROWS", 2)
+    fh = add_export(mock_drive)
+    mocker.patch(
+        "bookops_watchdog.worker_rules.evaluate_file_changes", side_effect=RuntimeError
+    )
+    with pytest.raises(RuntimeError):
+        process_export("bpl", EXPORT, mock_config.drive)
+
+    # delivered again without its first row
+    with open(fh) as f:
+        lines = f.readlines()
+    with open(fh, "w") as f:
+        f.writelines(lines[:1] + lines[2:])
+    mocker.patch("bookops_watchdog.worker_rules.evaluate_file_changes", return_value={})
+    spy = mocker.spy(SierraExportReader, "iter_chunks")
+    process_export("bpl", EXPORT, mock_config.drive)
+    assert spy.call_args.args[2] == 0
+    with session_scope() as s:
+        file = s.query(File).filter_by(handle=EXPORT).one()
+        assert (file.checkpoint_row, file.completed) == (4, True)
+        assert file.source_size == os.path.getsize(fh)
+
+
+def test_process_export_from_staging_cache(mock_drive, mock_store, tmpdir, mock_config):
+    staging = StagingCache(str(tmpdir.join("staging")))
+    add_export(mock_drive)
+    process_export("bpl", EXPORT, mock_config.drive, staging)
+    assert len(staging.sources) == 1
+    with session_scope() as s:
+        assert s.query(Bib).count() == 4
+
+
+def test_createArgParser_audit():
+    assert createArgParser().parse_args(["--env", "dev"]).audit is False
+    assert createArgParser().parse_args(["--env", "dev", "--audit"]).audit is True
+
+
+def test_run_full_audit(mock_drive, mock_store, mocker, mock_config):
+    mock_rules = mocker.patch(
+        "bookops_watchdog.worker_rules.evaluate_rules", return_value={}
+    )
+
+    def audits():
+        # incremental evaluation is limited to bibs of processed exports
+        return [c for c in mock_rules.call_args_list if "bib_wids" not in c.kwargs]
+
+    add_export(mock_drive)
+    run(mock_config)
+    assert mock_rules.call_count == 1
+    assert audits() == []
+    run(mock_config, full_audit=True)
+    assert len(audits()) == 1
+
+
+def test_watcher_reconcile_processes_old_exports(mock_drive, mock_store, mock_config):
+    add_export(mock_drive)
+    watcher = Watcher(mock_config)
+    watcher.reconcile()
+    assert watcher.ready() == [("bpl", EXPORT)]
+    watcher.process_ready()
+    assert watcher.pending == {}
+    with session_scope() as s:
+        assert s.query(File).count() == 1
+
+
+def test_watcher_debounces_fresh_exports(mock_drive, mock_store, mock_config):
+    watcher = Watcher(mock_config, debounce=60)
+    watcher.reconcile()
+    add_export(mock_drive, old=False)
+    watcher.poll()
+    assert list(watcher.pending) == [("bpl", EXPORT)]
+    assert watcher.ready() == []
+    assert 0 < watcher.next_timeout(interval=120) <= 60
+    watcher.process_ready()
+    with session_scope() as s:
+        assert s.query(File).count() == 0
+
+
+def test_run_waits_for_fresh_exports(mock_drive, mock_store, mock_config):
+    add_export(mock_drive, old=False)
+    start = time.monotonic()
+    run(mock_config, debounce=0.5)
+    assert time.monotonic() - start >= 0.5
+    with session_scope() as s:
+        assert s.query(File).filter_by(completed=True).count() == 1
+
+
+def test_watcher_settle_waits_for_changed_exports(
+    mock_drive, mock_store, mocker, mock_config
+):
+    watcher = Watcher(mock_config, debounce=0.3)
+    watcher.reconcile()
+    fh = add_export(mock_drive, old=False)
+    watcher.poll()
+    sleep = time.sleep
+
+    def modify_once(delay):
+        sleep(delay)
+        if sleep_mock.call_count == 1:
+            with open(fh, "a") as f:
+                f.write("\n")
+
+    sleep_mock = mocker.patch(
+        "bookops_watchdog.app.time.sleep", side_effect=modify_once
+    )
+    watcher.settle()
+    assert sleep_mock.call_count == 2
+    assert watcher.ready() == [("bpl", EXPORT)]
+
+
+def test_watcher_next_timeout_without_pending(mock_config):
+    watcher = Watcher(mock_config)
+    assert watcher.next_timeout(interval=15) == 15
+
+
+def test_watcher_survives_processing_errors(
+    mock_drive, mock_store, mocker, mock_config
+):
+    add_export(mock_drive)
+    mocker.patch("bookops_watchdog.app.process_export", side_effect=ValueError)
+    watcher = Watcher(mock_config)
+    watcher.reconcile()
+    watcher.process_ready()
+    assert list(watcher.pending) == [("bpl", EXPORT)]
+    assert watcher.failures == {("bpl", EXPORT): 1}
+
+
+def test_watcher_retries_failed_exports_with_backoff(
+    mock_drive, mock_store, monkeypatch, mocker, mock_config
+):
+    monkeypatch.setattr("bookops_watchdog.app.RETRY_DELAY", 0.2)
+    add_export(mock_drive)
+    process = mocker.patch(
+        "bookops_watchdog.app.process_export", side_effect=[ValueError, ValueError]
+    )
+    watcher = Watcher(mock_config, debounce=0)
+    watcher.reconcile()
+    watcher.process_ready()
+    assert watcher.ready() == []
+    assert 0 < watcher.next_timeout(30) <= 0.2
+
+    time.sleep(0.2)
+    watcher.process_ready()
+    assert watcher.failures == {("bpl", EXPORT): 2}
+    assert 0.2 < watcher.next_timeout(30) <= 0.4
+
+    time.sleep(0.4)
+    process.side_effect = None
+    watcher.process_ready()
+    assert process.call_count == 3
+    assert watcher.pending == {}
+    assert watcher.failures == {}
+
+
+def test_watcher_drops_failed_export_removed_from_drive(
+    mock_drive, mock_store, mocker, mock_config
+):
+    fh = add_export(mock_drive)
+    mocker.patch("bookops_watchdog.app.process_export", side_effect=ValueError)
+    watcher = Watcher(mock_config)
+    watcher.reconcile()
+    os.remove(fh)
+    watcher.process_ready()
+    assert watcher.pending == {}
+    assert watcher.failures == {}
+
+
+def test_watch_processes_new_exports_and_stops(mock_drive, mock_store, mock_config):
+    stop_event = threading.Event()
+    watcher = Watcher(mock_config, debounce=0)
+    watcher.reconcile()
+    thread = threading.Thread(target=watch, args=(watcher, stop_event, 0.05))
+    thread.start()
+    try:
+        add_export(mock_drive)
+        for _ in range(100):
+            with session_scope() as s:
+                if s.query(File).count():
+                    break
+            threading.Event().wait(0.05)
+    finally:
+        stop_event.set()
+        thread.join(timeout=5)
+    assert not thread.is_alive()
+    with session_scope() as s:
+        assert s.query(File).filter_by(handle=EXPORT).count() == 1
+
+
+def test_processing_many_exports_opens_one_engine(mock_drive, mock_store, mock_config):
+    for day in range(1, 6):
+        add_export(mock_drive, handle=f"BookOpsQCb.202108{day:02d}603001")
+    watcher = Watcher(mock_config)
+    watcher.store.connect()
+    engines = watcher.store.engines_created
+    connections = watcher.store.connections_created
+    watcher.reconcile()
+    watcher.process_ready()
+    with session_scope() as s:
+        assert s.query(File).count() == 5
+    assert watcher.store.engines_created == engines
+    assert watcher.store.connections_created == connections
+
+
+def test_process_library_reports_timing(mock_drive, mock_store, caplog, mock_config):
+    caplog.set_level(logging.INFO, logger="bookops-watchdog")
+    add_export(mock_drive)
+    with DatastoreWriter() as writer:
+        stats = process_library(
+            "bpl", [EXPORT, "BookOpsQCb.20210802603001"], writer, mock_config.drive
+        )
+    assert (stats["exports"], stats["rows"]) == (1, 5)
+    assert 0 < stats["parse"] < stats["seconds"]
+    assert 0 < stats["write"] < stats["seconds"]
+    assert "Unable to process export BookOpsQCb.20210802603001" in caplog.text
+    assert "BPL pipeline processed 1 export(s), 5 row(s)" in caplog.text
+
+
+def test_watcher_runs_library_pipelines_concurrently(
+    mock_drive, mock_store, tmpdir, mocker, mock_config
+):
+    add_export(mock_drive)
+    add_export(mock_drive.dirpath("NYPL"), handle="BookOpsQCn.20210801603001")
+    barrier = threading.Barrier(2, timeout=5)
+    stage = StagingCache(str(tmpdir.join("staging")))
+    stage_export = stage.stage
+
+    def wait_for_other_library(fh):
+        # fails unless both pipelines reach staging at the same time
+        barrier.wait()
+        return stage_export(fh)
+
+    mocker.patch.object(stage, "stage", side_effect=wait_for_other_library)
+    watcher = Watcher(mock_config, staging=stage)
+    watcher.reconcile()
+    timing = watcher.process_ready()
+    assert sorted(timing) == ["bpl", "nypl"]
+    assert [t["exports"] for t in timing.values()] == [1, 1]
+    with session_scope() as s:
+        assert s.query(File).filter_by(completed=True).count() == 2
+
+
+def test_run_reports_metrics(mock_drive, mock_store, mock_config, monkeypatch):
+    metrics_fh = mock_config.metrics_fh
+    monkeypatch.setattr(metrics, "enabled", False)
+    add_export(mock_drive)
+    run(mock_config._replace(metrics=True))
+    with open(metrics_fh) as f:
+        summary = json.loads(f.readlines()[-1])
+    for stage in (
+        "drive.list",
+        "datastore.find_unprocessed",
+        "reader.parse",
+        "reader.normalize",
+        "datastore.ingest",
+        "datastore.commit",
+    ):
+        assert stage in summary["stages"]
+    assert summary["stages"]["datastore.ingest"]["rows"] == 5
+    assert summary["counters"]["drive.files"] == 1
+
+
+def test_run_without_metrics(mock_drive, mock_store, mock_config, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    add_export(mock_drive)
+    run(mock_config)
+    assert not os.path.exists(mock_config.metrics_fh)
+
+
+def test_run_with_config(mock_drive, mock_config, mock_app_data_dir, monkeypatch):
+    # run uses the configured datastore, not the module's dal
+    monkeypatch.setattr(dal, "conn", None)
+    monkeypatch.setattr(metrics, "enabled", False)
+    add_export(mock_drive)
+    run(mock_config._replace(metrics=True))
+    assert dal.conn is None
+    store = DataAccessLayer(f"sqlite:///{mock_config.datastore_fh}")
+    with session_scope(store) as s:
+        assert s.query(File).filter_by(completed=True).count() == 1
+    store.dispose()
+    assert mock_app_data_dir.join("drive_index.json").exists()
+    assert mock_app_data_dir.join("metrics.jsonl").exists()
+
+
+def test_createArgParser_profile():
+    assert createArgParser().parse_args(["--env", "dev"]).profile is None
+    args = createArgParser().parse_args(["--env", "dev", "--profile", "mem"])
+    assert args.profile == "mem"
+    with pytest.raises(SystemExit):
+        createArgParser().parse_args(["--env", "dev", "--profile", "io"])
+
+
+def test_app_import_defers_heavy_dependencies():
+    code = (
+        "import sys, bookops_watchdog.app; "
+        "print(sorted({m.split('.')[0] for m in sys.modules} & "
+        "{'sqlalchemy', 'requests', 'urllib3', 'yaml', 'loggly', 'pymarc'}))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert out.stdout.strip() == "[]"
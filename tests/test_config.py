@@ -4,16 +4,25 @@ from unittest import mock
 import pytest
 
 from bookops_watchdog.config import (
-    add_environ_variables,
+    CONFIG_CACHE_VERSION,
+    Config,
+    build_config,
     configure_app,
     construct_config_path,
     get_app_data_dir,
+    get_config_cache_fh,
     get_config_settings,
     get_datastore_fh,
+    get_drive_index_fh,
     get_log_fh,
+    get_metrics_fh,
+    get_staging_dir,
+    load_config,
     watchdog_logging_config,
+    validate_config_settings,
     validate_directory,
 )
+from bookops_watchdog.errors import WatchdogError
 
 
 @pytest.mark.parametrize(
@@ -37,12 +46,6 @@ def test_get_config_settings(mock_user):
         )
 
 
-def test_add_environ_variables():
-    add_environ_variables(foo="bar", spam="baz")
-    assert os.getenv("foo") == "bar"
-    assert os.getenv("spam") == "baz"
-
-
 @pytest.mark.parametrize(
     "arg,expectation",
     [
@@ -76,11 +79,14 @@ def test_get_app_data_dir(arg, expectation, mock_user):
     ],
 )
 def test_configure_app_returns(
-    arg, expectation, fake_yaml_data, mock_user, mock_app_data_directory
+    arg, expectation, fake_yaml_data, mock_user, mock_app_data_directory, mocker
 ):
+    mocker.patch("logging.config.dictConfig")
     mock_open = mock.mock_open(read_data=fake_yaml_data)
     with mock.patch("builtins.open", mock_open):
-        assert configure_app(arg) == expectation
+        config = configure_app(arg)
+    assert isinstance(config, Config)
+    assert (config.log_fh, config.log_token, list(config.log_handlers)) == expectation
 
 
 @pytest.mark.parametrize(
@@ -98,25 +104,54 @@ def test_configure_app_returns(
         ),
     ],
 )
-def test_configure_app_adding_env_variables(
+def test_configure_app_settings(
     arg,
     exp1,
     exp2,
     fake_yaml_data,
     mock_user,
     mock_app_data_directory,
+    monkeypatch,
+    mocker,
 ):
+    monkeypatch.delenv("watchdog_store", raising=False)
+    dict_config = mocker.patch("logging.config.dictConfig")
     mock_open = mock.mock_open(read_data=fake_yaml_data)
     with mock.patch("builtins.open", mock_open):
-        configure_app(arg)
-        assert os.getenv("watchdog_store") == exp1
-        assert os.getenv("watchdog_drive") == exp2
+        config = configure_app(arg)
+    assert config.datastore_fh == exp1
+    assert config.drive == exp2
+    assert config.sendgrid_key == ""
+    assert config.email_recipients == {}
+    assert dict_config.call_args.args[0]["handlers"]["file"]["filename"] == (
+        config.log_fh
+    )
+    # settings are not passed through env variables
+    assert os.getenv("watchdog_store") is None
+
+
+def test_get_config_cache_fh():
+    assert get_config_cache_fh("C:\\Foo") == os.path.join(
+        "C:\\Foo", "config_cache.json"
+    )
 
 
 def test_get_datastore_fh():
     assert get_datastore_fh("C:\\Foo") == "C:\\Foo\\datastore.db"
 
 
+def test_get_drive_index_fh():
+    assert get_drive_index_fh("C:\\Foo") == os.path.join("C:\\Foo", "drive_index.json")
+
+
+def test_get_staging_dir():
+    assert get_staging_dir("C:\\Foo") == os.path.join("C:\\Foo", "staging")
+
+
+def test_get_metrics_fh():
+    assert get_metrics_fh("C:\\Foo") == os.path.join("C:\\Foo", "metrics.jsonl")
+
+
 def test_get_log_fh():
     assert get_log_fh("C:\\Foo") == "C:\\Foo\\watchdog.log"
 
@@ -148,7 +183,7 @@ def test_watchdog_logging_config_log_token():
         watchdog_logging_config(log_fh="foo.log", log_token="bar", handlers=[])[
             "handlers"
         ]["loggly"]["url"]
-        == "https://logs-01.loggly.com/inputs/bar/tag/python"
+        == "https://logs-01.loggly.com/bulk/bar/tag/python"
     )
 
 
@@ -164,3 +199,131 @@ def test_validate_directory(tmpdir):
     assert not os.path.isdir(data_dir)
     validate_directory(data_dir)
     assert os.path.isdir(data_dir)
+
+
+@pytest.fixture
+def config_files(tmpdir, fake_yaml_data, monkeypatch):
+    config_fh = tmpdir.join("config_variables_dev.yaml")
+    config_fh.write(fake_yaml_data)
+    data_dir = tmpdir.join("Bookops-Watchdog")
+    monkeypatch.setattr(
+        "bookops_watchdog.config.construct_config_path", lambda env: str(config_fh)
+    )
+    monkeypatch.setattr(
+        "bookops_watchdog.config.get_app_data_dir", lambda env: str(data_dir)
+    )
+    return config_fh, data_dir
+
+
+def test_load_config(config_files):
+    config_fh, data_dir = config_files
+    config = load_config("dev")
+    assert config.drive == "S:/BookopsWatchdog"
+    assert config.log_token == "spam"
+    assert config.log_handlers == ("console", "file")
+    assert config.datastore_fh == os.path.join(str(data_dir), "datastore.db")
+    assert config.datastore_profile == "performance"
+    assert config.email_recipients == {}
+    assert config.metrics is False
+    with pytest.raises(AttributeError):
+        config.drive = "foo"
+    cached = data_dir.join("config_cache.json").read()
+    assert f'"version": {CONFIG_CACHE_VERSION}' in cached
+
+
+def test_load_config_uses_cache(config_files, mocker):
+    load_config("dev")
+    parse = mocker.patch("bookops_watchdog.config.get_config_settings")
+    assert load_config("dev").drive == "S:/BookopsWatchdog"
+    assert parse.call_count == 0
+
+
+def test_load_config_rebuilds_cache_when_file_changes(config_files, mocker):
+    config_fh, _ = config_files
+    load_config("dev")
+    config_fh.write('---\nloggly_token: "spam"\nlog_handlers: [file]\ndrive: "T:/"')
+    os.utime(str(config_fh), ns=(0, 0))
+    assert load_config("dev").drive == "T:/"
+    assert load_config("dev").log_handlers == ("file",)
+
+
+def test_load_config_ignores_corrupted_cache(config_files):
+    _, data_dir = config_files
+    load_config("dev")
+    data_dir.join("config_cache.json").write("{")
+    assert load_config("dev").drive == "S:/BookopsWatchdog"
+
+
+def test_load_config_invalid_file_is_not_cached(config_files):
+    config_fh, data_dir = config_files
+    config_fh.write('---\nloggly_token: "spam"\nlog_handlers: [file]')
+    with pytest.raises(WatchdogError):
+        load_config("dev")
+    assert not data_dir.join("config_cache.json").exists()
+
+
+@pytest.mark.parametrize(
+    "arg",
+    [
+        None,
+        dict(log_handlers=["file"], drive="S:/"),
+        dict(loggly_token="spam", log_handlers=["email"], drive="S:/"),
+        dict(loggly_token="spam", log_handlers=["file"], drive=1),
+        dict(loggly_token="spam", log_handlers=["file"], drive="S:/", metrics="yes"),
+        dict(
+            loggly_token="spam",
+            log_handlers=["file"],
+            drive="S:/",
+            staging_cache_size=True,
+        ),
+        dict(
+            loggly_token="spam",
+            log_handlers=["file"],
+            drive="S:/",
+            email_recipients=dict(bpl="foo@bar.org"),
+        ),
+        dict(
+            loggly_token="spam",
+            log_handlers=["file"],
+            drive="S:/",
+            datastore_profile="fast",
+        ),
+    ],
+)
+def test_validate_config_settings_invalid(arg):
+    with pytest.raises(WatchdogError):
+        validate_config_settings(arg)
+
+
+def test_validate_config_settings_defaults():
+    conf = validate_config_settings(
+        dict(loggly_token="spam", log_handlers=["file"], drive="S:/", log_fh="foo")
+    )
+    assert conf == dict(
+        loggly_token="spam",
+        log_handlers=["file"],
+        drive="S:/",
+        datastore_profile="performance",
+        staging_cache_size=None,
+        sendGrid_key="",
+        email_sender="",
+        email_recipients={},
+        metrics=False,
+    )
+
+
+def test_build_config_read_only_recipients():
+    conf = validate_config_settings(
+        dict(
+            loggly_token="spam",
+            log_handlers=["file"],
+            drive="S:/",
+            email_recipients=dict(bpl=dict(error=["foo@bar.org"], warning=None)),
+        )
+    )
+    config = build_config("dev", "C:/Foo", conf)
+    assert config.email_recipients == dict(bpl=dict(error=("foo@bar.org",), warning=()))
+    with pytest.raises(TypeError):
+        config.email_recipients["nypl"] = dict()
+    with pytest.raises(TypeError):
+        config.email_recipients["bpl"]["error"] = ["spam@bar.org"]
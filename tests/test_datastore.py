@@ -1,18 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
+import threading
 
 import pytest
+from sqlalchemy import create_engine, inspect
 
 from bookops_watchdog.datastore import (
     Bib,
     Conflict,
     DataAccessLayer,
+    DatastoreWriter,
     File,
+    FileChange,
     Library,
     Order,
     Ticket,
+    dal,
     session_scope,
 )
+from bookops_watchdog.errors import WatchdogError
 
 
 def test_bib_tbl_repr():
@@ -54,11 +60,11 @@ def test_conflict_tbl_repr():
     )
 
 
-def test_DataAccessLayer_evn_var_conn(mock_all_env_variables):
-    assert (
-        DataAccessLayer().conn
-        == "sqlite:///C:\\Users\\Foo\\APPDATA\\TEMP\\Bookops-Watchdog\\datastore.db"
-    )
+def test_DataAccessLayer_not_configured():
+    dal = DataAccessLayer()
+    assert dal.conn is None
+    with pytest.raises(WatchdogError):
+        dal.connect()
 
 
 # def test_DataAccessLayer_test_conn():
@@ -66,10 +72,27 @@ def test_DataAccessLayer_evn_var_conn(mock_all_env_variables):
 
 
 def test_file_tbl_repr():
-    file = File(wid=1, timestamp="2021-07-01-07:01", handle="foo.txt", library_wid=1)
+    file = File(
+        wid=1,
+        timestamp="2021-07-01-07:01",
+        handle="foo.txt",
+        library_wid=1,
+        checkpoint_offset=100,
+        checkpoint_row=2,
+        completed=False,
+        source_size=200,
+        source_mtime=1,
+    )
     assert (
         str(file)
-        == "<File(wid='1', timestamp='2021-07-01-07:01', handle='foo.txt', library_wid='1')>"
+        == "<File(wid='1', timestamp='2021-07-01-07:01', handle='foo.txt', library_wid='1', checkpoint_offset='100', checkpoint_row='2', completed='False', source_size='200', source_mtime='1')>"
+    )
+
+
+def test_file_change_tbl_repr():
+    assert (
+        str(FileChange(wid=1, file_wid=2, bib_wid=3, order_wid=4))
+        == "<FileChange(wid='1', file_wid='2', bib_wid='3', order_wid='4')>"
     )
 
 
@@ -93,7 +116,8 @@ def test_order_tbl_repr():
     )
 
 
-def test_session_scope_returns_correct_obj():
+def test_session_scope_returns_correct_obj(monkeypatch):
+    monkeypatch.setattr(dal, "conn", "sqlite://")
     with session_scope() as s:
         assert str(type(s)) == "<class 'sqlalchemy.orm.session.Session'>"
 
@@ -107,8 +131,240 @@ def test_ticket_tbl_repr():
         bib_wid=4,
         copies=10,
         reported=False,
+        closed=False,
     )
     assert (
         str(issue)
-        == "<Ticket(wid='1', timestamp='2021-07-01-07:01', conflict_wid='2', order_wid='3', bib_wid='4', copies='10', reported='False')>"
+        == "<Ticket(wid='1', timestamp='2021-07-01-07:01', conflict_wid='2', order_wid='3', bib_wid='4', copies='10', reported='False', closed='False')>"
     )
+
+
+def test_DataAccessLayer_connect_reuses_engine(tmpdir):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}")
+    dal.connect()
+    engine = dal.engine
+    dal.connect()
+    assert dal.engine is engine
+    assert dal.engines_created == 1
+    dal.dispose()
+
+
+def test_DataAccessLayer_pools_file_connections(tmpdir):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}")
+    dal.connect()
+    for _ in range(5):
+        session = dal.Session()
+        session.query(Library).all()
+        session.close()
+    assert dal.connections_created == 1
+    dal.dispose()
+
+
+def test_DataAccessLayer_new_conn_creates_new_engine(tmpdir):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('foo.db')}")
+    dal.connect()
+    dal.conn = f"sqlite:///{tmpdir.join('bar.db')}"
+    assert dal.engine is None
+    dal.connect()
+    assert dal.engines_created == 2
+    assert str(dal.engine.url).endswith("bar.db")
+    dal.dispose()
+
+
+def test_DataAccessLayer_failed_schema_setup_is_retried(tmpdir, mocker):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}")
+    mocker.patch.object(
+        DataAccessLayer, "_add_missing_columns", side_effect=RuntimeError("locked")
+    )
+    with pytest.raises(RuntimeError):
+        dal.connect()
+    assert dal.engine is None
+    assert dal.Session is None
+
+    mocker.stopall()
+    with session_scope(dal) as session:
+        assert session.query(Library).count() == 0
+    assert dal.engines_created == 2
+    dal.dispose()
+
+
+def test_DataAccessLayer_dispose():
+    dal = DataAccessLayer("sqlite:///:memory:")
+    dal.connect()
+    dal.dispose()
+    assert dal.engine is None
+    assert dal.Session is None
+
+
+def test_DataAccessLayer_performance_profile_pragmas(tmpdir):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}", "performance")
+    dal.connect()
+    with dal.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+        assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == -64000
+    dal.dispose()
+
+
+def test_DataAccessLayer_default_profile_pragmas(tmpdir):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}", "default")
+    dal.connect()
+    with dal.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "delete"
+    dal.dispose()
+
+
+def test_DataAccessLayer_profile():
+    assert DataAccessLayer("sqlite://").profile == "performance"
+    assert DataAccessLayer("sqlite://", "default").profile == "default"
+
+
+@pytest.mark.parametrize(
+    "arg1,arg2",
+    [
+        ("order", "ix_order_bib_wid"),
+        ("ticket", "ix_ticket_order_wid"),
+        ("ticket", "ix_ticket_bib_wid"),
+        ("ticket", "ix_ticket_reported_bib_wid"),
+        ("ticket", "ix_ticket_conflict_order_bib"),
+        ("file", "ix_file_library_wid_handle"),
+    ],
+)
+def test_datastore_indexes(arg1, arg2, tmpdir):
+    dal = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}")
+    dal.connect()
+    assert arg2 in [i["name"] for i in inspect(dal.engine).get_indexes(arg1)]
+    dal.dispose()
+
+
+def test_DataAccessLayer_adds_indexes_to_existing_datastore(tmpdir):
+    conn = f"sqlite:///{tmpdir.join('datastore.db')}"
+    dal = DataAccessLayer(conn)
+    dal.connect()
+    with dal.engine.begin() as c:
+        c.exec_driver_sql("DROP INDEX ix_ticket_reported_bib_wid")
+    dal.dispose()
+
+    dal = DataAccessLayer(conn)
+    dal.connect()
+    indexes = [i["name"] for i in inspect(dal.engine).get_indexes("ticket")]
+    assert "ix_ticket_reported_bib_wid" in indexes
+    dal.dispose()
+
+
+def test_DataAccessLayer_adds_columns_to_existing_datastore(tmpdir):
+    # file and ticket tables as created before ingest checkpoints and
+    # closing of tickets were added
+    conn = f"sqlite:///{tmpdir.join('datastore.db')}"
+    engine = create_engine(conn)
+    with engine.begin() as c:
+        c.exec_driver_sql(
+            "CREATE TABLE file (wid INTEGER NOT NULL, timestamp DATETIME NOT NULL, "
+            "handle VARCHAR NOT NULL, library_wid INTEGER NOT NULL, PRIMARY KEY (wid))"
+        )
+        c.exec_driver_sql(
+            "CREATE TABLE ticket (wid INTEGER NOT NULL, timestamp DATETIME NOT NULL, "
+            "conflict_wid INTEGER NOT NULL, order_wid INTEGER NOT NULL, "
+            "bib_wid INTEGER NOT NULL, copies INTEGER NOT NULL, "
+            "reported BOOLEAN NOT NULL, PRIMARY KEY (wid))"
+        )
+        c.exec_driver_sql(
+            "INSERT INTO file VALUES (1, '2021-08-01 00:00:00', 'foo', 1)"
+        )
+        c.exec_driver_sql(
+            "INSERT INTO ticket VALUES (1, '2021-08-01 00:00:00', 1, 1, 1, 0, 0)"
+        )
+    engine.dispose()
+
+    dal = DataAccessLayer(conn)
+    dal.connect()
+    session = dal.Session()
+    file = session.query(File).one()
+    assert (file.checkpoint_offset, file.checkpoint_row) == (0, 0)
+    assert file.completed is False
+    assert session.query(Ticket).one().closed is False
+    session.close()
+    dal.dispose()
+
+
+def test_DataAccessLayer_merges_duplicate_tickets_of_existing_datastore(tmpdir):
+    # ticket table as created before tickets were de-duplicated
+    conn = f"sqlite:///{tmpdir.join('datastore.db')}"
+    engine = create_engine(conn)
+    with engine.begin() as c:
+        c.exec_driver_sql(
+            "CREATE TABLE ticket (wid INTEGER NOT NULL, timestamp DATETIME NOT NULL, "
+            "conflict_wid INTEGER NOT NULL, order_wid INTEGER NOT NULL, "
+            "bib_wid INTEGER NOT NULL, copies INTEGER NOT NULL, "
+            "reported BOOLEAN NOT NULL, PRIMARY KEY (wid))"
+        )
+        for values in (
+            "1, '2021-08-01 00:00:00', 1, 10, 100, 2, 1",
+            "2, '2021-08-02 00:00:00', 1, 10, 100, 3, 0",
+            "3, '2021-08-02 00:00:00', 2, 10, 100, 3, 0",
+            "4, '2021-08-03 00:00:00', 1, 10, 100, 5, 0",
+        ):
+            c.exec_driver_sql(f"INSERT INTO ticket VALUES ({values})")
+    engine.dispose()
+
+    dal = DataAccessLayer(conn)
+    dal.connect()
+    session = dal.Session()
+    tickets = session.query(Ticket).order_by(Ticket.wid).all()
+    assert [(t.wid, t.conflict_wid, t.copies, t.reported) for t in tickets] == [
+        (1, 1, 5, True),
+        (3, 2, 3, False),
+    ]
+    session.close()
+    indexes = [i["name"] for i in inspect(dal.engine).get_indexes("ticket")]
+    assert "ix_ticket_conflict_order_bib" in indexes
+    dal.dispose()
+
+
+def test_DatastoreWriter_runs_units_in_order_on_one_thread(tmpdir, monkeypatch):
+    monkeypatch.setattr(dal, "conn", f"sqlite:///{tmpdir.join('datastore.db')}")
+
+    def add(session, code):
+        session.add(Library(code=code))
+        return threading.get_ident()
+
+    with DatastoreWriter() as writer:
+        futures = [writer.submit(add, code, label="bpl") for code in ("a", "b", "c")]
+        threads = {f.result() for f in futures}
+    assert len(threads) == 1 and threading.get_ident() not in threads
+    assert writer.seconds["bpl"] > 0
+    with session_scope() as s:
+        assert [lib.code for lib in s.query(Library).order_by(Library.wid)] == [
+            "a",
+            "b",
+            "c",
+        ]
+
+
+def test_DatastoreWriter_rolls_back_failed_unit(tmpdir, monkeypatch):
+    monkeypatch.setattr(dal, "conn", f"sqlite:///{tmpdir.join('datastore.db')}")
+
+    def fail(session):
+        session.add(Library(code="a"))
+        raise ValueError
+
+    with DatastoreWriter() as writer:
+        with pytest.raises(ValueError):
+            writer.submit(fail).result()
+    assert writer.seconds == {}
+    with session_scope() as s:
+        assert s.query(Library).count() == 0
+
+
+def test_DatastoreWriter_writes_to_given_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(dal, "conn", None)
+    store = DataAccessLayer(f"sqlite:///{tmpdir.join('datastore.db')}")
+
+    def add(session):
+        session.add(Library(code="a"))
+
+    with DatastoreWriter(store) as writer:
+        writer.submit(add).result()
+    with session_scope(store) as s:
+        assert s.query(Library).count() == 1
+    store.dispose()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import time
+
+import pytest
+import requests
+
+from bookops_watchdog.log_handlers import (
+    DroppingQueueHandler,
+    LogglyBatchHandler,
+    enqueue_handlers,
+)
+from bookops_watchdog.worker_reports import SierraExportReader
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+        self.messages = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.messages.append(self.format(record))
+
+
+@pytest.fixture
+def test_logger():
+    logger = logging.getLogger("bookops-watchdog-test")
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    yield logger
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+
+@pytest.fixture
+def loggly(mocker):
+    handler = LogglyBatchHandler("https://logs.foo/bulk", capacity=3, flood_limit=2)
+    handler.setFormatter(logging.Formatter("%(levelname)s-%(message)s"))
+    post = mocker.patch.object(handler.session, "post")
+    return handler, post
+
+
+def make_record(msg, *args, level=logging.ERROR):
+    return logging.LogRecord("foo", level, "foo.py", 1, msg, args, None)
+
+
+def test_dropping_queue_handler_drops_when_full():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+    handler.handle(make_record("foo %s", 1))
+    handler.handle(make_record("foo %s", 2))
+    assert handler.dropped == 1
+    record = handler.queue.get_nowait()
+    assert (record.msg, record.args, record.template) == ("foo 1", None, "foo %s")
+
+
+def test_enqueue_handlers(test_logger):
+    sink = SlowHandler(0)
+    sink.setLevel(logging.INFO)
+    test_logger.handlers = [sink]
+    listener = enqueue_handlers(test_logger)
+    test_logger.debug("spam")
+    test_logger.info("foo %s", "bar")
+    listener.stop()
+    assert test_logger.level == logging.INFO
+    assert [type(h) for h in test_logger.handlers] == [DroppingQueueHandler]
+    assert sink.messages == ["foo bar"]
+
+
+def test_loggly_batch_handler_posts_batches(loggly):
+    handler, post = loggly
+    for n in range(4):
+        handler.handle(make_record(f"foo {n}"))
+    assert post.call_count == 1
+    assert post.call_args.kwargs["data"] == b"ERROR-foo 0\nERROR-foo 1\nERROR-foo 2"
+    handler.close()
+    assert post.call_count == 2
+    assert post.call_args.kwargs["data"] == b"ERROR-foo 3"
+
+
+def test_loggly_batch_handler_flushes_after_interval(loggly):
+    handler, post = loggly
+    handler.flush_interval = 0
+    handler.handle(make_record("foo"))
+    assert post.call_count == 1
+
+
+def test_loggly_batch_handler_flushes_single_record_on_timer(loggly):
+    handler, post = loggly
+    handler.flush_interval = 0.2
+    handler.handle(make_record("foo"))
+    assert post.call_count == 0
+    deadline = time.monotonic() + 5
+    while post.call_count == 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert post.call_count == 1
+    assert post.call_args.kwargs["data"] == b"ERROR-foo"
+    assert handler._timer is None
+
+
+def test_loggly_batch_handler_close_cancels_timer(loggly):
+    handler, post = loggly
+    handler.flush_interval = 60
+    handler.handle(make_record("foo"))
+    timer = handler._timer
+    handler.close()
+    assert post.call_count == 1
+    timer.join(1)
+    assert not timer.is_alive()
+
+
+def test_enqueue_handlers_flushes_on_stop(test_logger, loggly):
+    handler, post = loggly
+    handler.flush_interval = 60
+    test_logger.handlers = [handler]
+    listener = enqueue_handlers(test_logger)
+    test_logger.error("foo")
+    listener.stop()
+    assert post.call_count == 1
+    handler.close()
+
+
+def test_loggly_batch_handler_escapes_newlines(loggly):
+    handler, post = loggly
+    handler.handle(make_record("foo\nbar"))
+    handler.flush()
+    assert post.call_args.kwargs["data"] == b"ERROR-foo\\nbar"
+
+
+def test_loggly_batch_handler_aggregates_floods(loggly):
+    handler, post = loggly
+    handler.capacity = 100
+    for n in range(5):
+        handler.handle(make_record("Unable to parse %s", n))
+    handler.handle(make_record("bar"))
+    handler.close()
+    assert post.call_args.kwargs["data"].decode("utf-8").split("\n") == [
+        "ERROR-Unable to parse 0",
+        "ERROR-Unable to parse 1",
+        "ERROR-bar",
+        "ERROR-Suppressed 3 repeated message(s): Unable to parse 4",
+    ]
+
+
+def test_loggly_batch_handler_drops_failed_batches(loggly):
+    handler, post = loggly
+    post.side_effect = requests.ConnectionError("down")
+    handler.handle(make_record("foo"))
+    handler.flush()
+    assert handler.dropped == 1
+    assert handler.buffer == []
+
+
+def test_slow_sink_does_not_slow_down_parsing(tmpdir):
+    # every row has invalid copies and logs a debug message
+    rows = 200
+    with open("tests/sierra_export_bpl_sample.txt", "r") as f:
+        header, row = f.readlines()[:2]
+    row = row.replace("^10^^o", "^foo^^o")
+    export = tmpdir.join("export.txt")
+    export.write(header + row * rows)
+
+    logger = logging.getLogger("bookops-watchdog")
+    handlers, level = logger.handlers, logger.level
+    sink = SlowHandler(0.005)
+    logger.handlers = [sink]
+    logger.setLevel(logging.DEBUG)
+    try:
+        listener = enqueue_handlers(logger)
+        start = time.perf_counter()
+        assert len(list(SierraExportReader(str(export)))) == rows
+        elapsed = time.perf_counter() - start
+        listener.stop()
+    finally:
+        logger.handlers, logger.level = handlers, level
+
+    # the sink alone needs 1 second to handle all messages
+    assert elapsed < rows * sink.delay / 4
+    assert len(sink.messages) >= rows
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+
+import pytest
+
+from bookops_watchdog.metrics import Metrics, metrics
+
+
+@pytest.fixture
+def enabled():
+    return Metrics(enabled=True)
+
+
+def test_disabled_metrics_collect_nothing():
+    m = Metrics()
+    with m.timer("foo") as timer:
+        timer.rows = 10
+    m.count("bar")
+    m.add("spam", 1.0)
+    assert m.timed("foo")(lambda x: x + 1)(1) == 2
+    assert m.summary()["stages"] == {}
+    assert m.summary()["counters"] == {}
+    assert m.report() is None
+
+
+def test_disabled_timer_is_shared():
+    m = Metrics()
+    assert m.timer("foo") is m.timer("bar")
+
+
+def test_timer_records_throughput(enabled):
+    for _ in range(2):
+        with enabled.timer("reader.parse") as timer:
+            timer.rows = 500
+            timer.bytes = 1000
+    stage = enabled.summary()["stages"]["reader.parse"]
+    assert stage["calls"] == 2
+    assert stage["rows"] == 1000
+    assert stage["bytes"] == 2000
+    assert stage["rows_per_sec"] > 0 and stage["bytes_per_sec"] > 0
+    assert 0 < stage["max_seconds"] <= stage["seconds"]
+
+
+def test_timer_records_failed_block(enabled):
+    with pytest.raises(ValueError):
+        with enabled.timer("foo"):
+            raise ValueError
+    assert enabled.summary()["stages"]["foo"]["calls"] == 1
+
+
+def test_timed_decorator(enabled):
+    @enabled.timed("drive.list")
+    def listing(library):
+        return [library]
+
+    assert listing("bpl") == ["bpl"]
+    assert listing.__name__ == "listing"
+    stage = enabled.summary()["stages"]["drive.list"]
+    assert stage["calls"] == 1
+    assert "rows" not in stage
+
+
+def test_counters(enabled):
+    enabled.count("drive.files", 3)
+    enabled.count("drive.files")
+    assert enabled.summary()["counters"] == {"drive.files": 4}
+
+
+def test_report_logs_saves_and_resets(enabled, tmpdir, caplog):
+    caplog.set_level(logging.INFO, logger="bookops-watchdog")
+    metrics_fh = str(tmpdir.join("metrics.jsonl"))
+    enabled.add("foo", 0.5, rows=10)
+    enabled.report(metrics_fh)
+    enabled.count("bar")
+    enabled.report(metrics_fh)
+
+    with open(metrics_fh) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert lines[0]["stages"]["foo"]["rows_per_sec"] == 20
+    assert lines[1]["stages"] == {}
+    assert lines[1]["counters"] == {"bar": 1}
+    assert "Run metrics:" in caplog.text
+    assert enabled.report(metrics_fh) is None
+
+
+def test_report_survives_unwritable_file(enabled, tmpdir, caplog):
+    enabled.count("bar")
+    summary = enabled.report(str(tmpdir.join("missing", "metrics.jsonl")))
+    assert summary["counters"] == {"bar": 1}
+    assert "Unable to write metrics file" in caplog.text
+
+
+def test_instrumented_reader(ser, monkeypatch):
+    monkeypatch.setattr(metrics, "enabled", True)
+    metrics.reset()
+    list(ser)
+    list(ser.iter_chunks(2))
+    stages = metrics.summary()["stages"]
+    metrics.reset()
+    assert stages["reader.iter"]["rows"] == 5
+    assert stages["reader.iter"]["bytes"] == ser.stats.bytes_read
+    assert stages["reader.parse"]["calls"] == 3
+    assert stages["reader.normalize"]["rows"] == 5
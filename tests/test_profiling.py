@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import pstats
+import threading
+import tracemalloc
+
+import pytest
+
+from bookops_watchdog.profiling import cpu_hot_spots, profile
+
+
+def busy_function():
+    return sum(i * i for i in range(50000))
+
+
+def test_profile_without_mode(tmpdir):
+    with profile(None, str(tmpdir)):
+        busy_function()
+    assert tmpdir.listdir() == []
+
+
+def test_profile_unknown_mode(tmpdir):
+    with pytest.raises(ValueError):
+        with profile("io", str(tmpdir)):
+            pass
+
+
+def test_profile_cpu(tmpdir, caplog):
+    caplog.set_level(logging.INFO, logger="bookops-watchdog")
+    with profile("cpu", str(tmpdir)):
+        busy_function()
+    (dump,) = tmpdir.listdir()
+    assert dump.basename.startswith("profile-cpu-")
+    assert dump.ext == ".pstats"
+    stats = pstats.Stats(str(dump))
+    assert any(name == "busy_function" for _, _, name in stats.stats)
+    assert "CPU profile saved to" in caplog.text
+    assert "Top 20 functions by own time" in caplog.text
+    assert "test_profiling.py" in caplog.text
+
+
+def test_profile_cpu_includes_worker_threads(tmpdir):
+    with profile("cpu", str(tmpdir)):
+        thread = threading.Thread(target=busy_function)
+        thread.start()
+        thread.join()
+    (dump,) = tmpdir.listdir()
+    stats = pstats.Stats(str(dump))
+    assert any(name == "busy_function" for _, _, name in stats.stats)
+
+
+def test_profile_cpu_saves_dump_on_error(tmpdir):
+    with pytest.raises(RuntimeError):
+        with profile("cpu", str(tmpdir)):
+            raise RuntimeError
+    assert len(tmpdir.listdir()) == 1
+
+
+def test_cpu_hot_spots_top_n(tmpdir):
+    with profile("cpu", str(tmpdir)):
+        busy_function()
+    stats = pstats.Stats(str(tmpdir.listdir()[0]))
+    lines = cpu_hot_spots(stats, top=2)
+    assert len(lines) == 2
+    assert "calls" in lines[0]
+
+
+def test_profile_mem(tmpdir, caplog):
+    caplog.set_level(logging.INFO, logger="bookops-watchdog")
+    with profile("mem", str(tmpdir), top=5):
+        held = [bytes(1024) for _ in range(1000)]
+    assert not tracemalloc.is_tracing()
+    files = sorted(f.basename for f in tmpdir.listdir())
+    assert [f.rsplit(".", 1)[1] for f in files] == ["tracemalloc", "txt"]
+    snapshot = tracemalloc.Snapshot.load(str(tmpdir.listdir("*.tracemalloc")[0]))
+    assert snapshot.traces
+    top = tmpdir.listdir("*.txt")[0].readlines()
+    assert top[0].startswith("Top 5 allocation sites")
+    assert "test_profiling.py" in top[1]
+    assert "Memory snapshot saved to" in caplog.text
+    assert len(held) == 1000
@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import os
+
 import pytest
 
 
-from bookops_watchdog.worker_datastore import insert_or_ignore
-from bookops_watchdog.datastore import Library
+from bookops_watchdog.errors import WatchdogError
+from bookops_watchdog.worker_datastore import (
+    INGEST_COUNTS,
+    bulk_ingest,
+    bulk_upsert,
+    find_unprocessed_handles,
+    get_file,
+    ingest_chunk,
+    insert_or_ignore,
+)
+from bookops_watchdog.datastore import Bib, File, FileChange, Library, Order
+from bookops_watchdog.worker_reports import SierraExportReader
 
 
 def test_insert_or_ignore_insert(mock_datastore_session):
@@ -35,3 +47,273 @@ def test_insert_or_ignore_not_unique_ignore(mock_datastore_session):
     s.add(rec2)
     s.commit()
     assert rec2.wid == 1
+
+
+def test_bulk_upsert(mock_datastore_session):
+    s = mock_datastore_session
+    s.add_all([Library(wid=1, code="bpl"), Library(wid=2, code="nyp")])
+    s.commit()
+
+    written = bulk_upsert(
+        s,
+        Library,
+        [dict(wid=1, code="foo"), dict(wid=2, code="nyp"), dict(wid=3, code="bar")],
+        ["code"],
+    )
+    s.commit()
+    assert written == 2
+    assert s.query(Library).filter_by(wid=1).one().code == "foo"
+    assert s.query(Library).count() == 3
+
+
+def test_bulk_upsert_empty(mock_datastore_session):
+    assert bulk_upsert(mock_datastore_session, Library, [], ["code"]) == 0
+
+
+def test_bulk_ingest_updates_changed_records(mock_datastore_session, ser):
+    s = mock_datastore_session
+    bulk_ingest(s, ser, library_wid=1)
+    s.query(Order).filter_by(wid=2005302).update(dict(copies=0))
+    s.query(Bib).filter_by(wid=12203913).update(dict(title="foo"))
+    s.commit()
+    counts = bulk_ingest(s, ser, library_wid=1)
+    assert counts == dict(
+        bibs_inserted=0,
+        bibs_updated=1,
+        bibs_skipped=4,
+        orders_inserted=0,
+        orders_updated=1,
+        orders_skipped=4,
+    )
+    assert s.query(Order).filter_by(wid=2005302).one().copies == 10
+    assert s.query(Bib).filter_by(wid=12203913).one().title.startswith("Latvia")
+
+
+def test_bulk_ingest_counts(mock_datastore_session, ser):
+    s = mock_datastore_session
+    counts = bulk_ingest(s, ser, library_wid=1, batch_size=2)
+    s.commit()
+    assert counts == dict(
+        bibs_inserted=4,
+        bibs_updated=0,
+        bibs_skipped=1,
+        orders_inserted=5,
+        orders_updated=0,
+        orders_skipped=0,
+    )
+    assert s.query(Bib).count() == 4
+    assert s.query(Order).filter_by(bib_wid=12211319).count() == 2
+
+
+def test_bulk_ingest_compact_records(mock_datastore_session, ser):
+    reader = SierraExportReader(ser.fh, compact=True)
+    counts = bulk_ingest(mock_datastore_session, reader, library_wid=1)
+    assert counts["bibs_inserted"] == 4
+    assert counts["orders_inserted"] == 5
+
+
+def test_bulk_ingest_ignores_existing(mock_datastore_session, ser):
+    s = mock_datastore_session
+    bulk_ingest(s, ser, library_wid=1)
+    s.commit()
+    counts = bulk_ingest(s, ser, library_wid=1)
+    assert counts == dict(
+        bibs_inserted=0,
+        bibs_updated=0,
+        bibs_skipped=5,
+        orders_inserted=0,
+        orders_updated=0,
+        orders_skipped=5,
+    )
+
+
+def test_bulk_ingest_records_file_changes(mock_datastore_session, ser):
+    s = mock_datastore_session
+    s.add(File(wid=1, handle="BookOpsQCb.20210701063001", library_wid=1))
+    bulk_ingest(s, ser, library_wid=1, batch_size=2, file_wid=1)
+    s.commit()
+    changes = s.query(FileChange).filter_by(file_wid=1).all()
+    assert len(changes) == 5
+    assert {c.bib_wid for c in changes} == {b for (b,) in s.query(Bib.wid).all()}
+    bulk_ingest(s, ser, library_wid=1)
+    assert s.query(FileChange).count() == 5
+
+
+def test_bulk_ingest_records_only_changed_records(mock_datastore_session, ser):
+    s = mock_datastore_session
+    s.add_all(
+        [
+            File(wid=1, handle="BookOpsQCb.20210701063001", library_wid=1),
+            File(wid=2, handle="BookOpsQCb.20210702063001", library_wid=1),
+            File(wid=3, handle="BookOpsQCb.20210703063001", library_wid=1),
+        ]
+    )
+    bulk_ingest(s, ser, library_wid=1, file_wid=1)
+    s.query(Order).filter_by(wid=2015692).update(dict(copies=0))
+    s.query(Bib).filter_by(wid=12203913).update(dict(title="foo"))
+    bulk_ingest(s, ser, library_wid=1, file_wid=2)
+    bulk_ingest(s, ser, library_wid=1, file_wid=3)
+    s.commit()
+    changes = s.query(FileChange.bib_wid, FileChange.order_wid).filter_by(file_wid=2)
+    assert sorted(changes) == [(12203913, 2005302), (12211319, 2015692)]
+    assert s.query(FileChange).filter_by(file_wid=3).count() == 0
+
+
+def test_bulk_ingest_invalid_batch_size(mock_datastore_session, ser):
+    with pytest.raises(ValueError):
+        bulk_ingest(mock_datastore_session, ser, library_wid=1, batch_size=0)
+
+
+@pytest.fixture
+def processed_files(mock_datastore_session):
+    s = mock_datastore_session
+    s.add_all(
+        [
+            Library(wid=1, code="bpl"),
+            Library(wid=2, code="nyp"),
+            File(handle="BookOpsQCb.20210701063001", library_wid=1, completed=True),
+            File(handle="BookOpsQCb.20210703063001", library_wid=1, completed=True),
+            File(handle="BookOpsQCn.20210702063001", library_wid=2, completed=True),
+            File(handle="BookOpsQCb.20210704063001", library_wid=1),
+        ]
+    )
+    s.commit()
+    return s
+
+
+@pytest.mark.parametrize(
+    "arg1,arg2,expectation",
+    [
+        (1, [], []),
+        (1, ["BookOpsQCb.20210701063001"], []),
+        (
+            1,
+            [
+                "BookOpsQCb.20210701063001",
+                "BookOpsQCb.20210702063001",
+                "BookOpsQCb.20210703063001",
+                "BookOpsQCb.20210704063001",
+                "notes.txt",
+                "BookOpsQCb.20210702063001",
+            ],
+            ["BookOpsQCb.20210702063001", "BookOpsQCb.20210704063001"],
+        ),
+        (
+            2,
+            ["BookOpsQCn.20210702063001", "BookOpsQCn.20210703063001"],
+            ["BookOpsQCn.20210703063001"],
+        ),
+    ],
+)
+def test_find_unprocessed_handles(arg1, arg2, expectation, processed_files):
+    assert find_unprocessed_handles(processed_files, arg1, arg2) == expectation
+
+
+def test_find_unprocessed_handles_large_batch(processed_files):
+    delivered = [
+        f"BookOpsQCb.2021{m:02d}{d:02d}063001"
+        for m in range(1, 13)
+        for d in range(1, 29)
+    ]
+    unprocessed = find_unprocessed_handles(processed_files, 1, delivered)
+    assert len(unprocessed) == len(delivered) - 2
+    assert "BookOpsQCb.20210701063001" not in unprocessed
+
+
+def test_get_file(mock_datastore_session):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001")
+    assert (file.wid, file.checkpoint_offset, file.checkpoint_row) == (1, 0, 0)
+    assert file.completed is False
+    assert get_file(s, 1, "BookOpsQCb.20210701063001") is file
+    assert get_file(s, 2, "BookOpsQCb.20210701063001").wid == 2
+
+
+def test_get_file_keeps_checkpoint_of_same_source(mock_datastore_session):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001", 100, 1)
+    file.checkpoint_offset, file.checkpoint_row = 50, 2
+    file = get_file(s, 1, "BookOpsQCb.20210701063001", 100, 1)
+    assert (file.checkpoint_offset, file.checkpoint_row) == (50, 2)
+
+
+@pytest.mark.parametrize("arg", [(100, 2), (120, 1)])
+def test_get_file_resets_checkpoint_of_changed_source(arg, mock_datastore_session):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001", 100, 1)
+    file.checkpoint_offset, file.checkpoint_row = 50, 2
+    file = get_file(s, 1, "BookOpsQCb.20210701063001", *arg)
+    assert (file.checkpoint_offset, file.checkpoint_row) == (0, 0)
+    assert (file.source_size, file.source_mtime) == arg
+
+
+def test_get_file_reprocesses_changed_completed_source(mock_datastore_session):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001", 100, 1)
+    file.checkpoint_offset, file.completed = 100, True
+    assert get_file(s, 1, "BookOpsQCb.20210701063001", 100, 1).completed is True
+    assert get_file(s, 1, "BookOpsQCb.20210701063001", 100, 2).completed is False
+
+
+def test_get_file_keeps_completed_file_without_source(mock_datastore_session):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001")
+    file.checkpoint_offset, file.completed = 100, True
+    file = get_file(s, 1, "BookOpsQCb.20210701063001", 100, 1)
+    assert (file.checkpoint_offset, file.completed) == (100, True)
+    assert file.source_size == 100
+
+
+def test_ingest_chunk_checkpoints(mock_datastore_session, ser):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001")
+    bibs = 0
+    for records, end in ser.iter_chunks(2):
+        counts = ingest_chunk(s, file, records, file.checkpoint_offset, end)
+        bibs += counts["bibs_inserted"]
+        assert file.checkpoint_offset == end
+    assert bibs == 4
+    assert file.checkpoint_row == 5
+    assert file.checkpoint_offset == os.path.getsize(ser.fh)
+    assert file.completed is False
+    assert s.query(FileChange).filter_by(file_wid=file.wid).count() == 5
+
+
+def test_ingest_chunk_resumes_from_checkpoint(mock_datastore_session, ser):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001")
+    (first, end), (second, second_end) = list(ser.iter_chunks(2))[:2]
+    ingest_chunk(s, file, first, 0, end)
+    s.commit()
+    # write of the second chunk is lost
+    ingest_chunk(s, file, second, end, second_end)
+    s.rollback()
+    assert file.checkpoint_row == 2
+    assert s.query(Order).count() == 2
+
+    counts = dict.fromkeys(INGEST_COUNTS, 0)
+    for records, offset in ser.iter_chunks(2, file.checkpoint_offset):
+        chunk = ingest_chunk(s, file, records, file.checkpoint_offset, offset)
+        for key, value in chunk.items():
+            counts[key] += value
+    assert counts == dict(
+        bibs_inserted=2,
+        bibs_updated=0,
+        bibs_skipped=1,
+        orders_inserted=3,
+        orders_updated=0,
+        orders_skipped=0,
+    )
+    assert file.checkpoint_row == 5
+    assert s.query(Order).count() == 5
+
+
+def test_ingest_chunk_rejects_chunk_past_checkpoint(mock_datastore_session, ser):
+    s = mock_datastore_session
+    file = get_file(s, 1, "BookOpsQCb.20210701063001")
+    (first, end), (second, _) = list(ser.iter_chunks(3))[:2]
+    with pytest.raises(WatchdogError):
+        ingest_chunk(s, file, second, end, os.path.getsize(ser.fh))
+    assert s.query(Order).count() == 0
+    ingest_chunk(s, file, first, 0, end)
+    assert (file.checkpoint_offset, file.checkpoint_row) == (end, 3)
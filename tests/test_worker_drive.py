@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
 from shutil import copyfile
+import sys
+import threading
+import time
 
 import pytest
 
+from bookops_watchdog.errors import WatchdogError
 from bookops_watchdog.worker_drive import (
+    DriveIndex,
+    InotifyBackend,
+    PollingBackend,
+    StagingCache,
+    get_watch_backend,
     find_unprocessed_files,
     get_sierra_files,
     is_sierra_export,
@@ -60,10 +70,272 @@ def test_find_unprocessed_files(arg1, arg2, expectation):
 )
 def test_get_sierra_files(arg1, arg2, tmpdir):
     root = tmpdir.mkdir("BookOpsWatchdog")
-    os.environ["watchdog_drive"] = str(root)
     os.mkdir(os.path.join(root, arg1.upper()))
     src = os.path.join("tests", arg2)
     dst = os.path.join(os.path.join(root, arg1.upper()), arg2)
     copyfile(src, dst)
-    files = get_sierra_files(arg1)
+    files = get_sierra_files(arg1, str(root))
     assert files == [arg2]
+
+
+@pytest.fixture
+def mock_drive(tmpdir):
+    root = tmpdir.mkdir("BookOpsWatchdog")
+    bpl = root.mkdir("BPL")
+    bpl.mkdir("Archive")
+    bpl.join("BookOpsQCb.20210801603001").write("foo")
+    bpl.join("notes.txt").write("bar")
+    return bpl
+
+
+def test_drive_index_scan_new_files(mock_drive, tmpdir):
+    index = DriveIndex(str(tmpdir.join("index.json")), mock_drive.dirname)
+    assert index.scan("bpl") == ["BookOpsQCb.20210801603001"]
+    assert index.scan("bpl") == []
+
+
+def test_drive_index_scan_changed_files(mock_drive, tmpdir):
+    index = DriveIndex(str(tmpdir.join("index.json")), mock_drive.dirname)
+    index.scan("bpl")
+    mock_drive.join("BookOpsQCb.20210801603001").write("foo-bar")
+    mock_drive.join("BookOpsQCb.20210802603001").write("spam")
+    assert sorted(index.scan("bpl")) == [
+        "BookOpsQCb.20210801603001",
+        "BookOpsQCb.20210802603001",
+    ]
+
+
+def test_drive_index_persisted(mock_drive, tmpdir):
+    index_fh = str(tmpdir.join("index.json"))
+    index = DriveIndex(index_fh, mock_drive.dirname)
+    index.scan("bpl")
+    index.save()
+    assert DriveIndex(index_fh, mock_drive.dirname).scan("bpl") == []
+
+
+def test_drive_index_in_memory(mock_drive, tmpdir):
+    index = DriveIndex(None, mock_drive.dirname)
+    assert index.scan("bpl") == ["BookOpsQCb.20210801603001"]
+    index.save()
+    assert tmpdir.listdir() == [mock_drive.dirpath()]
+
+
+def test_drive_index_removes_missing_files(mock_drive, tmpdir):
+    index = DriveIndex(str(tmpdir.join("index.json")), mock_drive.dirname)
+    index.scan("bpl")
+    mock_drive.join("BookOpsQCb.20210801603001").remove()
+    index.scan("bpl")
+    assert index.entries["bpl"] == {}
+
+
+def test_drive_index_corrupted_file(mock_drive, tmpdir):
+    index_fh = tmpdir.join("index.json")
+    index_fh.write("{foo")
+    index = DriveIndex(str(index_fh), mock_drive.dirname)
+    assert index.entries == {}
+    assert index.scan("bpl") == ["BookOpsQCb.20210801603001"]
+
+
+def test_polling_backend_wait_stops(tmpdir):
+    stop_event = threading.Event()
+    stop_event.set()
+    backend = PollingBackend([str(tmpdir)], stop_event)
+    start = time.monotonic()
+    backend.wait(10)
+    assert time.monotonic() - start < 1
+
+
+@pytest.mark.skipif(
+    not sys.platform.startswith("linux"), reason="inotify is Linux only"
+)
+def test_inotify_backend_wakes_on_new_file(tmpdir):
+    backend = get_watch_backend([str(tmpdir)], threading.Event())
+    assert isinstance(backend, InotifyBackend)
+    try:
+        tmpdir.join("BookOpsQCb.20210801603001").write("foo")
+        start = time.monotonic()
+        backend.wait(10)
+        assert time.monotonic() - start < 5
+    finally:
+        backend.close()
+
+
+def test_get_watch_backend_polling_fallback(tmpdir, monkeypatch):
+    monkeypatch.setattr(sys, "platform", "win32")
+    backend = get_watch_backend([str(tmpdir)], threading.Event())
+    assert isinstance(backend, PollingBackend)
+    assert backend.name == "polling"
+
+
+def test_get_watch_backend_missing_directory(tmpdir):
+    backend = get_watch_backend([str(tmpdir.join("foo"))], threading.Event())
+    assert backend.name == "polling"
+
+
+@pytest.fixture
+def staged_export(tmpdir):
+    drive = tmpdir.mkdir("drive")
+    fh = str(drive.join("BookOpsQCb.20210801603001"))
+    copyfile("tests/sierra_export_bpl_sample.txt", fh)
+    return fh
+
+
+@pytest.fixture
+def staging_dir(tmpdir):
+    return str(tmpdir.join("staging"))
+
+
+def test_staging_cache_disabled(staged_export):
+    assert StagingCache().stage(staged_export) == staged_export
+
+
+def test_staging_cache_stage(staged_export, staging_dir, mocker):
+    spy = mocker.spy(sys.modules["bookops_watchdog.worker_drive"], "_copy_and_hash")
+    cache = StagingCache(staging_dir)
+    local = cache.stage(staged_export)
+    with open(staged_export, "rb") as f:
+        data = f.read()
+    assert os.path.dirname(local) == staging_dir
+    assert os.path.basename(local) == hashlib.sha256(data).hexdigest()
+    with open(local, "rb") as f:
+        assert f.read() == data
+    assert cache.stage(staged_export) == local
+    assert spy.call_count == 1
+    assert sorted(os.listdir(staging_dir)) == sorted(
+        ["index.json", os.path.basename(local)]
+    )
+
+
+def test_staging_cache_reused_across_runs(staged_export, staging_dir, mocker):
+    local = StagingCache(staging_dir).stage(staged_export)
+    spy = mocker.spy(sys.modules["bookops_watchdog.worker_drive"], "_copy_and_hash")
+    assert StagingCache(staging_dir).stage(staged_export) == local
+    assert spy.call_count == 0
+
+
+def test_staging_cache_restages_changed_export(staged_export, staging_dir):
+    cache = StagingCache(staging_dir)
+    first = cache.stage(staged_export)
+    with open(staged_export, "a") as f:
+        f.write("\n")
+    second = cache.stage(staged_export)
+    assert first != second
+    assert os.path.getsize(second) == os.path.getsize(staged_export)
+
+
+def test_staging_cache_same_content_stored_once(staged_export, staging_dir):
+    other = staged_export.replace("603001", "603002")
+    copyfile(staged_export, other)
+    cache = StagingCache(staging_dir)
+    assert cache.stage(staged_export) == cache.stage(other)
+    assert len(cache.objects) == 1
+    assert len(cache.sources) == 2
+
+
+def test_staging_cache_evicts_least_recently_used(tmpdir, staging_dir):
+    exports = []
+    for n in range(3):
+        fh = str(tmpdir.join(f"export{n}.txt"))
+        with open(fh, "w") as f:
+            f.write(str(n) * 100)
+        exports.append(fh)
+    cache = StagingCache(staging_dir, max_size=250)
+    first = cache.stage(exports[0])
+    cache.release(first)
+    cache.release(cache.stage(exports[1]))
+    cache.release(cache.stage(exports[0]))
+    cache.release(cache.stage(exports[2]))
+    assert cache.size == 200
+    assert os.path.isfile(first)
+    assert os.path.abspath(exports[1]) not in cache.sources
+    assert len(os.listdir(staging_dir)) == 3
+
+
+@pytest.fixture
+def small_exports(tmpdir):
+    exports = []
+    for n in range(2):
+        fh = str(tmpdir.join(f"export{n}.txt"))
+        with open(fh, "w") as f:
+            f.write(str(n) * 100)
+        exports.append(fh)
+    return exports
+
+
+def test_staging_cache_keeps_copies_in_use(small_exports, staging_dir):
+    cache = StagingCache(staging_dir, max_size=150)
+    first = cache.stage(small_exports[0])
+    second = cache.stage(small_exports[1])
+    assert cache.size == 200
+    assert os.path.isfile(first)
+    cache.release(first)
+    assert not os.path.isfile(first)
+    assert os.path.isfile(second)
+    assert cache.size == 100
+
+
+def test_staging_cache_eviction_error(small_exports, staging_dir, mocker):
+    cache = StagingCache(staging_dir, max_size=150)
+    first = cache.stage(small_exports[0])
+    cache.release(first)
+    mocker.patch("bookops_watchdog.worker_drive.os.remove", side_effect=PermissionError)
+    cache.stage(small_exports[1])
+    assert os.path.isfile(first)
+    assert os.path.basename(first) in cache.objects
+
+
+def test_staging_cache_copies_without_lock(staged_export, staging_dir, mocker):
+    module = sys.modules["bookops_watchdog.worker_drive"]
+    copy = module._copy_and_hash
+    cache = StagingCache(staging_dir)
+
+    def copy_unlocked(src, dst):
+        assert not cache._lock.locked()
+        return copy(src, dst)
+
+    mocker.patch.object(module, "_copy_and_hash", side_effect=copy_unlocked)
+    local = cache.stage(staged_export)
+    assert os.path.isfile(local)
+    assert sorted(os.listdir(staging_dir)) == sorted(
+        ["index.json", os.path.basename(local)]
+    )
+
+
+def test_staging_cache_corrupted_copy(staged_export, staging_dir, mocker):
+    mocker.patch("bookops_watchdog.worker_drive._hash_file", return_value="foo")
+    cache = StagingCache(staging_dir)
+    with pytest.raises(WatchdogError):
+        cache.stage(staged_export)
+    assert os.listdir(staging_dir) == []
+    assert cache.objects == dict()
+
+
+def test_staging_cache_export_changed_while_copied(staged_export, staging_dir, mocker):
+    module = sys.modules["bookops_watchdog.worker_drive"]
+    copy = module._copy_and_hash
+
+    def copy_and_modify(src, dst):
+        digest = copy(src, dst)
+        with open(src, "a") as f:
+            f.write("foo")
+        return digest
+
+    mocker.patch.object(module, "_copy_and_hash", side_effect=copy_and_modify)
+    with pytest.raises(WatchdogError):
+        StagingCache(staging_dir).stage(staged_export)
+
+
+def test_staging_cache_drops_missing_copies(staged_export, staging_dir):
+    local = StagingCache(staging_dir).stage(staged_export)
+    os.remove(local)
+    cache = StagingCache(staging_dir)
+    assert cache.objects == dict()
+    assert cache.stage(staged_export) == local
+    assert os.path.isfile(local)
+
+
+def test_staging_cache_corrupted_index(staged_export, staging_dir):
+    os.makedirs(staging_dir)
+    with open(os.path.join(staging_dir, "index.json"), "w") as f:
+        f.write("foo")
+    assert StagingCache(staging_dir).sources == dict()
@@ -1 +1,204 @@
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
 import pytest
+
+from bookops_watchdog.datastore import Bib, Conflict, Library, Ticket
+from bookops_watchdog.errors import WatchdogError
+from bookops_watchdog.worker_datastore import BIB_DEFAULTS
+from bookops_watchdog.worker_email import (
+    SendGridTransport,
+    build_digests,
+    get_unreported_tickets,
+    mark_reported,
+    send_digests,
+)
+
+RECIPIENTS = {
+    "bpl": {"error": ["a@bpl.org"], "warning": ["a@bpl.org", "b@bpl.org"]},
+    "nypl": {"error": ["c@nypl.org"], "warning": ["c@nypl.org"]},
+}
+
+
+class StubTransport:
+    def __init__(self, fail_for=None):
+        self.fail_for = fail_for
+        self.sent = []
+
+    def send(self, recipients, subject, body):
+        if recipients == self.fail_for:
+            raise WatchdogError("Rejected.")
+        self.sent.append((recipients, subject, body))
+
+
+@pytest.fixture
+def tickets(mock_datastore_session):
+    s = mock_datastore_session
+    s.add_all(
+        [
+            Library(wid=1, code="bpl"),
+            Library(wid=2, code="nyp"),
+            Conflict(wid=1, code="BIB001", tier="error", description="No date."),
+            Conflict(wid=2, code="ORD001", tier="warning", description="No copies."),
+        ]
+    )
+    s.bulk_insert_mappings(
+        Bib,
+        [
+            dict(BIB_DEFAULTS, wid=1, library_wid=1, title="Foo"),
+            dict(BIB_DEFAULTS, wid=2, library_wid=1, title="Bar"),
+            dict(BIB_DEFAULTS, wid=3, library_wid=2, title="Spam"),
+        ],
+    )
+    s.bulk_insert_mappings(
+        Ticket,
+        [
+            dict(wid=1, conflict_wid=2, order_wid=11, bib_wid=1, copies=0),
+            dict(wid=2, conflict_wid=1, order_wid=21, bib_wid=2, copies=1),
+            dict(wid=3, conflict_wid=1, order_wid=31, bib_wid=3, copies=2),
+            dict(wid=4, conflict_wid=2, order_wid=12, bib_wid=1, reported=True),
+            dict(wid=5, conflict_wid=2, order_wid=13, bib_wid=1, closed=True),
+        ],
+    )
+    s.commit()
+    return s
+
+
+def test_get_unreported_tickets(tickets):
+    rows = get_unreported_tickets(tickets)
+    assert [(r.wid, r.library, r.tier) for r in rows] == [
+        (2, "bpl", "error"),
+        (1, "bpl", "warning"),
+        (3, "nypl", "error"),
+    ]
+    assert rows[0].title == "Bar"
+
+
+def test_build_digests_groups_by_recipients(tickets):
+    rows = get_unreported_tickets(tickets)
+    recipients = dict(
+        RECIPIENTS, bpl={"error": ["a@bpl.org"], "warning": ["a@bpl.org"]}
+    )
+    digests = build_digests(rows, recipients)
+    assert len(digests) == 2
+    assert digests[0].recipients == ["a@bpl.org"]
+    assert digests[0].ticket_wids == [2, 1]
+    assert "BPL errors, BPL warnings" in digests[0].subject
+    assert "[ORD001] No copies." in digests[0].body
+    assert "b1 / o11 (copies: 0) Foo" in digests[0].body
+
+
+def test_build_digests_skips_missing_recipients(tickets, caplog):
+    digests = build_digests(get_unreported_tickets(tickets), {"bpl": RECIPIENTS["bpl"]})
+    assert [d.ticket_wids for d in digests] == [[2], [1]]
+    assert "No recipients of NYPL error notifications" in caplog.text
+
+
+def test_mark_reported(tickets):
+    assert mark_reported(tickets, [1, 3]) == 2
+    assert mark_reported(tickets, []) == 0
+    assert tickets.query(Ticket).filter_by(reported=False).count() == 2
+
+
+def test_mark_reported_in_batches(tickets, monkeypatch):
+    monkeypatch.setattr("bookops_watchdog.worker_email.IN_CLAUSE_BATCH_SIZE", 2)
+    assert mark_reported(tickets, [1, 2, 3]) == 3
+    assert tickets.query(Ticket).filter_by(reported=False).count() == 1
+
+
+def test_send_digests(tickets):
+    transport = StubTransport()
+    counts = send_digests(tickets, transport, RECIPIENTS)
+    tickets.commit()
+    assert counts == dict(sent=3, failed=0, reported=3)
+    assert len(transport.sent) == 3
+    assert tickets.query(Ticket).filter_by(reported=False).count() == 1
+
+
+def test_send_digests_leaves_failed_unreported(tickets):
+    transport = StubTransport(fail_for=["c@nypl.org"])
+    counts = send_digests(tickets, transport, RECIPIENTS)
+    assert counts == dict(sent=2, failed=1, reported=2)
+    unreported = tickets.query(Ticket).filter_by(reported=False)
+    assert sorted(t.wid for t in unreported) == [3, 5]
+
+
+def test_send_digests_nothing_to_report(mock_datastore_session):
+    transport = StubTransport()
+    counts = send_digests(mock_datastore_session, transport, RECIPIENTS)
+    assert counts == dict(sent=0, failed=0, reported=0)
+    assert transport.sent == []
+
+
+@pytest.fixture
+def stub_server():
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            server.requests.append(
+                (self.headers["Authorization"], json.loads(self.rfile.read(length)))
+            )
+            status = server.statuses.pop(0) if server.statuses else 202
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    server.statuses = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def stub_transport(server, **kwargs):
+    url = f"http://127.0.0.1:{server.server_address[1]}/v3/mail/send"
+    return SendGridTransport("key", "watchdog@bookops.org", url=url, **kwargs)
+
+
+def test_sendgrid_transport_send(stub_server):
+    transport = stub_transport(stub_server)
+    transport.send(["a@bpl.org"], "Foo", "Bar")
+    transport.close()
+    auth, payload = stub_server.requests[0]
+    assert auth == "Bearer key"
+    assert payload["personalizations"] == [{"to": [{"email": "a@bpl.org"}]}]
+    assert payload["from"] == {"email": "watchdog@bookops.org"}
+    assert payload["content"] == [{"type": "text/plain", "value": "Bar"}]
+
+
+def test_sendgrid_transport_retries(stub_server):
+    stub_server.statuses = [503, 429]
+    transport = stub_transport(stub_server, backoff=0.01)
+    transport.send(["a@bpl.org"], "Foo", "Bar")
+    assert len(stub_server.requests) == 3
+
+
+def test_sendgrid_transport_rejected(stub_server):
+    stub_server.statuses = [400]
+    transport = stub_transport(stub_server)
+    with pytest.raises(WatchdogError):
+        transport.send(["a@bpl.org"], "Foo", "Bar")
+
+
+def test_sendgrid_transport_gives_up(stub_server):
+    stub_server.statuses = [503] * 3
+    transport = stub_transport(stub_server, retries=2, backoff=0.01)
+    with pytest.raises(WatchdogError):
+        transport.send(["a@bpl.org"], "Foo", "Bar")
+    assert len(stub_server.requests) == 3
+
+
+def test_send_digests_through_stub_server(tickets, stub_server):
+    transport = stub_transport(stub_server)
+    counts = send_digests(tickets, transport, RECIPIENTS, max_workers=2)
+    assert counts["sent"] == 3
+    assert len(stub_server.requests) == 3
@@ -1,7 +1,196 @@
+import csv
 from datetime import datetime
+import gzip
+import io
+import os
+import zipfile
 
 import pytest
 
+from bookops_watchdog import worker_reports
+from bookops_watchdog.worker_reports import (
+    Record,
+    SierraExportReader,
+    _scan_line,
+    batch_to_records,
+    chunk_ranges,
+    count_records,
+    open_export,
+    parse_date,
+    records_to_batch,
+    sierra_no_to_int,
+)
+
+HEADER = "RECORD #(BIBLIO)^CAT DATE^TITLE\n"
+
+
+@pytest.mark.parametrize(
+    "arg1,arg2,expectation",
+    [
+        (b"b1^foo^bar\n", False, False),
+        (b'b1^"foo\n', False, True),
+        (b'b1^"foo"^bar\n', False, False),
+        (b'b1^foo "bar\n', False, False),
+        (b'spam"^bar\n', True, False),
+        (b'spam ""quoted"" \n', True, True),
+        (b'b1^12" disk^"foo\n', False, True),
+        (b'b1^"12"" disk"^foo\n', False, False),
+        (b'^"foo\n', False, True),
+    ],
+)
+def test_scan_line(arg1, arg2, expectation):
+    assert _scan_line(arg1, arg2) == expectation
+
+
+@pytest.mark.parametrize(
+    "arg,expectation",
+    [
+        ("", 0),
+        (HEADER, 0),
+        (f"{HEADER}b1^01-01-2021^Foo\nb2^01-01-2021^Bar\n", 2),
+        (f"{HEADER}b1^01-01-2021^Foo\nb2^01-01-2021^Bar", 2),
+        (f'{HEADER}b1^01-01-2021^"Foo\nbar"\nb2^01-01-2021^Bar\n', 2),
+        (f'{HEADER}b1^01-01-2021^Foo "bar\nb2^01-01-2021^Bar\n', 2),
+    ],
+)
+def test_count_records(arg, expectation, tmpdir):
+    fh = tmpdir.join("export.txt")
+    fh.write_binary(arg.encode())
+    assert count_records(str(fh)) == expectation
+
+
+def test_count_records_matches_parsing(ser):
+    assert count_records(ser.fh) == len(list(ser))
+
+
+def test_count_records_quoted_fields(tmpdir):
+    fh = tmpdir.join("export.txt")
+    rows = [f'".b1220391{n}"^01-01-2021^"Foo ""bar"""\n' for n in range(10)]
+    fh.write_binary((HEADER + "".join(rows)).encode())
+    assert count_records(str(fh)) == 10
+
+
+def test_count_records_inch_mark_before_quoted_newline():
+    # literal quote inside a title, later field quoted across a newline
+    fh = "tests/sierra_export_bpl_inch_mark.txt"
+    with open(fh, "r", newline="") as f:
+        rows = list(csv.reader(f, delimiter="^"))
+    assert count_records(fh) == len(rows) - 1 == 2
+    reader = SierraExportReader(fh)
+    assert len(reader) == 2
+    records = [r for chunk, _ in reader.iter_chunks(1) for r in chunk]
+    assert records == list(reader)
+    assert records[0]["title"].startswith('Latvia 12" disk')
+
+
+@pytest.fixture
+def large_export(tmpdir):
+    fh = tmpdir.join("large_export.txt")
+    with open("tests/sierra_export_bpl_sample.txt", "r") as src:
+        header = src.readline()
+        rows = [r.rstrip("\n") + "\n" for r in src.readlines()]
+    fh.write(header + "".join(rows * 40))
+    return str(fh)
+
+
+@pytest.mark.parametrize("arg", [1, 1000, 10**9])
+def test_chunk_ranges_record_aligned(arg, large_export):
+    ranges = chunk_ranges(large_export, arg)
+    with open(large_export, "rb") as f:
+        header = f.readline()
+        f.seek(0)
+        data = f.read()
+    assert ranges[0][0] == len(header)
+    assert ranges[-1][1] == len(data)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+    for start, _ in ranges:
+        assert data[start - 1 : start] == b"\n"
+
+
+def test_chunk_ranges_quoted_newlines(tmpdir):
+    fh = tmpdir.join("export.txt")
+    fh.write_binary(f'{HEADER}b1^01-01-2021^"Foo\nbar"\nb2^01-01-2021^Bar\n'.encode())
+    assert chunk_ranges(str(fh), 1) == [(32, 56), (56, 74)]
+
+
+def test_chunk_ranges_empty_file(tmpdir):
+    fh = tmpdir.join("export.txt")
+    fh.write("")
+    assert chunk_ranges(str(fh), 1) == []
+
+
+@pytest.mark.parametrize("arg", [True, False])
+def test_iter_parallel_same_as_serial(arg, large_export):
+    reader = SierraExportReader(large_export)
+    serial = list(reader)
+    parallel = list(reader.iter_parallel(workers=2, chunk_size=2048, ordered=arg))
+    assert len(parallel) == 200
+    if arg:
+        assert parallel == serial
+    else:
+        key = lambda r: (r["bibNo"], r["orderNo"])  # noqa: E731
+        assert sorted(parallel, key=key) == sorted(serial, key=key)
+
+
+def test_iter_parallel_compact(large_export):
+    reader = SierraExportReader(large_export, compact=True)
+    records = list(reader.iter_parallel(workers=2, chunk_size=2048))
+    assert all(isinstance(r, Record) for r in records)
+    assert records == list(reader)
+
+
+def test_iter_parallel_encoding(tmpdir, large_export):
+    fh = tmpdir.join("latin1_export.txt")
+    with open(large_export, "r") as src:
+        fh.write_binary(
+            src.read().replace("Latvia /", "Latvi\u00eb /").encode("latin-1")
+        )
+    reader = SierraExportReader(str(fh), encoding="latin-1")
+    records = list(reader.iter_parallel(workers=2, chunk_size=2048))
+    assert records == list(reader)
+    assert records[0]["title"].startswith("Latvi\u00eb")
+
+
+def test_iter_parallel_single_worker_parses_serially(large_export, mocker):
+    pool = mocker.patch.object(worker_reports, "ProcessPoolExecutor")
+    reader = SierraExportReader(large_export)
+    assert list(reader.iter_parallel(workers=1)) == list(reader)
+    assert list(reader.iter_parallel(workers=2, chunk_size=10**9)) == list(reader)
+    assert pool.call_count == 0
+
+
+def test_chunk_ranges_quoted_fields(tmpdir):
+    fh = tmpdir.join("export.txt")
+    rows = [f'".b1220391{n}"^01-01-2021^"Foo ""bar"""\n' for n in range(10)]
+    fh.write_binary((HEADER + "".join(rows)).encode())
+    ranges = chunk_ranges(str(fh), 1)
+    assert len(ranges) == 10
+    assert ranges[-1][1] == os.path.getsize(str(fh))
+
+
+def test_iter_parallel_invalid_chunk_size(ser):
+    with pytest.raises(ValueError):
+        list(ser.iter_parallel(chunk_size=0))
+
+
+def test_sierra_export_reader_len(ser):
+    assert len(ser) == 5
+
+
+def test_sierra_export_reader_len_cached(tmpdir, mocker):
+    fh = tmpdir.join("export.txt")
+    fh.write(f"{HEADER}b1^01-01-2021^Foo\n")
+    spy = mocker.spy(SierraExportReader, "_normalize_data")
+    reader = SierraExportReader(str(fh))
+    assert len(reader) == 1
+    assert len(SierraExportReader(str(fh))) == 1
+    assert spy.call_count == 0
+
+    fh.write(f"{HEADER}b1^01-01-2021^Foo\nb2^01-01-2021^Bar\n")
+    os.utime(str(fh), ns=(0, 10**9))
+    assert len(reader) == 2
+
 
 @pytest.mark.parametrize(
     "arg,expectation",
@@ -24,6 +213,31 @@ def test_normalize_date(arg, expectation, ser):
     assert ser._normalize_date(arg) == expectation
 
 
+@pytest.mark.parametrize(
+    "arg,expectation",
+    [
+        ("07-06-2021", datetime(2021, 7, 6)),
+        ("7-6-2021", datetime(2021, 7, 6)),
+        ("02-30-2021", None),
+        ("13-01-2021", None),
+        ("  -  -    ", None),
+        ("", None),
+    ],
+)
+def test_parse_date(arg, expectation):
+    assert parse_date(arg) == expectation
+
+
+def test_parse_date_cache_stats():
+    parse_date.cache_clear()
+    parse_date("01-29-2021")
+    parse_date("01-29-2021")
+    parse_date("02-01-2021")
+    info = parse_date.cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+
+
 @pytest.mark.parametrize(
     "arg,expectation",
     [
@@ -60,3 +274,255 @@ def test_normalize_author(arg, expectation, ser):
 )
 def test_normalize_title(arg, expectation, ser):
     assert ser._normalize_title(arg) == expectation
+
+
+@pytest.fixture
+def record():
+    return Record(
+        author="Barlas, Robert.",
+        bibNo="12203913",
+        catDate=datetime(2021, 7, 6),
+        orderDate=datetime(2019, 4, 19),
+        orderNo="2005302",
+        copies=10,
+        subjects=["Latvia -- Juvenile literature."],
+        title="Latvia",
+    )
+
+
+def test_record_dict_access(record):
+    assert record["bibNo"] == "12203913"
+    assert record.get("copies") == 10
+    assert record.get("foo") is None
+    assert "title" in record
+    assert len(record) == 8
+    with pytest.raises(KeyError):
+        record["foo"]
+    with pytest.raises(TypeError):
+        record["copies"] = 1
+
+
+def test_record_has_no_instance_dict(record):
+    assert not hasattr(record, "__dict__")
+
+
+def test_record_equals_dict(record):
+    assert record == record.to_dict()
+    assert dict(record) == record.to_dict()
+
+
+def test_record_repr(record):
+    assert repr(record).startswith("Record(author='Barlas, Robert.', bibNo='12203913'")
+
+
+def test_sierra_export_reader_compact_same_as_dict(ser):
+    compact = list(SierraExportReader(ser.fh, compact=True))
+    assert all(isinstance(r, Record) for r in compact)
+    assert compact == list(ser)
+
+
+@pytest.mark.parametrize("arg", [1, 3, 10000])
+def test_iter_columnar_batch_sizes(arg, large_export):
+    np = pytest.importorskip("numpy")
+    batches = list(SierraExportReader(large_export).iter_columnar(batch_size=arg))
+    assert sum(len(b["bibNo"]) for b in batches) == 200
+    assert all(len(b["title"]) <= arg for b in batches)
+    assert batches[0]["bibNo"].dtype == np.int64
+    assert batches[0]["copies"].dtype == np.int64
+    assert batches[0]["catDate"].dtype == np.dtype("datetime64[D]")
+    assert batches[0]["subjects"].dtype == object
+
+
+def test_iter_columnar_round_trip(ser):
+    pytest.importorskip("numpy")
+    records = []
+    for batch in ser.iter_columnar(batch_size=2):
+        records.extend(batch_to_records(batch))
+    assert records == list(ser)
+
+
+@pytest.mark.parametrize(
+    "arg,expectation",
+    [
+        ("12203913", 12203913),
+        ("b12203913", 12203913),
+        ("foo", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_sierra_no_to_int(arg, expectation):
+    assert sierra_no_to_int(arg) == expectation
+
+
+def test_records_to_batch_quoted_sierra_numbers(tmpdir):
+    pytest.importorskip("numpy")
+    fh = tmpdir.join("export.txt")
+    with open("tests/sierra_export_bpl_sample.txt") as src:
+        header, row = src.readline(), src.readline()
+    row = row.replace("b122039130^", '".b122039130"^').replace(
+        "^o20053022^", '^".o20053022"^'
+    )
+    fh.write(header + row)
+    (record,) = SierraExportReader(str(fh))
+    assert (record["bibNo"], record["orderNo"]) == ("b12203913", "o2005302")
+    batch = records_to_batch([record])
+    assert batch["bibNo"].tolist() == [12203913]
+    assert batch["orderNo"].tolist() == [2005302]
+
+
+def test_records_to_batch_invalid_values():
+    np = pytest.importorskip("numpy")
+    record = dict(
+        author=None,
+        bibNo="",
+        catDate=None,
+        orderDate=datetime(2021, 1, 1),
+        orderNo="2005302",
+        copies=None,
+        subjects=[],
+        title="Foo",
+    )
+    batch = records_to_batch([record])
+    assert batch["bibNo"].mask.tolist() == [True]
+    assert batch["copies"].mask.tolist() == [True]
+    assert np.isnat(batch["catDate"][0])
+    assert batch_to_records(batch) == [dict(record, bibNo=None)]
+
+
+def test_iter_columnar_vectorized_counts(large_export):
+    np = pytest.importorskip("numpy")
+    batch = next(SierraExportReader(large_export).iter_columnar())
+    dates, counts = np.unique(batch["catDate"], return_counts=True)
+    assert dates.tolist() == [datetime(2021, 7, 6).date()]
+    assert counts.tolist() == [200]
+    assert batch["copies"].sum() == 28 * 40
+
+
+def test_iter_columnar_invalid_batch_size(ser):
+    with pytest.raises(ValueError):
+        next(ser.iter_columnar(batch_size=0))
+
+
+@pytest.fixture
+def compressed_exports(tmpdir, ser):
+    with open(ser.fh, "rb") as f:
+        data = f.read()
+    gz = tmpdir.join("export.txt.gz")
+    with gzip.open(str(gz), "wb") as f:
+        f.write(data)
+    zp = tmpdir.join("export.zip")
+    with zipfile.ZipFile(str(zp), "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("BookOpsQCb.20210801603001", data)
+    return str(gz), str(zp)
+
+
+@pytest.mark.parametrize("arg", [0, 1])
+def test_sierra_export_reader_compressed(arg, compressed_exports, ser):
+    reader = SierraExportReader(compressed_exports[arg])
+    assert list(reader) == list(ser)
+    assert len(reader) == 5
+    assert list(reader.iter_parallel(workers=1)) == list(ser)
+
+
+def test_sierra_export_reader_stream(ser):
+    with open(ser.fh, "rb") as f:
+        stream = io.BytesIO(f.read())
+    reader = SierraExportReader(stream)
+    assert len(reader) == 5
+    assert stream.tell() == 0
+    assert list(reader) == list(ser)
+    assert not stream.closed
+
+
+def test_sierra_export_reader_compressed_stream(compressed_exports, ser):
+    with open(compressed_exports[0], "rb") as f:
+        assert list(SierraExportReader(f)) == list(ser)
+
+
+def test_sierra_export_reader_non_seekable_stream_len(ser, mocker):
+    stream = io.BytesIO(b"")
+    mocker.patch.object(stream, "seekable", return_value=False)
+    with pytest.raises(TypeError):
+        len(SierraExportReader(stream))
+
+
+def test_sierra_export_reader_read_stats(ser):
+    size = os.path.getsize(ser.fh)
+    list(ser)
+    assert ser.stats.bytes_read == size
+    assert ser.stats.reads <= 3
+    assert ser.stats.bytes_per_second > 0
+
+    reader = SierraExportReader(ser.fh, block_size=256)
+    assert list(reader) == list(ser)
+    assert reader.stats.reads >= size // 256
+
+
+def test_open_export_invalid_block_size(ser):
+    with pytest.raises(ValueError):
+        with open_export(ser.fh, block_size=0):
+            pass
+
+
+def test_open_export_empty_zip(tmpdir):
+    zp = tmpdir.join("export.zip")
+    with zipfile.ZipFile(str(zp), "w"):
+        pass
+    with pytest.raises(ValueError):
+        with open_export(str(zp)):
+            pass
+
+
+def test_iter_chunks_same_as_serial(ser):
+    chunks = list(ser.iter_chunks(2))
+    assert [len(records) for records, _ in chunks] == [2, 2, 1]
+    assert [r for records, _ in chunks for r in records] == list(ser)
+    assert chunks[-1][1] == os.path.getsize(ser.fh)
+
+
+def test_iter_chunks_resume(ser):
+    first, offset = next(ser.iter_chunks(2))
+    rest = [r for records, _ in ser.iter_chunks(2, offset) for r in records]
+    assert first + rest == list(ser)
+
+
+def test_iter_chunks_quoted_newlines(tmpdir, ser):
+    with open(ser.fh, "rb") as f:
+        header, row = f.readlines()[:2]
+    fields = row.split(b"^")
+    fields[3] = b'"Foo\nbar"'
+    quoted = b"^".join(fields)
+    fh = tmpdir.join("export.txt")
+    fh.write_binary(header + quoted + row)
+    chunks = list(SierraExportReader(str(fh)).iter_chunks(1))
+    assert [c[1] for c in chunks] == [
+        len(header) + len(quoted),
+        len(header) + len(quoted) + len(row),
+    ]
+    assert chunks[0][0][0]["title"] == "Foo\nbar"
+
+
+def test_iter_chunks_compressed_resume(compressed_exports, ser):
+    reader = SierraExportReader(compressed_exports[0])
+    _, offset = next(reader.iter_chunks(3))
+    rest = [r for records, _ in reader.iter_chunks(3, offset) for r in records]
+    assert rest == list(ser)[3:]
+
+
+def test_iter_chunks_non_seekable_stream_resume(ser, mocker):
+    _, offset = next(ser.iter_chunks(3))
+    with open(ser.fh, "rb") as f:
+        stream = io.BytesIO(f.read())
+    mocker.patch.object(stream, "seekable", return_value=False)
+    rest = [
+        r
+        for records, _ in SierraExportReader(stream).iter_chunks(3, offset)
+        for r in records
+    ]
+    assert rest == list(ser)[3:]
+
+
+def test_iter_chunks_invalid_size(ser):
+    with pytest.raises(ValueError):
+        next(ser.iter_chunks(0))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy import select, update
+
+from bookops_watchdog.datastore import Bib, Conflict, File, FileChange, Order, Ticket
+from bookops_watchdog.worker_datastore import BIB_DEFAULTS
+from bookops_watchdog.worker_rules import (
+    DEFAULT_RULES,
+    Rule,
+    changed_bibs,
+    close_resolved_tickets,
+    evaluate_file_changes,
+    evaluate_rules,
+    get_conflict_wids,
+    rule_matches,
+    upsert_tickets,
+)
+
+
+@pytest.fixture
+def catalog(mock_datastore_session):
+    s = mock_datastore_session
+    s.bulk_insert_mappings(
+        Bib,
+        [
+            dict(
+                BIB_DEFAULTS,
+                wid=1,
+                library_wid=1,
+                title="Foo",
+                catDate=date(2021, 7, 6),
+                subjects="Latvia.",
+            ),
+            dict(BIB_DEFAULTS, wid=2, library_wid=1, title="Bar", subjects=""),
+            dict(
+                BIB_DEFAULTS,
+                wid=3,
+                library_wid=2,
+                title="Spam",
+                catDate=date(2021, 1, 1),
+                subjects="Uganda.",
+            ),
+        ],
+    )
+    s.bulk_insert_mappings(
+        Order,
+        [
+            dict(wid=11, bib_wid=1, copies=10, orderDate=date(2019, 4, 19)),
+            dict(wid=12, bib_wid=1, copies=0, orderDate=date(2019, 4, 19)),
+            dict(wid=21, bib_wid=2, copies=2, orderDate=date(2019, 4, 19)),
+            dict(wid=31, bib_wid=3, copies=4, orderDate=date(2021, 2, 1)),
+        ],
+    )
+    s.commit()
+    return s
+
+
+def test_default_rules_unique_codes():
+    codes = [rule.code for rule in DEFAULT_RULES]
+    assert len(codes) == len(set(codes))
+
+
+def test_get_conflict_wids_adds_missing(mock_datastore_session):
+    s = mock_datastore_session
+    s.add(Conflict(code="BIB001", tier="error", description="foo"))
+    s.commit()
+    wids = get_conflict_wids(s, DEFAULT_RULES)
+    assert wids["BIB001"] == 1
+    assert s.query(Conflict).count() == len(DEFAULT_RULES)
+    assert s.query(Conflict).filter_by(code="ORD001").one().tier == "warning"
+
+
+@pytest.mark.parametrize(
+    "arg1,arg2,expectation",
+    [
+        ("BIB001", None, [(21, 2, 2)]),
+        ("BIB002", None, [(21, 2, 2)]),
+        ("ORD001", None, [(12, 1, 0)]),
+        ("ORD002", None, [(31, 3, 4)]),
+        ("ORD002", 1, []),
+    ],
+)
+def test_rule_matches(arg1, arg2, expectation, catalog):
+    rule = [r for r in DEFAULT_RULES if r.code == arg1][0]
+    assert catalog.execute(rule_matches(rule, arg2)).all() == expectation
+
+
+def test_evaluate_rules_creates_tickets(catalog):
+    counts = evaluate_rules(catalog)
+    catalog.commit()
+    assert counts == dict(BIB001=1, BIB002=1, ORD001=1, ORD002=1)
+    conflict = catalog.query(Conflict).filter_by(code="ORD001").one()
+    ticket = catalog.query(Ticket).filter_by(conflict_wid=conflict.wid).one()
+    assert (ticket.order_wid, ticket.bib_wid, ticket.copies) == (12, 1, 0)
+    assert ticket.reported is False
+
+
+def test_evaluate_rules_library(catalog):
+    counts = evaluate_rules(catalog, library_wid=2)
+    assert counts == dict(BIB001=0, BIB002=0, ORD001=0, ORD002=1)
+
+
+def test_evaluate_rules_custom_rule(catalog):
+    rule = Rule("ORD100", "warning", "Large order.", Order.copies >= 4)
+    assert evaluate_rules(catalog, [rule]) == dict(ORD100=2)
+    assert catalog.query(Conflict).filter_by(code="ORD100").count() == 1
+
+
+@pytest.fixture
+def changed_catalog(catalog):
+    catalog.add(File(wid=1, handle="BookOpsQCb.20210701063001", library_wid=1))
+    catalog.add(FileChange(file_wid=1, bib_wid=1, order_wid=12))
+    catalog.commit()
+    return catalog
+
+
+def test_changed_bibs(changed_catalog):
+    assert changed_catalog.execute(changed_bibs([1])).scalars().all() == [1]
+    assert changed_catalog.execute(changed_bibs([2])).scalars().all() == []
+
+
+def test_rule_matches_scoped_to_bibs(changed_catalog):
+    rule = [r for r in DEFAULT_RULES if r.code == "ORD001"][0]
+    stmt = rule_matches(rule, bib_wids=changed_bibs([1]))
+    assert changed_catalog.execute(stmt).all() == [(12, 1, 0)]
+    rule = [r for r in DEFAULT_RULES if r.code == "BIB001"][0]
+    stmt = rule_matches(rule, bib_wids=changed_bibs([1]))
+    assert changed_catalog.execute(stmt).all() == []
+
+
+def test_rule_matches_includes_dependents(changed_catalog):
+    # bibs sharing title with a changed bib are re-evaluated as well
+    def same_title(bib_wids):
+        titles = select(Bib.title).where(Bib.wid.in_(bib_wids))
+        return select(Bib.wid).where(Bib.title.in_(titles))
+
+    changed_catalog.execute(update(Bib).where(Bib.wid == 2).values(title="Foo"))
+    rule = Rule("BIB100", "warning", "Duplicate.", Bib.title == "Foo", same_title)
+    stmt = rule_matches(rule, bib_wids=changed_bibs([1]))
+    assert changed_catalog.execute(stmt).all() == [(11, 1, 10), (12, 1, 0), (21, 2, 2)]
+
+
+def test_evaluate_file_changes(changed_catalog):
+    counts = evaluate_file_changes(changed_catalog, [1])
+    assert counts == dict(BIB001=0, BIB002=0, ORD001=1, ORD002=0)
+    assert changed_catalog.query(Ticket).count() == 1
+
+
+def ord001_ticket(session):
+    return session.query(Ticket).filter_by(order_wid=12).one()
+
+
+def test_evaluate_rules_does_not_duplicate_tickets(catalog):
+    evaluate_rules(catalog)
+    evaluate_rules(catalog)
+    catalog.commit()
+    assert catalog.query(Ticket).count() == 4
+
+
+def test_evaluate_rules_updates_unreported_tickets(catalog):
+    evaluate_rules(catalog)
+    catalog.execute(update(Order).where(Order.wid == 11).values(copies=0))
+    catalog.execute(update(Ticket).values(timestamp=datetime(2021, 1, 1)))
+    counts = evaluate_rules(catalog)
+    catalog.commit()
+    assert counts["ORD001"] == 2
+    assert (
+        catalog.query(Ticket).filter(Ticket.timestamp > datetime(2021, 1, 1)).count()
+        == 5
+    )
+
+
+def test_evaluate_rules_leaves_reported_tickets(catalog):
+    evaluate_rules(catalog)
+    catalog.execute(update(Ticket).values(reported=True))
+    counts = evaluate_rules(catalog)
+    assert counts == dict(BIB001=0, BIB002=0, ORD001=0, ORD002=0)
+    assert catalog.query(Ticket).filter_by(reported=False).count() == 0
+
+
+def test_evaluate_rules_closes_resolved_tickets(catalog):
+    evaluate_rules(catalog)
+    catalog.execute(update(Order).where(Order.wid == 12).values(copies=3))
+    evaluate_rules(catalog)
+    catalog.commit()
+    assert ord001_ticket(catalog).closed is True
+    assert catalog.query(Ticket).filter_by(closed=False).count() == 3
+
+
+def test_evaluate_rules_reopens_closed_tickets(catalog):
+    evaluate_rules(catalog)
+    catalog.execute(update(Ticket).values(reported=True, closed=True))
+    evaluate_rules(catalog)
+    catalog.commit()
+    ticket = ord001_ticket(catalog)
+    assert (ticket.reported, ticket.closed) == (False, False)
+
+
+def test_close_resolved_tickets_scoped_to_bibs(changed_catalog):
+    rule = [r for r in DEFAULT_RULES if r.code == "ORD001"][0]
+    wid = get_conflict_wids(changed_catalog, [rule])["ORD001"]
+    upsert_tickets(changed_catalog, wid, rule_matches(rule), datetime.now())
+    changed_catalog.execute(update(Order).values(copies=5))
+    assert (
+        close_resolved_tickets(changed_catalog, rule, wid, bib_wids=changed_bibs([2]))
+        == 0
+    )
+    assert (
+        close_resolved_tickets(changed_catalog, rule, wid, bib_wids=changed_bibs([1]))
+        == 1
+    )
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_evaluate_rules_closes_tickets_of_moved_orders(changed_catalog, incremental):
+    evaluate_rules(changed_catalog)
+    # re-export moves order 12 (ORD001) from bib 1 to bib 2
+    changed_catalog.execute(update(Order).where(Order.wid == 12).values(bib_wid=2))
+    changed_catalog.execute(update(FileChange).values(bib_wid=2))
+    if incremental:
+        evaluate_file_changes(changed_catalog, [1])
+    else:
+        evaluate_rules(changed_catalog)
+    changed_catalog.commit()
+    tickets = changed_catalog.query(Ticket).filter_by(order_wid=12).all()
+    assert [t.closed for t in tickets if t.bib_wid == 1] == [True]
+    assert all(not t.closed for t in tickets if t.bib_wid == 2)